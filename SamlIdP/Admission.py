@@ -0,0 +1,147 @@
+from collections import OrderedDict
+import threading
+import time
+
+from .Counters import Counters
+
+# Client IP buckets kept (least recently used are dropped)
+MAX_IP_BUCKETS = 100000
+
+
+class   AdmissionError(Exception):
+    """ Request refused for load - status is 429 (rate limited) or 503 (overloaded) """
+
+    def __init__(self, status, reason, retry_after=1):
+
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+
+class   TokenBucket:
+    """ Token bucket rate limit: rate tokens per second, up to burst """
+
+    def __init__(self, rate, burst=None):
+
+        self.rate = float(rate)
+        self.burst = float(burst if burst else rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    @classmethod
+    def fromConfig(this, limit):
+        """ TokenBucket from {'rate': n, 'burst': m}, None if not limited """
+
+        if not limit:
+            return None
+
+        return this(limit['rate'], limit.get('burst'))
+
+
+    def take(self):
+        """ True if a token was available """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+
+            return False
+
+
+
+class   AdmissionControl:
+    """ Per-SP and per-client rate limits and a global in-flight signing limit """
+
+    def __init__(self, idp_config):
+
+        self.ip_limit = idp_config.get('ip_rate_limit')
+        self.ip_buckets = OrderedDict()
+        self.ip_lock = threading.Lock()
+
+        self.max_signing = idp_config.get('max_inflight_signing')
+        self.signing_slots = threading.BoundedSemaphore(self.max_signing) if self.max_signing else None
+
+        # slots held by this thread - a request holds one from admission to its response
+        self.held = threading.local()
+
+        self.counters = Counters('admitted', 'ip_limited', 'sp_limited', 'signing_overloaded')
+
+
+    def reinit(self):
+        """ Fresh locks and signing slots (a forked worker inherits them in whatever state) """
+
+        self.ip_lock = threading.Lock()
+        self.signing_slots = threading.BoundedSemaphore(self.max_signing) if self.max_signing else None
+        self.held = threading.local()
+        self.counters.reinit()
+
+
+    def ipBucket(self, client_ip):
+
+        with self.ip_lock:
+            bucket = self.ip_buckets.get(client_ip)
+
+            if bucket is None:
+                bucket = self.ip_buckets[client_ip] = TokenBucket.fromConfig(self.ip_limit)
+                if len(self.ip_buckets) > MAX_IP_BUCKETS:
+                    self.ip_buckets.popitem(last=False)
+            else:
+                self.ip_buckets.move_to_end(client_ip)
+
+            return bucket
+
+
+    def admit(self, client_ip, sp=None):
+        """ Raise AdmissionError if the client or SP is over its limit """
+
+        if self.ip_limit and not self.ipBucket(client_ip).take():
+            self.counters.add('ip_limited')
+            raise AdmissionError(429, 'Too many requests from client')
+
+        if sp is not None and sp.rate_limit is not None and not sp.rate_limit.take():
+            self.counters.add('sp_limited')
+            raise AdmissionError(429, f'Too many requests for {sp.sp_id}')
+
+        self.counters.add('admitted')
+
+
+    def signing(self):
+        """ Context manager holding an in-flight signing slot (nested use shares the outer one) """
+
+        return _SigningSlot(self)
+
+
+
+class   _SigningSlot:
+
+    def __init__(self, admission):
+        self.slots = admission.signing_slots
+        self.admission = admission
+
+    def __enter__(self):
+
+        held = self.admission.held
+        depth = getattr(held, 'depth', 0)
+
+        if depth == 0 and self.slots is not None and not self.slots.acquire(blocking=False):
+            self.admission.counters.add('signing_overloaded')
+            raise AdmissionError(503, 'Signing capacity exhausted')
+
+        held.depth = depth + 1
+
+    def __exit__(self, *args):
+
+        held = self.admission.held
+        held.depth -= 1
+
+        if held.depth == 0 and self.slots is not None:
+            self.slots.release()
@@ -0,0 +1,254 @@
+from base64 import b64encode, b64decode
+from datetime import datetime
+from hashlib import sha1
+from secrets import token_bytes, token_hex
+import sqlite3
+import threading
+import time
+from xml.sax.saxutils import quoteattr
+
+from lxml import etree
+
+from .constants import *
+from .SamlSerializer import ThreadParsers
+from .SPservice import SamlSPservice
+
+# SAML 2.0 artifact type 0x0004: TypeCode(2) EndpointIndex(2) SourceID(20) MessageHandle(20)
+ARTIFACT_TYPECODE = b'\x00\x04'
+ARTIFACT_LENGTH = 44
+
+# Artifacts are short lived - SPs resolve them immediately
+DEFAULT_ARTIFACT_TTL = 60
+
+
+def createArtifact(idp_id, endpoint_index=0):
+    """ Return a new b64 encoded type 0x0004 artifact for idp_id """
+
+    artifact = ARTIFACT_TYPECODE \
+        + endpoint_index.to_bytes(2, 'big') \
+        + sha1(idp_id.encode('utf-8')).digest() \
+        + token_bytes(20)
+
+    return b64encode(artifact).decode()
+
+
+def artifactSourceId(artifact):
+    """ Return the SourceID of a b64 encoded artifact, None if malformed """
+
+    try:
+        raw = b64decode(artifact, validate=True)
+    except Exception:
+        return None
+
+    if len(raw) != ARTIFACT_LENGTH or raw[:2] != ARTIFACT_TYPECODE:
+        return None
+
+    return raw[4:24]
+
+
+
+class   ArtifactStore:
+    """ Single-use, expiring store of issued SAML messages keyed by artifact """
+
+    def put(self, artifact, sp_id, saml_data, ttl=DEFAULT_ARTIFACT_TTL):
+        raise NotImplementedError
+
+    def take(self, artifact):
+        """ Remove and return (sp_id, saml_data), or None if unknown or expired """
+        raise NotImplementedError
+
+    def reinit(self):
+        """ Reset after fork """
+        pass
+
+
+
+class   MemoryArtifactStore(ArtifactStore):
+    """ In-process artifact store """
+
+    def __init__(self):
+
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.next_purge = 0
+
+
+    def put(self, artifact, sp_id, saml_data, ttl=DEFAULT_ARTIFACT_TTL):
+
+        now = time.monotonic()
+
+        with self.lock:
+            self.entries[artifact] = (now + ttl, sp_id, saml_data)
+
+            if now >= self.next_purge:
+                # drop anything never resolved
+                self.entries = {k: v for k, v in self.entries.items() if v[0] > now}
+                self.next_purge = now + ttl
+
+
+    def take(self, artifact):
+
+        with self.lock:
+            entry = self.entries.pop(artifact, None)
+
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+
+        return entry[1], entry[2]
+
+
+    def reinit(self):
+
+        self.lock = threading.Lock()
+        self.entries = {}
+
+
+
+class   SqliteArtifactStore(ArtifactStore):
+    """ SQLite artifact store (shared between processes on a host) """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.local = threading.local()
+
+        with self.connection as db:
+            db.execute('CREATE TABLE IF NOT EXISTS artifacts (artifact TEXT PRIMARY KEY, sp_id TEXT, saml_data BLOB, expires REAL)')
+
+
+    @property
+    def connection(self):
+        # sqlite3 connections can't be shared between threads
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = self.local.db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        return db
+
+
+    def put(self, artifact, sp_id, saml_data, ttl=DEFAULT_ARTIFACT_TTL):
+
+        now = time.time()
+        db = self.connection
+
+        db.execute('DELETE FROM artifacts WHERE expires <= ?', (now,))
+        db.execute('INSERT INTO artifacts VALUES (?,?,?,?)', (artifact, sp_id, saml_data, now + ttl))
+
+
+    def take(self, artifact):
+
+        db = self.connection
+
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            row = db.execute('SELECT sp_id, saml_data, expires FROM artifacts WHERE artifact = ?', (artifact,)).fetchone()
+            if row:
+                db.execute('DELETE FROM artifacts WHERE artifact = ?', (artifact,))
+        finally:
+            db.execute('COMMIT')
+
+        if row is None or row[2] <= time.time():
+            return None
+
+        return row[0], bytes(row[1])
+
+
+    def reinit(self):
+        # connections can't cross a fork
+        self.local = threading.local()
+
+
+
+def createArtifactStore(store):
+    """ Artifact store from idp_config['artifact_store'] - None/'memory', 'sqlite:<path>' or an ArtifactStore """
+
+    if store is None or store == 'memory':
+        return MemoryArtifactStore()
+
+    if isinstance(store, ArtifactStore):
+        return store
+
+    if isinstance(store, str) and store.startswith('sqlite:'):
+        return SqliteArtifactStore(store[len('sqlite:'):])
+
+    raise Exception(f'Config error: unknown artifact store {store}')
+
+
+
+class   ArtifactResolver:
+    """ Issue artifacts and answer SOAP <ArtifactResolve> requests for an IdP """
+
+    def __init__(self, idP, store=None, ttl=DEFAULT_ARTIFACT_TTL):
+
+        self.idP = idP
+        self.store = createArtifactStore(store)
+        self.ttl = ttl
+        self.source_id = sha1(idP.idp_id.encode('utf-8')).digest()
+
+        # white space is kept - it is covered by the SP's signature digest
+        self.parsers = ThreadParsers(resolve_entities=False, no_network=True)
+
+
+    def issue(self, sp_id, saml_data):
+        """ Store a signed SAML message, return its artifact """
+
+        artifact = createArtifact(self.idP.idp_id)
+        self.store.put(artifact, sp_id, saml_data, self.ttl)
+
+        return artifact
+
+
+    def reinit(self):
+        """ Reset store and parser after fork """
+
+        self.store.reinit()
+        self.parsers.reinit()
+
+
+    def resolve(self, soap_request):
+        """ Return SOAP <ArtifactResponse> for a SOAP <ArtifactResolve> """
+
+        envelope = etree.XML(soap_request, parser=self.parsers.get())
+        resolve = envelope.find(f'./{soapBodyTag}/{samlpArtifactResolveTag}')
+
+        if resolve is None:
+            raise Exception('SOAP body has no ArtifactResolve')
+
+        request_id = resolve.attrib['ID']
+        issuer = resolve.findtext(f'./{samlIssuerTag}')
+        artifact = resolve.findtext(f'./{samlpArtifactTag}', '').strip()
+
+        sp = SamlSPservice.getSamlSP(issuer, self.idP.idp_id)
+
+        if sp is None:
+            raise Exception(f'Unknown Service Provider {issuer}')
+
+        # the SP must sign the ArtifactResolve itself - without a certificate nobody can
+        if not sp.sp_cert or not sp.verifier.verifyReferenced(resolve):
+            return self.soapArtifactResponse(request_id, SamlStatusRequestDenied)
+
+        if artifactSourceId(artifact) != self.source_id:
+            return self.soapArtifactResponse(request_id, SamlStatusRequestor)
+
+        entry = self.store.take(artifact)
+
+        if entry is None:
+            # unknown, expired or already resolved - success with no message
+            return self.soapArtifactResponse(request_id, SamlStatusSuccess)
+
+        sp_id, saml_data = entry
+
+        if sp_id != issuer:
+            return self.soapArtifactResponse(request_id, SamlStatusRequestDenied)
+
+        return self.soapArtifactResponse(request_id, SamlStatusSuccess, saml_data)
+
+
+    def soapArtifactResponse(self, request_id, status, saml_data=b''):
+        """ Create SOAP wrapped <ArtifactResponse> """
+
+        instant = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+        if type(saml_data) is bytes:
+            saml_data = saml_data.decode('utf-8')
+
+        return f'<SOAP-ENV:Envelope xmlns:SOAP-ENV="{soapEnvelopeNS}"><SOAP-ENV:Body><samlp:ArtifactResponse xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="_{token_hex(16)}" InResponseTo={quoteattr(request_id)} Version="2.0" IssueInstant="{instant}"><saml:Issuer>{self.idP.idp_id}</saml:Issuer><samlp:Status><samlp:StatusCode Value="{status}"/></samlp:Status>{saml_data}</samlp:ArtifactResponse></SOAP-ENV:Body></SOAP-ENV:Envelope>'.encode('utf-8')
@@ -0,0 +1,102 @@
+import logging as logger
+import re
+
+
+class   AttributeReleasePolicy:
+    """ Compiled per-SP attribute release plan
+
+    A policy is a list of rules, one per released attribute:
+
+        {
+            'Name': 'uid',                  # session attribute (required)
+            'ReleaseAs': 'urn:oid:0.9.2342.19200300.100.1.1',  # default: Name
+            'NameFormat': SamlAttrNameFmtURI, # optional <Attribute NameFormat>
+            'Match': '^staff-',             # optional regex values must match
+            'Values': ['a', 'b'],           # optional list of permitted values
+            'Scope': 'example.com',         # optional '@scope' appended to values
+        }
+
+    A plain attribute name is accepted as a rule releasing that attribute as-is.
+    Rules are compiled once, when the SP is registered.  Filtered values
+    are compared as text - numbers are converted, bytes decoded as UTF-8,
+    and other values are logged and left out.
+    """
+
+    __slots__ = ('plan', 'sources')
+
+    def __init__(self, rules):
+
+        plan = []
+
+        for rule in rules:
+            if isinstance(rule, str):
+                rule = {'Name': rule}
+
+            source = rule.get('Name')
+            assert source, f'Config error: attribute release rule missing Name {rule}'
+
+            # static part of the <Attribute> element - copied per response
+            fragment = {'@Name': rule.get('ReleaseAs', source)}
+            if rule.get('NameFormat'):
+                fragment['@NameFormat'] = rule['NameFormat']
+
+            match = re.compile(rule['Match']).search if rule.get('Match') else None
+            permitted = frozenset(rule['Values']) if rule.get('Values') else None
+            scope = '@' + rule['Scope'] if rule.get('Scope') else None
+
+            plan.append((source, fragment, match, permitted, scope))
+
+        self.plan = tuple(plan)
+        self.sources = frozenset(step[0] for step in self.plan)
+
+
+    def release(self, attributes):
+        """ Return list of <Attribute> entries released from attributes """
+
+        released = []
+
+        for source, fragment, match, permitted, scope in self.plan:
+
+            values = attributes.get(source)
+            if values is None:
+                continue
+
+            if match is None and permitted is None and scope is None:
+                # fast path - released unaltered
+                entry = fragment.copy()
+                entry['AttributeValue'] = values
+                released.append(entry)
+                continue
+
+            if not isinstance(values, (list, tuple)):
+                values = (values,)
+
+            kept = [
+                value if scope is None else value + scope
+                for value in (_text(source, value) for value in values)
+                if value is not None
+                    and (permitted is None or value in permitted)
+                    and (match is None or match(value))
+            ]
+
+            if kept:
+                entry = fragment.copy()
+                entry['AttributeValue'] = kept if len(kept) > 1 else kept[0]
+                released.append(entry)
+
+        return released
+
+
+
+def _text(name, value):
+    """ Attribute value as str, None (logged) if it has no text form """
+
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+
+    logger.warning(f'Attribute {name}: value of type {type(value).__name__} not released')
+    return None
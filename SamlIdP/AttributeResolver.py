@@ -0,0 +1,313 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import logging as logger
+import sqlite3
+import threading
+import time
+
+from .Counters import Counters
+
+# Resolver lookups for all responses share one bounded pool
+RESOLVER_MAX_WORKERS = 16
+
+
+class   AttributeResolver:
+    """ Source of attributes about a principal, beyond those in the session
+
+    Subclasses implement lookup(principal) -> {attribute: value or [values]}
+    for the attribute names listed in provides.  A lookup that takes
+    longer than timeout seconds is abandoned for that response; results
+    are cached for ttl seconds.
+    """
+
+    def __init__(self, name, provides, timeout=1.0, ttl=300):
+
+        assert name, 'Config error: attribute resolver needs a name'
+        assert provides, f'Config error: attribute resolver {name} provides no attributes'
+
+        self.name = name
+        self.provides = frozenset(provides)
+        self.timeout = timeout
+        self.ttl = ttl
+
+
+    def lookup(self, principal):
+        raise NotImplementedError
+
+
+    def reinit(self):
+        """ Drop connections (e.g. in a forked worker) """
+        pass
+
+
+    @staticmethod
+    def collect(rows):
+        """ {attribute: value or [values]} from (attribute, value) pairs """
+
+        attributes = {}
+        for name, value in rows:
+            if value is None:
+                continue
+            attributes.setdefault(name, []).append(value if isinstance(value, str) else str(value))
+
+        return {name: values if len(values) > 1 else values[0] for name, values in attributes.items()}
+
+
+
+class   SqliteResolver(AttributeResolver):
+    """ Attributes from an SQLite query - every column is an attribute, every row adds values
+
+        {'type': 'sqlite', 'name': 'entitlements', 'path': '/var/lib/idp/entitlements.db',
+         'query': 'SELECT entitlement FROM grants WHERE uid = ?', 'provides': ['entitlement']}
+    """
+
+    def __init__(self, name, path, query, provides, timeout=1.0, ttl=300):
+
+        super().__init__(name, provides, timeout, ttl)
+
+        self.path = path
+        self.query = query
+
+        # sqlite connections belong to the thread that made them
+        self.local = threading.local()
+
+
+    def connection(self):
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path)
+        return conn
+
+
+    def lookup(self, principal):
+
+        cursor = self.connection().execute(self.query, (principal,))
+        columns = [column[0] for column in cursor.description]
+
+        return self.collect(
+            (column, value)
+                for row in cursor.fetchall()
+                for column, value in zip(columns, row)
+        )
+
+
+    def reinit(self):
+        self.local = threading.local()
+
+
+
+class   LdapResolver(AttributeResolver):
+    """ Attributes of the directory entry found by search_filter (needs ldap3)
+
+        {'type': 'ldap', 'name': 'directory', 'url': 'ldaps://ldap.example.com',
+         'base': 'ou=people,dc=example,dc=com', 'search_filter': '(uid={principal})',
+         'bind_dn': ..., 'password': ..., 'provides': ['mail', 'memberOf']}
+
+    connect is a callable returning a bound ldap3 Connection - e.g. one
+    using the MOCK_SYNC strategy for an in-process directory.
+    """
+
+    def __init__(self, name, base, provides, url=None, search_filter='(uid={principal})', bind_dn=None, password=None, connect=None, timeout=1.0, ttl=300):
+
+        super().__init__(name, provides, timeout, ttl)
+
+        self.url = url
+        self.base = base
+        self.search_filter = search_filter
+        self.bind_dn = bind_dn
+        self.password = password
+        self.connect = connect or self.bind
+
+        self.local = threading.local()
+
+
+    def bind(self):
+
+        from ldap3 import Server, Connection
+
+        return Connection(Server(self.url, connect_timeout=self.timeout), self.bind_dn, self.password,
+            auto_bind=True, receive_timeout=self.timeout, read_only=True)
+
+
+    def lookup(self, principal):
+
+        from ldap3.utils.conv import escape_filter_chars
+
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+
+        conn.search(self.base, self.search_filter.format(principal=escape_filter_chars(principal)),
+            attributes=sorted(self.provides), size_limit=1)
+
+        if not conn.entries:
+            return {}
+
+        entry = conn.entries[0]
+        return self.collect(
+            (name, value)
+                for name in self.provides if name in entry
+                for value in entry[name].values
+        )
+
+
+    def reinit(self):
+        self.local = threading.local()
+
+
+
+class   ResolverCache:
+    """ Resolved attributes per (resolver, principal) - TTL expiry and LRU eviction """
+
+    def __init__(self, size=10000):
+
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key):
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] <= time.monotonic():
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+
+    def set(self, key, attributes, ttl):
+
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, attributes)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+
+_resolverTypes = {
+    'sqlite': SqliteResolver,
+    'ldap': LdapResolver,
+}
+
+
+class   AttributeResolvers:
+    """ The attribute resolvers of an IdP
+
+    resolve() adds resolved attributes to the session attributes, asking
+    only the resolvers that provide an attribute the SP's release policy
+    needs.  Cache misses are looked up concurrently; a resolver that fails
+    or times out is logged and its attributes are left out.
+    """
+
+    def __init__(self, resolvers, principal_attr='uid', cache_size=10000):
+
+        self.resolvers = tuple(resolvers)
+        self.principal_attr = principal_attr
+        self.cache = ResolverCache(cache_size)
+
+        # resolvers needed per release policy (sources are a frozenset)
+        self.plans = {}
+
+        # threads are only started on the first submit
+        self.pool = ThreadPoolExecutor(RESOLVER_MAX_WORKERS, thread_name_prefix='samlidp-resolver')
+        self.counters = Counters('timeouts', 'errors')
+
+
+    @classmethod
+    def fromConfig(this, idp_config):
+        """ AttributeResolvers from idp_config['attribute_resolvers'], None if there are none """
+
+        configs = idp_config.get('attribute_resolvers')
+        if not configs:
+            return None
+
+        resolvers = []
+        for config in configs:
+            config = dict(config)
+            kind = config.pop('type')
+            assert kind in _resolverTypes, f'Config error: unknown attribute resolver type {kind}'
+            resolvers.append(_resolverTypes[kind](**config))
+
+        return this(resolvers,
+            principal_attr=idp_config.get('resolver_principal', 'uid'),
+            cache_size=idp_config.get('resolver_cache_size', 10000),
+        )
+
+
+    def plan(self, needed):
+        """ Resolvers providing any of the needed attribute names """
+
+        resolvers = self.plans.get(needed)
+        if resolvers is None:
+            resolvers = self.plans[needed] = tuple(r for r in self.resolvers if r.provides & needed)
+        return resolvers
+
+
+    def resolve(self, attributes, needed):
+        """ Session attributes plus those resolved for the needed attribute names """
+
+        resolvers = self.plan(needed)
+
+        principal = attributes.get(self.principal_attr)
+        if isinstance(principal, (list, tuple)):
+            principal = principal[0] if principal else None
+
+        if not resolvers or principal is None:
+            return attributes
+
+        resolved = []
+        pending = []
+        start = time.monotonic()
+
+        for resolver in resolvers:
+            cached = self.cache.get((resolver.name, principal))
+
+            if cached is not None:
+                resolved.append(cached)
+            else:
+                pending.append((resolver, self.pool.submit(resolver.lookup, principal)))
+
+        for resolver, future in pending:
+            try:
+                result = future.result(timeout=max(0, start + resolver.timeout - time.monotonic()))
+
+            except TimeoutError:
+                self.counters.add('timeouts')
+                logger.warning(f'Attribute resolver {resolver.name} timed out for {principal}')
+                continue
+
+            except Exception as e:
+                self.counters.add('errors')
+                logger.warning(f'Attribute resolver {resolver.name} failed for {principal}: {str(e)}')
+                continue
+
+            self.cache.set((resolver.name, principal), result, resolver.ttl)
+            resolved.append(result)
+
+        merged = dict(attributes)
+        for result in resolved:
+            for name, value in result.items():
+                # upstream session attributes are not overridden
+                merged.setdefault(name, value)
+
+        return merged
+
+
+    def reinit(self):
+        """ Drop connections, fresh pool (e.g. in a forked worker - its threads aren't inherited) """
+
+        self.pool = ThreadPoolExecutor(RESOLVER_MAX_WORKERS, thread_name_prefix='samlidp-resolver')
+        self.counters.reinit()
+        for resolver in self.resolvers:
+            resolver.reinit()
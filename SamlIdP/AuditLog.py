@@ -0,0 +1,173 @@
+from collections import deque
+import json
+import logging as logger
+import socket
+import threading
+import time
+
+# Backpressure when the queue is full
+AUDIT_DROP = 'drop'      # count and discard the event
+AUDIT_BLOCK = 'block'    # wait for the writer to make room
+
+
+class   AuditLog:
+    """ Structured audit events, written as JSON lines by a background thread
+
+    Request threads only take a queue slot (a BoundedSemaphore of
+    queue_size - with 'drop' backpressure that never waits) and append
+    to a deque, so writing never happens on the request thread.  The
+    writer gives the slots back as it drains.  Sinks are a file path,
+    'tcp://host:port' or 'unix:///path'.
+    """
+
+    def __init__(self, sink, queue_size=10000, backpressure=AUDIT_DROP, batch_size=500, flush_interval=1.0):
+
+        assert backpressure in (AUDIT_DROP, AUDIT_BLOCK), f'Config error: unknown audit backpressure {backpressure}'
+
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = backpressure == AUDIT_BLOCK
+
+        self.queue_size = queue_size
+
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self.reinit()
+
+
+    def reinit(self):
+        """ Fresh queue and writer thread (threads don't survive fork) """
+
+        self.queue = deque()
+        self.slots = threading.BoundedSemaphore(self.queue_size)
+        self.wakeup = threading.Event()
+
+        # dropped is counted by request threads
+        self.lock = threading.Lock()
+
+        self.stream = None
+
+        writer = threading.Thread(target=self.writer, name='samlidp-audit', daemon=True)
+        writer.start()
+
+
+    @classmethod
+    def fromConfig(this, audit_config):
+        """ AuditLog from idp_config['audit_log'], None if not configured """
+
+        if not audit_config:
+            return None
+
+        return this(
+            audit_config.get('sink') or audit_config['path'],
+            queue_size=audit_config.get('queue_size', 10000),
+            backpressure=audit_config.get('backpressure', AUDIT_DROP),
+            batch_size=audit_config.get('batch_size', 500),
+            flush_interval=audit_config.get('flush_interval', 1.0),
+        )
+
+
+    def emit(self, event):
+        """ Queue an audit event (dict) """
+
+        if not self.slots.acquire(blocking=self.block):
+            with self.lock:
+                self.dropped += 1
+            return
+
+        self.queue.append(event)
+
+        if len(self.queue) >= self.batch_size:
+            self.wakeup.set()
+
+
+    def writer(self):
+        """ Drain the queue in batches """
+
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+
+            while self.queue:
+                batch = []
+                while self.queue and len(batch) < self.batch_size:
+                    batch.append(self.queue.popleft())
+                    self.slots.release()
+
+                self.write(batch)
+
+
+    def write(self, batch):
+        """ Write a batch of events as JSON lines """
+
+        data = ''.join(json.dumps(event, default=str) + '\n' for event in batch).encode('utf-8')
+
+        try:
+            if self.stream is None:
+                self.stream = self.open()
+
+            if isinstance(self.stream, socket.socket):
+                self.stream.sendall(data)
+            else:
+                self.stream.write(data)
+                self.stream.flush()
+
+            self.written += len(batch)
+
+        except Exception as e:
+            self.failed += len(batch)
+            logger.error(f'Audit log write to {self.sink} failed: {str(e)}')
+
+            # reopen on next batch
+            try:
+                self.stream.close()
+            except Exception:
+                pass
+            self.stream = None
+
+
+    def open(self):
+        """ Open the sink """
+
+        if self.sink.startswith('tcp://'):
+            host, port = self.sink[len('tcp://'):].rsplit(':', 1)
+            return socket.create_connection((host, int(port)), timeout=5)
+
+        if self.sink.startswith('unix://'):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(5)
+            sock.connect(self.sink[len('unix://'):])
+            return sock
+
+        return open(self.sink, 'ab')
+
+
+    @property
+    def counters(self):
+        return {
+            'queued': len(self.queue),
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+
+
+class   AuditTimer:
+    """ Collect named stage timings (ms) for an audit event """
+
+    def __init__(self):
+
+        self.timings = {}
+        self.last = time.perf_counter()
+
+
+    def stage(self, name):
+        """ Record time since the previous stage """
+
+        now = time.perf_counter()
+        self.timings[name] = round((now - self.last) * 1000, 3)
+        self.last = now
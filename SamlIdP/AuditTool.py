@@ -0,0 +1,251 @@
+"""
+Offline audit of issued SAMLResponses
+
+    python -m SamlIdP.AuditTool [options] archive.jsonl[.gz] ...
+
+Each archive line is either a JSON object with a 'SAMLResponse' member
+(b64 encoded, as POSTed to the SP) or a bare b64 SAMLResponse.  Every
+response is checked for:
+
+    - a valid signature and digest from one of the IdP signing keys
+    - NotOnOrAfter present, after IssueInstant and within --max-validity
+    - an Audience that is a registered SP, and a Destination in its ACS list
+
+Work is fanned out in chunks across a process pool with a bounded number
+of chunks in flight, so memory use doesn't depend on the archive size.
+Failures are written as JSON lines, followed by a summary line.
+"""
+from argparse import ArgumentParser
+from base64 import b64decode
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import timedelta
+from hashlib import sha256
+from importlib import import_module
+import gzip
+import json
+import os
+import sys
+
+from lxml import etree
+
+from .constants import *
+from .Metadata import loadSPMetadata
+from .RequestDecoder import saml_time
+from .SamlSerializer import SamlResponseSigner
+
+samlpStatusTag = '{urn:oasis:names:tc:SAML:2.0:protocol}Status'
+samlpStatusCodeTag = '{urn:oasis:names:tc:SAML:2.0:protocol}StatusCode'
+samlConditionsTag = '{urn:oasis:names:tc:SAML:2.0:assertion}Conditions'
+samlAudienceTag = '{urn:oasis:names:tc:SAML:2.0:assertion}Audience'
+
+# Slack allowed on --max-validity
+VALIDITY_SKEW = timedelta(seconds=1)
+
+# Per worker process state (set by _init_worker)
+_signers = {}
+_registry = {}
+_max_validity = None
+
+
+def _init_worker(certs, registry, max_validity):
+    """ Worker process initialization - one verifier per IdP signing cert """
+
+    global _registry, _max_validity
+
+    for cert in certs:
+        signer = SamlResponseSigner(cert)
+        _signers[signer.signer.material.fingerprint] = signer
+
+    _registry = registry
+    _max_validity = timedelta(minutes=max_validity)
+
+
+def _audit_one(saml_response):
+    """ Return failure reason for one b64 SAMLResponse, None if it passes, 'skipped' for errors """
+
+    try:
+        xmlroot = etree.XML(b64decode(saml_response), parser=etree.XMLParser(resolve_entities=False, no_network=True))
+    except Exception:
+        return 'undecodable'
+
+    status = xmlroot.find(f'./{samlpStatusTag}/{samlpStatusCodeTag}')
+    if status is None or status.get('Value') != SamlStatusSuccess:
+        # error responses are unsigned
+        return 'skipped'
+
+    x509_cert = xmlroot.findtext(f'.//{dsX509CertificateTag}')
+    if x509_cert is None:
+        return 'unsigned'
+
+    try:
+        signer = _signers.get(sha256(b64decode(x509_cert)).digest())
+    except Exception:
+        signer = None
+
+    if signer is None:
+        return 'unknown signing certificate'
+
+    # only enveloped signatures referencing the Response or Assertion count
+    if not signer.verifyTree(xmlroot):
+        return 'signature or digest mismatch'
+
+    conditions = xmlroot.find(f'./{samlAssertionTag}/{samlConditionsTag}')
+    if conditions is None or not conditions.get('NotOnOrAfter'):
+        return 'NotOnOrAfter missing'
+
+    try:
+        issued = saml_time(xmlroot.get('IssueInstant'))
+        notonorafter = saml_time(conditions.get('NotOnOrAfter'))
+    except Exception:
+        return 'invalid timestamp'
+
+    if notonorafter <= issued:
+        return 'NotOnOrAfter before IssueInstant'
+
+    # NotOnOrAfter is set from the same clock a few microseconds after IssueInstant
+    if notonorafter - issued > _max_validity + VALIDITY_SKEW:
+        return 'validity exceeds maximum'
+
+    audience = conditions.findtext(f'.//{samlAudienceTag}')
+    if audience not in _registry:
+        return 'unknown audience'
+
+    if xmlroot.get('Destination') not in _registry[audience]:
+        return 'Destination not an ACS of audience'
+
+    return None
+
+
+def _audit_chunk(chunk):
+    """ Audit a chunk of (line number, record id, b64 SAMLResponse) """
+
+    passed = skipped = 0
+    failures = []
+
+    for lineno, record_id, saml_response in chunk:
+
+        reason = _audit_one(saml_response)
+
+        if reason is None:
+            passed += 1
+        elif reason == 'skipped':
+            skipped += 1
+        else:
+            failures.append({'line': lineno, 'id': record_id, 'reason': reason})
+
+    return passed, skipped, failures
+
+
+def read_archive(path):
+    """ Stream (line number, record id, b64 SAMLResponse) from a JSONL (or gzip JSONL) archive """
+
+    opener = gzip.open if path.endswith('.gz') else open
+
+    with opener(path, 'rt') as f:
+        for lineno, line in enumerate(f, 1):
+
+            line = line.strip()
+            if not line:
+                continue
+
+            if line.startswith('{'):
+                record = json.loads(line)
+                yield lineno, record.get('id'), record.get('SAMLResponse', '')
+            else:
+                yield lineno, None, line
+
+
+def chunked(records, size):
+    """ Group records into lists of size """
+
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def audit(paths, idp_config, workers=None, chunk_size=200, max_validity=60, out=sys.stdout):
+    """ Audit archives against idp_config, write failures and return summary """
+
+    certs = []
+    if idp_config.get('x509Cert'):
+        certs.append(idp_config['x509Cert'])
+    certs.extend(key['x509Cert'] for key in idp_config.get('signing_keys', []))
+
+    registry = {}
+    for sp in idp_config.get('splist', []):
+        sp = loadSPMetadata(sp)
+        registry[sp['SPEntityId']] = sp.get('ACSList', [])
+
+    workers = workers or os.cpu_count()
+    summary = {'passed': 0, 'skipped': 0, 'failed': 0}
+    reasons = {}
+
+    def collect(done):
+        for future in done:
+            passed, skipped, failures = future.result()
+            summary['passed'] += passed
+            summary['skipped'] += skipped
+            summary['failed'] += len(failures)
+            for failure in failures:
+                reasons[failure['reason']] = reasons.get(failure['reason'], 0) + 1
+                out.write(json.dumps(failure) + '\n')
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(certs, registry, max_validity)) as pool:
+
+        pending = set()
+
+        for path in paths:
+            for chunk in chunked(read_archive(path), chunk_size):
+
+                if len(pending) >= 2 * workers:
+                    # bound work in flight - keeps memory constant
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+
+                pending.add(pool.submit(_audit_chunk, chunk))
+
+        collect(wait(pending).done)
+
+    summary['reasons'] = reasons
+    return summary
+
+
+def main(argv=None):
+
+    parser = ArgumentParser(description='Re-verify archived SAMLResponses')
+    parser.add_argument('archives', nargs='+', help='JSONL or gzipped JSONL archives')
+    parser.add_argument('--config', default='config', help='module containing idp_config (default: config)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: CPU count)')
+    parser.add_argument('--chunk-size', type=int, default=200, help='responses per work unit')
+    parser.add_argument('--max-validity', type=int, default=60, help='maximum NotOnOrAfter window in minutes')
+    parser.add_argument('--failures', default='-', help='file for failure records (default: stdout)')
+
+    args = parser.parse_args(argv)
+
+    idp_config = import_module(args.config).idp_config
+
+    out = sys.stdout if args.failures == '-' else open(args.failures, 'w')
+
+    try:
+        summary = audit(args.archives, idp_config,
+            workers=args.workers,
+            chunk_size=args.chunk_size,
+            max_validity=args.max_validity,
+            out=out,
+        )
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(json.dumps({'summary': summary}))
+
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+from collections import OrderedDict
+from hashlib import sha256
+import threading
+import time
+
+from flask import Response
+
+from .Counters import Counters
+
+
+class   _Flight:
+    """ One request being serviced, and its rendered result once done """
+
+    __slots__ = ('done', 'result', 'finished')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.finished = None
+
+
+
+class   InflightCoalescer:
+    """ Duplicate requests share the first one's rendered response
+
+    Double clicks, back-button replays and SP retries resubmit the same
+    redirect URL within milliseconds.  A duplicate arriving while the
+    first is being serviced waits for it, and one arriving up to window
+    seconds after it finished gets a copy of its response - neither
+    repeats the decode, verify and sign work.  Keys include the user's
+    session, so only the same browser session shares a response; failed
+    requests are never shared.
+    """
+
+    def __init__(self, window=2.0, wait=10.0, max_entries=10000):
+
+        self.window = window
+        self.wait = wait
+        self.max_entries = max_entries
+
+        self.flights = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.counters = Counters('serviced', 'coalesced', 'waited')
+
+
+    def reinit(self):
+        """ Forget flights and locks of the parent process """
+
+        self.flights = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters.reinit()
+
+
+    @classmethod
+    def fromConfig(this, coalesce_config):
+        """ InflightCoalescer from idp_config['coalesce'], None if not configured """
+
+        if not coalesce_config:
+            return None
+
+        return this(
+            window=coalesce_config.get('window', 2.0),
+            wait=coalesce_config.get('wait', 10.0),
+            max_entries=coalesce_config.get('max_entries', 10000),
+        )
+
+
+    @staticmethod
+    def key(request_qs, session_id):
+        return sha256(request_qs + b'\0' + session_id.encode('utf-8')).digest()
+
+
+    def _expire(self, now):
+        """ Drop finished flights older than window (lock held) """
+
+        while self.flights:
+            key, flight = next(iter(self.flights.items()))
+
+            if len(self.flights) <= self.max_entries and (flight.finished is None or flight.finished + self.window > now):
+                break
+
+            # a running flight evicted here still answers its own waiters
+            self.flights.popitem(last=False)
+
+
+    def run(self, key, service):
+        """ Response of service() - or a copy of a duplicate's """
+
+        with self.lock:
+            now = time.monotonic()
+            self._expire(now)
+
+            flight = self.flights.get(key)
+
+            if flight is None:
+                owner = True
+                flight = self.flights[key] = _Flight()
+            else:
+                owner = False
+
+        if owner:
+            self.counters.add('serviced')
+            try:
+                response = service()
+                if isinstance(response, Response) and response.status_code < 400:
+                    flight.result = (response.get_data(), response.status_code, list(response.headers.items()))
+                return response
+
+            finally:
+                flight.finished = time.monotonic()
+                flight.done.set()
+
+        if not flight.done.is_set():
+            self.counters.add('waited')
+
+        if flight.done.wait(self.wait) and flight.result is not None:
+            self.counters.add('coalesced')
+            body, status, headers = flight.result
+            return Response(body, status=status, headers=headers)
+
+        # the first request failed or is taking too long - service this one
+        self.counters.add('serviced')
+        return service()
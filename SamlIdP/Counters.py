@@ -0,0 +1,25 @@
+import threading
+
+
+class   Counters(dict):
+    """ Exported counters (/saml2/stats) - a dict of name: count
+
+    Request threads count with add(), under a lock: += on a shared dict
+    entry is a read-modify-write and loses counts between threads.
+    """
+
+    def __init__(self, *names):
+
+        super().__init__((name, 0) for name in names)
+        self.lock = threading.Lock()
+
+
+    def reinit(self):
+        """ Fresh lock (e.g. in a forked worker) - counts carry on """
+        self.lock = threading.Lock()
+
+
+    def add(self, name, count=1):
+
+        with self.lock:
+            self[name] += count
@@ -0,0 +1,241 @@
+"""
+Differential test of alternative SAMLResponse engines
+
+    python -m SamlIdP.Differential [options] package.module:engine [corpus.jsonl ...]
+
+An engine is a callable(request_qs, attributes, target, clock) returning
+the signed SAMLResponse (bytes) for a redirect binding query string and a
+dict of session attributes.  The reference engine is the production
+pipeline - RequestDecoder, AttributeReleasePolicy, ResponseEncoder and
+the IdP signer.
+
+Corpus lines are JSON objects with 'request_qs' and 'attributes' members
+(e.g. recorded traffic), and --random adds generated AuthnRequests and
+attribute sets.  Both engines get identically seeded FixedClocks, so for
+every case the exclusive c14n of their output must be identical and
+both signatures must verify.  Mismatches are written as JSON lines,
+followed by a summary line with the throughput of each engine.
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+from importlib import import_module
+from random import Random
+import json
+import sys
+import time
+
+from lxml import etree
+
+from .constants import *
+from .AttributePolicy import AttributeReleasePolicy
+from .KeySet import KeySet
+from .RequestDecoder import RequestDecoder
+from .ResponseEncoder import ResponseEncoder
+from .ResponseHandler import ResponseHandler
+from .ResponseTemplate import FixedClock
+from .SamlSerializer import SamlRequestSerializer
+
+# Request base URL of the generated requests
+DIFF_IDP_URL = 'https://idp.example.com/saml2'
+
+_nameIdFormats = (SamlNameIdTransient, SamlNameIdPersistent, SamlNameIdEmailAddress, SamlNameIdUnspecified)
+
+# awkward values - markup, entities, non-ascii and whitespace
+_values = ('alice', 'bob@example.com', 'Ōsaka', '<b>&amp;</b>', 'a "quoted" value', ' padded ', 'éè', 'x' * 300)
+
+
+class   DiffTarget:
+    """ The IdP and SP a case is answered for - stands in for SamlSPservice and IdPservice """
+
+    def __init__(self, idp_id, sp_id, acs, keyset, release_policy, sign_assertion=False, sign_response=True, nameid_attr=None):
+
+        self.idP = self
+        self.idp_id = idp_id
+        self.sp_id = sp_id
+        self.acs = (acs,)
+        self.keyset = keyset
+        self.release_policy = release_policy
+        self.sign_assertion = sign_assertion
+        self.sign_response = sign_response
+        self.authn_nameIdAttr = nameid_attr
+        self.pairwise = None
+        self.pairwise_version = None
+
+    def signResponse(self, saml_response, sign_assertion=False, sign_response=True):
+        return self.keyset.active.signSaml(saml_response, sign_assertion, sign_response)
+
+
+
+def referenceEngine(request_qs, attributes, target, clock):
+    """ The production xmltodict pipeline """
+
+    saml_request = RequestDecoder(DIFF_IDP_URL, request_qs)
+    saml_request.sp = target
+    saml_request.idP = target
+
+    resp = ResponseEncoder(saml_request, clock=clock)
+    nameid = ResponseHandler.subject_nameid(saml_request, resp.nameIdFormat, attributes)
+    resp.auth_info(attrs=target.release_policy.release(attributes), nameid=nameid)
+
+    return resp.sign()
+
+
+def randomCase(rnd):
+    """ (request_qs, attributes, sp options) for a generated AuthnRequest """
+
+    sp_id = f'urn:sp{rnd.randrange(1000)}.example.com'
+    acs = f'https://sp{rnd.randrange(1000)}.example.com/acs'
+    fmt = rnd.choice(_nameIdFormats + (None,))
+    policy = f'<samlp:NameIDPolicy Format="{fmt}" AllowCreate="true"/>' if fmt else ''
+
+    authn_request = f'<samlp:AuthnRequest xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="_{rnd.getrandbits(128):032x}" Version="2.0" IssueInstant="2000-01-01T00:00:00Z" Destination="{DIFF_IDP_URL}" AssertionConsumerServiceURL="{acs}"><saml:Issuer>{sp_id}</saml:Issuer>{policy}</samlp:AuthnRequest>'
+
+    request_qs = SamlRequestSerializer().serializeSamlRequest(authn_request.encode('utf-8'), relayState=str(rnd.getrandbits(32)), sign=False)
+
+    attributes = {}
+    for n in range(rnd.randrange(1, 12)):
+        values = [rnd.choice(_values) for _ in range(rnd.randrange(1, 4))]
+        attributes[f'attr{n}'] = values if len(values) > 1 else values[0]
+    attributes['uid'] = rnd.choice(_values)
+
+    return {
+        'request_qs': request_qs,
+        'attributes': attributes,
+        'sign_assertion': rnd.random() < 0.5,
+        'sign_response': True,
+        'nameid_attr': rnd.choice((None, 'uid')),
+    }
+
+
+def readCorpus(paths, random_cases, seed):
+    """ Stream cases from corpus files, then generated ones """
+
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    rnd = Random(seed)
+    for _ in range(random_cases):
+        yield randomCase(rnd)
+
+
+def canonical(saml_response):
+    """ Exclusive c14n of a SAMLResponse """
+
+    xmlroot = etree.XML(saml_response, parser=etree.XMLParser(resolve_entities=False, no_network=True))
+    return etree.tostring(xmlroot, method='c14n', exclusive=True)
+
+
+def compare(engines, cases, idp_config, out=sys.stdout):
+    """ Run every case through every engine, write mismatches and return summary """
+
+    keyset = KeySet.fromConfig(idp_config)
+    verifier = keyset.active
+    policies = {}
+
+    summary = {'cases': 0, 'mismatched': 0, 'unverified': 0, 'errors': 0}
+    elapsed = {name: 0.0 for name in engines}
+
+    for index, case in enumerate(cases):
+
+        attributes = case['attributes']
+        names = tuple(sorted(attributes))
+        policy = policies.get(names) or policies.setdefault(names, AttributeReleasePolicy(list(names)))
+
+        saml_request = RequestDecoder(DIFF_IDP_URL, case['request_qs'].encode('utf-8'))
+
+        target = DiffTarget(
+            idp_config['entityId'], saml_request.issuer, saml_request.acs, keyset, policy,
+            sign_assertion=case.get('sign_assertion', False),
+            sign_response=case.get('sign_response', True),
+            nameid_attr=case.get('nameid_attr'),
+        )
+
+        outputs = {}
+        for name, engine in engines.items():
+
+            clock = FixedClock(datetime(2000, 1, 1), seed=index)
+
+            start = time.perf_counter()
+            try:
+                outputs[name] = engine(case['request_qs'].encode('utf-8'), attributes, target, clock)
+            except Exception as e:
+                outputs[name] = e
+            elapsed[name] += time.perf_counter() - start
+
+        summary['cases'] += 1
+        failure = None
+        canonicals = set()
+
+        for name, output in outputs.items():
+
+            if isinstance(output, Exception):
+                failure = f'{name} error: {str(output)}'
+                summary['errors'] += 1
+                break
+
+            if not verifier.verifySignedSamlResponse(output):
+                failure = f'{name} signature does not verify'
+                summary['unverified'] += 1
+                break
+
+            canonicals.add(canonical(output))
+
+        if failure is None and len(canonicals) > 1:
+            failure = 'canonical output differs'
+            summary['mismatched'] += 1
+
+        if failure is not None:
+            out.write(json.dumps({'case': index, 'reason': failure, 'request_qs': case['request_qs']}) + '\n')
+
+    summary['responses_per_second'] = {
+        name: round(summary['cases'] / seconds, 1) if seconds else None
+            for name, seconds in elapsed.items()
+    }
+    return summary
+
+
+def loadEngine(spec):
+    """ callable from 'package.module:name' """
+
+    module, _, name = spec.partition(':')
+    return getattr(import_module(module), name or 'engine')
+
+
+def main(argv=None):
+
+    parser = ArgumentParser(description='Compare a candidate SAMLResponse engine with the reference pipeline')
+    parser.add_argument('candidate', help='candidate engine as package.module:callable')
+    parser.add_argument('corpus', nargs='*', help='JSONL files of recorded cases')
+    parser.add_argument('--config', default='config', help='module containing idp_config (default: config)')
+    parser.add_argument('--random', type=int, default=1000, help='generated cases to add (default: 1000)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for generated cases')
+    parser.add_argument('--failures', default='-', help='file for mismatch records (default: stdout)')
+
+    args = parser.parse_args(argv)
+
+    idp_config = import_module(args.config).idp_config
+
+    engines = {
+        'reference': referenceEngine,
+        'candidate': loadEngine(args.candidate),
+    }
+
+    out = sys.stdout if args.failures == '-' else open(args.failures, 'w')
+
+    try:
+        summary = compare(engines, readCorpus(args.corpus, args.random, args.seed), idp_config, out=out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print(json.dumps({'summary': summary}))
+
+    failed = summary['mismatched'] + summary['unverified'] + summary['errors']
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
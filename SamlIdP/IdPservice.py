@@ -1,13 +1,29 @@
 import logging as logger
 
-from .SPservice import SamlSPservice
+from flask import session
+
+from .SPservice import SamlSPservice, allServiceProviders
 from .ResponseHandler import ResponseHandler
-from .SamlSerializer import SamlResponseSigner
+from .KeySet import KeySet
+from .ArtifactBinding import ArtifactResolver
+from .AuditLog import AuditLog
+from .StateBackend import createStateBackend
+from .SessionRegistry import SessionRegistry
+from .Admission import AdmissionControl
+from .StatelessToken import PendingRequestCodec
+from .AttributeResolver import AttributeResolvers
+from .PairwiseId import PairwiseIdGenerator
+from .Coalescer import InflightCoalescer
+from .IdpMetaEncoder import encodeIdPMetaData
+from .SingleLogout import SingleLogout
+
+# IdP entity ID -> IdPservice (tenants served by this process)
+allIdentityProviders = {}
 
 class IdPservice:
     """ SAML Identity Provider definition """
 
-    def __init__(self, auth, idp_config):
+    def __init__(self, auth, idp_config, slo_transport=None):
 
         self.auth = auth
 
@@ -15,20 +31,68 @@ class IdPservice:
         self.responseHandler = ResponseHandler(auth)
 
         self.idp_id = idp_config['entityId']
-        self.cert = idp_config['x509Cert']
-        self.key = idp_config['priv_key']
-        self.passwd = idp_config.get('priv_password')
         self.destination = idp_config.get('destination')
 
         
         assert self.idp_id, 'Config error: missing IdP Entity Id'
-        assert self.cert, 'Config error: IdP x509 certificate missing'
-        assert self.key, 'Config error: IdP siging key missing'
+        assert self.idp_id not in allIdentityProviders, f'Config error: ({self.idp_id}) IdP instance already defined'
+        assert idp_config.get('x509Cert') or idp_config.get('signing_keys'), 'Config error: IdP x509 certificate missing'
+        assert idp_config.get('priv_key') or idp_config.get('signing_keys'), 'Config error: IdP siging key missing'
         
-        self.signer = SamlResponseSigner(self.cert, self.key, self.passwd)
+        # Signing keys (next, active, retiring) - the active one can be switched at runtime
+        self.keyset = KeySet.fromConfig(idp_config)
         
         self.permit_forceAuthn = idp_config.get('permit_forceAuthn',True)
 
+        # HTTP-Artifact binding: signed responses wait here for the SP to resolve them
+        self.artifacts = ArtifactResolver(self, store=idp_config.get('artifact_store'))
+
+        # Structured audit events of issued responses (None when not configured)
+        self.auditLog = AuditLog.fromConfig(idp_config.get('audit_log'))
+
+        # Cluster or host-wide replay IDs and pending logins (None - use the session)
+        self.stateStore = createStateBackend(idp_config)
+        if self.stateStore is not None:
+            ResponseHandler.stateStores.append(self.stateStore)
+
+        # Stateless login - pending requests carried in an encrypted token (None - stored)
+        self.pendingCodec = PendingRequestCodec.fromConfig(self.idp_id, idp_config.get('stateless'))
+        if self.pendingCodec is not None:
+            ResponseHandler.pendingCodecs.append((self.pendingCodec, self.stateStore))
+
+        # Directory and database attributes added per response (None - session only)
+        self.resolvers = AttributeResolvers.fromConfig(idp_config)
+
+        # Persistent NameIDs derived per SP from a keyed HMAC (None - from NameIdAttr)
+        self.pairwise = PairwiseIdGenerator.fromConfig(idp_config.get('pairwise_ids'))
+
+        # Duplicate in-flight requests share one response (None - every request serviced)
+        self.coalescer = InflightCoalescer.fromConfig(idp_config.get('coalesce'))
+
+        # Rate limits and in-flight signing limit
+        self.admission = AdmissionControl(idp_config)
+
+        # Issued SSO sessions (user -> SPs -> SessionIndex)
+        self.sessions = SessionRegistry()
+
+        # Back-channel logout - slo_transport(url, soap_request, timeout) replaces the SOAP POST
+        self.singleLogout = SingleLogout(self, slo_transport)
+
+        # Session attribute identifying the authenticated user
+        self.principal_attr = idp_config.get('principal_attr', 'uid')
+
+        # Encoded metadata - rebuilt only when the published keys change
+        self.metadata_cache = {}
+
+        # Tenants sharing one primary authentication (and so one Flask session) don't
+        # trust each other's logins - each records its own in the session
+        sharing = [idP for idP in allIdentityProviders.values() if idP.auth is auth]
+        self.scoped_auth = bool(sharing)
+        for idP in sharing:
+            idP.scoped_auth = True
+
+        allIdentityProviders[self.idp_id] = self
+
         # Register defined service providers
         for sp in idp_config['splist']:
             try:
@@ -38,17 +102,94 @@ class IdPservice:
                 logger.error(str(e) + ' - SKIPPING THIS SERVICE PROVIDER')
 
 
+    @property
+    def signer(self):
+        # no lock - the key set swaps this reference atomically
+        return self.keyset.active
+
+    @property
+    def cert(self):
+        return self.keyset.active_cert
+
+    def activateKey(self, fingerprint):
+        """ Admin: switch signing to the key with this (hex SHA-256) fingerprint """
+        return self.keyset.activate(fingerprint)
+
+    def rolloverKeys(self):
+        """ Admin: promote next key, retire the active key """
+        return self.keyset.rollover()
+
+    def metadata(self, ssologin, artifact_url=None):
+        """ IdP metadata XML (cached per endpoint URLs and published key set) """
+
+        cache_key = (ssologin, artifact_url)
+        keys, metaxml = self.metadata_cache.get(cache_key, (None, None))
+
+        if keys is not self.keyset.keys:
+            keys = self.keyset.keys
+            metaxml = encodeIdPMetaData(self, ssologin=ssologin, artifact_url=artifact_url)
+            self.metadata_cache[cache_key] = (keys, metaxml)
+
+        return metaxml
+
+    def reinit(self):
+        """ Rebuild everything that isn't fork safe (crypto handles, parsers, threads) """
+
+        self.keyset.reinit()
+        self.artifacts.reinit()
+        self.admission.reinit()
+
+        if self.coalescer is not None:
+            self.coalescer.reinit()
+
+        if self.auditLog:
+            self.auditLog.reinit()
+
+        if self.stateStore is not None:
+            self.stateStore.reinit()
+
+        if self.resolvers is not None:
+            self.resolvers.reinit()
+
+        for sp in allServiceProviders.values():
+            if sp.idP is self:
+                sp.reinit()
+
+    @classmethod
+    def getIdP(this, idp_id):
+        """ Find IdP (tenant) for an entity id """
+        return allIdentityProviders.get(idp_id)
+
     @property
     def is_authenticated(self):
+        if self.scoped_auth and self.idp_id not in session.get('saml_idps', ()):
+            return False
         return self.auth.is_authenticated
+
+    def authenticated(self):
+        """ Record primary authentication completed for this tenant """
+        if self.scoped_auth and self.auth.is_authenticated and self.idp_id not in session.get('saml_idps', ()):
+            session['saml_idps'] = [*session.get('saml_idps', ()), self.idp_id]
+
+    def principal(self, attributes):
+        """ The user identifier from session attributes, or None """
+
+        value = attributes.get(self.principal_attr)
+        if isinstance(value, (list, tuple)):
+            value = value[0] if value else None
+
+        return value
     
     def signResponse(self,saml_response, sign_assertion=False, sign_response=True):
-        return self.signer.signSaml(saml_response, sign_assertion, sign_response)
+        with self.admission.signing():
+            return self.signer.signSaml(saml_response, sign_assertion, sign_response)
 
     def verifyResponse(self,saml_response):
         return self.signer.verifySamlResponse(saml_response)
 
     def unauthenticate(self):
+        # the next login may be someone else's - at every tenant
+        session.pop('saml_idps', None)
         return self.auth.unauthenticate()
 
     def initiate_login(self, *args, **kwargs):
@@ -1,15 +1,24 @@
 from copy import deepcopy
 
 import xmltodict
-from .SamlSerializer import serialize_cert
+from .KeyMaterial import keyRegistry
 
-def encodeIdPMetaData(idp, ssologin):
+def encodeIdPMetaData(idp, ssologin, artifact_url=None):
 
     idpmeta = deepcopy(_template_IdPMetaData)
     idpmeta['md:EntityDescriptor']['@entityID'] = idp.idp_id
+    # publish every key in the set (next, active and retiring)
     kdesc = idpmeta['md:EntityDescriptor']['md:IDPSSODescriptor']['md:KeyDescriptor']
-    kdesc[0]['ds:KeyInfo']['ds:X509Data']['ds:X509Certificate'] = serialize_cert(idp.cert)
+    ktemplate = kdesc.pop()
+    for key in idp.keyset.keys:
+        kd = deepcopy(ktemplate)
+        kd['ds:KeyInfo']['ds:X509Data']['ds:X509Certificate'] = keyRegistry.load(key.cert).b64
+        kdesc.append(kd)
     idpmeta['md:EntityDescriptor']['md:IDPSSODescriptor']['md:SingleSignOnService']['@Location'] = ssologin
+    if artifact_url:
+        idpmeta['md:EntityDescriptor']['md:IDPSSODescriptor']['md:ArtifactResolutionService']['@Location'] = artifact_url
+    else:
+        del idpmeta['md:EntityDescriptor']['md:IDPSSODescriptor']['md:ArtifactResolutionService']
 
     return xmltodict.unparse(idpmeta)
 
@@ -32,6 +41,12 @@ _template_IdPMetaData = {
                     }
                 }
             ],
+            'md:ArtifactResolutionService': {
+                '@Binding': 'urn:oasis:names:tc:SAML:2.0:bindings:SOAP',
+                '@Location': '_IdP Artifact Resolution URL **',
+                '@index': '0',
+                '@isDefault': 'true'
+            },
             'md:NameIDFormat': 'urn:oasis:names:tc:SAML:2.0:nameid-format:transient',
             'md:SingleSignOnService': {
                 '@Binding': 'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect',
@@ -0,0 +1,89 @@
+from base64 import b64encode, b64decode
+from hashlib import sha256
+import threading
+
+from cryptography.hazmat.primitives import serialization
+from cryptography import x509
+
+
+class   KeyMaterial:
+    """ One parsed x509 certificate with its precomputed forms """
+
+    def __init__(self, cert):
+
+        self.cert = cert
+        self.public_key = cert.public_key()
+
+        self.der = cert.public_bytes(serialization.Encoding.DER)
+        self.fingerprint = sha256(self.der).digest()
+
+        # PEM body without headers or new lines (i.e. <ds:X509Certificate> text)
+        self.b64 = b64encode(self.der).decode()
+
+
+    def matches(self, cert_b64):
+        """ True if b64 (<ds:X509Certificate>) cert text is this certificate """
+
+        if cert_b64 == self.b64:
+            return True
+
+        if type(cert_b64) is str:
+            cert_b64 = cert_b64.encode('utf-8')
+
+        if b'-----' in cert_b64:
+            # PEM headers would otherwise decode as certificate data
+            cert_b64 = b''.join(line for line in cert_b64.splitlines() if b'-----' not in line)
+
+        try:
+            # non-alphabet characters (white space) are discarded
+            return sha256(b64decode(cert_b64)).digest() == self.fingerprint
+        except Exception:
+            return False
+
+
+
+class   KeyRegistry:
+    """ Certificates shared by fingerprint - one KeyMaterial per unique cert """
+
+    def __init__(self):
+
+        self.by_fingerprint = {}
+        self.by_pem = {}
+        self.lock = threading.Lock()
+
+
+    def load(self, cert):
+        """ Return the KeyMaterial for a PEM certificate (bytes or str) """
+
+        if type(cert) is str:
+            cert = cert.encode('utf-8')
+
+        material = self.by_pem.get(cert)
+        if material is not None:
+            return material
+
+        parsed = x509.load_pem_x509_certificate(cert)
+        fingerprint = sha256(parsed.public_bytes(serialization.Encoding.DER)).digest()
+
+        with self.lock:
+            material = self.by_fingerprint.get(fingerprint)
+            if material is None:
+                material = self.by_fingerprint[fingerprint] = KeyMaterial(parsed)
+            self.by_pem[cert] = material
+
+        return material
+
+
+    def reinit(self):
+        """ Rebuild public key handles (e.g. in a forked worker) """
+
+        for material in self.by_fingerprint.values():
+            material.cert = x509.load_der_x509_certificate(material.der)
+            material.public_key = material.cert.public_key()
+
+
+    def __len__(self):
+        return len(self.by_fingerprint)
+
+
+keyRegistry = KeyRegistry()
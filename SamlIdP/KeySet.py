@@ -0,0 +1,182 @@
+import json
+import logging as logger
+import os
+import threading
+import time
+
+from .KeyMaterial import keyRegistry
+from .SamlSerializer import SamlResponseSigner
+
+# Signing key states
+KEY_NEXT = 'next'           # published in metadata, not yet signing
+KEY_ACTIVE = 'active'       # published and signing
+KEY_RETIRING = 'retiring'   # published until SPs have moved on, no longer signing
+
+KEY_STATES = (KEY_NEXT, KEY_ACTIVE, KEY_RETIRING)
+
+
+class   SigningKey:
+    """ An IdP signing certificate and key in a KeySet """
+
+    def __init__(self, cert, key, password=None, state=KEY_NEXT):
+
+        assert state in KEY_STATES, f'Config error: unknown key state {state}'
+
+        self.cert = cert
+        self.state = state
+        self.fingerprint = keyRegistry.load(cert).fingerprint.hex()
+        self.signer = SamlResponseSigner(cert, key, password)
+
+
+    def withState(self, state):
+        """ Copy of this key in a new state (keys are never changed in place) """
+
+        copy = object.__new__(SigningKey)
+        copy.__dict__.update(self.__dict__)
+        copy.state = state
+        return copy
+
+
+
+class   KeySet:
+    """ IdP signing keys with runtime rollover
+
+    The active signer is swapped by a single attribute assignment, so the
+    signing path reads it without locking.  Only writers take the lock.
+    """
+
+    def __init__(self, keys, state_file=None, poll_interval=10):
+
+        keys = tuple(keys)
+
+        active = [k for k in keys if k.state == KEY_ACTIVE]
+        assert len(active) == 1, 'Config error: exactly one IdP signing key must be active'
+
+        self.lock = threading.Lock()
+        self.keys = keys
+        self.active = active[0].signer
+        self.active_cert = active[0].cert
+
+        self.state_file = state_file
+        self.state_mtime = None
+        self.poll_interval = poll_interval
+
+        if state_file:
+            self.checkStateFile()
+            self.startWatcher()
+
+
+    def startWatcher(self):
+        """ Start background watch of the state file """
+
+        watcher = threading.Thread(target=self.watchStateFile, args=(self.poll_interval,), daemon=True)
+        watcher.start()
+
+
+    def reinit(self):
+        """ Rebuild signers and restart the watcher (threads don't survive fork) """
+
+        self.lock = threading.Lock()
+
+        for key in self.keys:
+            key.signer.reinit()
+
+        if self.state_file:
+            self.startWatcher()
+
+
+    @classmethod
+    def fromConfig(this, idp_config):
+        """ Build KeySet from idp_config (x509Cert/priv_key and/or signing_keys) """
+
+        keys = []
+
+        if idp_config.get('priv_key'):
+            keys.append(SigningKey(
+                idp_config['x509Cert'],
+                idp_config['priv_key'],
+                idp_config.get('priv_password'),
+                state=KEY_ACTIVE,
+            ))
+
+        for key in idp_config.get('signing_keys', []):
+            keys.append(SigningKey(
+                key['x509Cert'],
+                key['priv_key'],
+                key.get('priv_password'),
+                state=key.get('state', KEY_NEXT),
+            ))
+
+        return this(keys, state_file=idp_config.get('key_state_file'))
+
+
+    def activate(self, fingerprint):
+        """ Make the key with (hex SHA-256) fingerprint active, previous active key retires """
+
+        with self.lock:
+            match = [k for k in self.keys if k.fingerprint == fingerprint]
+
+            if not match:
+                raise Exception(f'No IdP signing key with fingerprint {fingerprint}')
+
+            if match[0].state == KEY_ACTIVE:
+                return
+
+            keys = []
+            for key in self.keys:
+                if key.fingerprint == fingerprint:
+                    key = key.withState(KEY_ACTIVE)
+                    newkey = key
+                elif key.state == KEY_ACTIVE:
+                    key = key.withState(KEY_RETIRING)
+                keys.append(key)
+
+            # publish the new key set before switching signers
+            self.keys = tuple(keys)
+            self.active_cert = newkey.cert
+            self.active = newkey.signer
+
+        logger.info(f'IdP signing key {fingerprint} is now active')
+
+
+    def rollover(self):
+        """ Promote the next key to active, retire the active key, drop retired keys """
+
+        nextkeys = [k for k in self.keys if k.state == KEY_NEXT]
+
+        if not nextkeys:
+            raise Exception('No next IdP signing key to roll over to')
+
+        with self.lock:
+            self.keys = tuple(k for k in self.keys if k.state != KEY_RETIRING)
+
+        self.activate(nextkeys[0].fingerprint)
+
+
+    def checkStateFile(self):
+        """ Activate the key named in the state file if it has changed """
+
+        try:
+            mtime = os.stat(self.state_file).st_mtime
+        except OSError:
+            return
+
+        if mtime == self.state_mtime:
+            return
+
+        self.state_mtime = mtime
+
+        try:
+            with open(self.state_file) as f:
+                self.activate(json.load(f)['active'])
+
+        except Exception as e:
+            logger.error(f'IdP key state file {self.state_file}: {str(e)}')
+
+
+    def watchStateFile(self, poll_interval):
+        """ Background watch of the key state file """
+
+        while True:
+            time.sleep(poll_interval)
+            self.checkStateFile()
@@ -2,7 +2,7 @@ import logging as logger
 
 import xmltodict
 
-from .constants import SamlNS
+from .constants import SamlNS, bindSOAP
 
 HTTP_Redirect = 'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Redirect'
 HTTP_POST = 'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST'
@@ -130,6 +130,7 @@ def loadSPMetadata(sp_config):
 
     ssolist = []
     slolist = []
+    soaplist = []
     cert = None
 
     root = xmltodict.parse(
@@ -176,6 +177,8 @@ def loadSPMetadata(sp_config):
         for slo in slos:
             if slo['@Binding'] == HTTP_Redirect:
                 slolist.append(slo['@Location'])
+            elif slo['@Binding'] == bindSOAP:
+                soaplist.append(slo['@Location'])
 
 
     if 'md:AssertionConsumerService' in spsso:
@@ -192,6 +195,7 @@ def loadSPMetadata(sp_config):
 
     sp_meta['SPEntityId'] = sp_id
     sp_meta['ACSList'] = ssolist
+    sp_meta['SLOList'] = soaplist
     sp_meta['sp_cert'] = cert
     sp_meta['NameIdFmt'] = nameid_fmt
     sp_meta['AuthnRequestsSigned'] = authn_signed
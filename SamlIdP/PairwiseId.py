@@ -0,0 +1,152 @@
+"""
+Pairwise persistent NameIDs
+
+    python -m SamlIdP.PairwiseId [options] --sp SP_ENTITY_ID principals.txt ...
+
+A persistent NameID is HMAC-SHA256(key, SP entity ID, principal), so the
+same user always gets the same opaque ID at an SP, different SPs can't
+correlate their IDs, and nothing is stored.  Keys are versioned: an SP
+keeps the key version it was provisioned with ('PairwiseKeyVersion' in
+its config) while new SPs get the current one.
+
+The command line exports the IDs of a list of principals (one per line)
+for an SP, as CSV lines of principal,nameid.
+"""
+from argparse import ArgumentParser
+from base64 import urlsafe_b64encode
+from importlib import import_module
+import hashlib
+import hmac
+import sys
+
+from .Metadata import loadSPMetadata
+
+
+class   PairwiseIdGenerator:
+    """ Persistent NameIDs from a keyed HMAC - no storage, no round trip
+
+        idp_config['pairwise_ids'] = {
+            'keys': {1: b'...32 or more secret bytes...', 2: ...},
+            'current': 2,           # version for SPs not pinned to one (default: the highest number)
+            'attribute': 'uid',     # session attribute identifying the user
+        }
+    """
+
+    def __init__(self, keys, current=None, attribute='uid'):
+
+        assert keys, 'Config error: pairwise_ids needs at least one key'
+
+        self.keys = {}
+        for version, secret in keys.items():
+            secret = secret if type(secret) is bytes else secret.encode('utf-8')
+            assert len(secret) >= 32, f'Config error: pairwise key {version} must be at least 32 bytes'
+            self.keys[str(version)] = secret
+
+        if current is None:
+            assert all(str(version).isdigit() for version in keys), 'Config error: pairwise_ids needs current unless key versions are numbers'
+            current = max(keys, key=int)
+
+        self.current = str(current)
+        assert self.current in self.keys, f'Config error: current pairwise key {self.current} is not defined'
+
+        self.attribute = attribute
+
+
+    @classmethod
+    def fromConfig(this, pairwise_config):
+        """ PairwiseIdGenerator from idp_config['pairwise_ids'], None if not configured """
+
+        if not pairwise_config:
+            return None
+
+        return this(
+            pairwise_config['keys'],
+            current=pairwise_config.get('current'),
+            attribute=pairwise_config.get('attribute', 'uid'),
+        )
+
+
+    def hasVersion(self, version):
+        return str(version) in self.keys
+
+
+    def nameId(self, sp_id, principal, version=None):
+        """ Persistent NameID of principal at SP sp_id """
+
+        version = str(version) if version is not None else self.current
+        if version not in self.keys:
+            raise KeyError(f'Pairwise key version {version} is not defined')
+
+        key = self.keys[version]
+
+        mac = hmac.new(key, sp_id.encode('utf-8') + b'\0' + principal.encode('utf-8'), hashlib.sha256)
+
+        return urlsafe_b64encode(mac.digest()).decode().rstrip('=')
+
+
+    def principal(self, attributes):
+        """ The user identifier from session attributes, or None """
+
+        value = attributes.get(self.attribute)
+        if isinstance(value, (list, tuple)):
+            value = value[0] if value else None
+
+        return value
+
+
+
+def export(generator, sp_id, principals, version=None, out=sys.stdout):
+    """ Write principal,nameid CSV lines, return the count """
+
+    count = 0
+    for principal in principals:
+
+        principal = principal.strip()
+        if not principal:
+            continue
+
+        out.write(f'{principal},{generator.nameId(sp_id, principal, version)}\n')
+        count += 1
+
+    return count
+
+
+def main(argv=None):
+
+    parser = ArgumentParser(description='Export pairwise persistent NameIDs for SP provisioning')
+    parser.add_argument('principals', nargs='*', help='files of principals, one per line (default: stdin)')
+    parser.add_argument('--sp', required=True, help='SP entity ID')
+    parser.add_argument('--version', default=None, help='key version (default: the SP\'s, else current)')
+    parser.add_argument('--config', default='config', help='module containing idp_config (default: config)')
+
+    args = parser.parse_args(argv)
+
+    idp_config = import_module(args.config).idp_config
+    generator = PairwiseIdGenerator.fromConfig(idp_config.get('pairwise_ids'))
+
+    if generator is None:
+        print('pairwise_ids is not configured', file=sys.stderr)
+        return 1
+
+    version = args.version
+    if version is None:
+        for sp in idp_config.get('splist', []):
+            sp = loadSPMetadata(sp)
+            if sp.get('SPEntityId') == args.sp:
+                version = sp.get('PairwiseKeyVersion')
+
+    count = 0
+    for path in args.principals or ['-']:
+        if path == '-':
+            count += export(generator, args.sp, sys.stdin, version)
+        else:
+            with open(path) as f:
+                count += export(generator, args.sp, f, version)
+
+    print(f'{count} NameIDs exported', file=sys.stderr)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,75 @@
+"""
+Pre-fork preload lifecycle (gunicorn --preload)
+
+In the master, after the app has been imported:
+
+    preload(app)    - build immutable state (templates, and metadata when
+                      the external host is configured), then gc.freeze()
+                      it so the workers share those pages copy-on-write
+
+In each worker, straight after the fork:
+
+    post_fork()     - rebuild what isn't fork safe: crypto handles, lxml
+                      parsers, sqlite connections, background threads and
+                      thread pools (Single Logout, attribute resolvers)
+
+Each worker warms up again (its own self-test cycle) on its first
+/saml2/ready check - until then it reports not ready.
+
+See gunicorn_conf_sample.py for the hooks.
+"""
+import gc
+import logging as logger
+
+from .IdPservice import allIdentityProviders
+from .KeyMaterial import keyRegistry
+from .ResponseHandler import ResponseHandler
+from .SamlIdP import SamlIdP
+from .SingleLogout import reinitPool
+
+
+def unique_memory():
+    """ This process' unique set size (private pages) in kB, None if unavailable """
+
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            return sum(
+                int(line.split()[1]) for line in f
+                if line.startswith(('Private_Clean:', 'Private_Dirty:'))
+            )
+    except OSError:
+        return None
+
+
+def preload(app):
+    """ Build shared immutable state in the master process and freeze it """
+
+    # compile the POST-REDIRECT template once, for every worker
+    with app.app_context():
+        app.jinja_env.get_template(ResponseHandler.post_redir_template)
+
+    # encoded metadata - unless its URLs are only known from a request's Host
+    idps = [blueprint for blueprint in app.blueprints.values() if isinstance(blueprint, SamlIdP)]
+    prebuilt = sum(1 for blueprint in idps if blueprint.prebuildMetadata(app))
+
+    if prebuilt < len(idps):
+        logger.info(f'Metadata of {len(idps) - prebuilt} IdP(s) is built per worker - set SERVER_NAME or host to preload it')
+
+    gc.collect()
+    gc.freeze()
+
+    logger.info(f'Preloaded {len(allIdentityProviders)} IdP(s), {len(keyRegistry)} certificate(s), metadata of {prebuilt}, {gc.get_freeze_count()} frozen objects; master USS {unique_memory()} kB')
+
+
+def post_fork():
+    """ Rebuild per-worker state that must not be shared across fork """
+
+    before = unique_memory()
+
+    keyRegistry.reinit()
+    reinitPool()
+
+    for idP in allIdentityProviders.values():
+        idP.reinit()
+
+    logger.info(f'Worker reinitialized: USS {before} kB after fork, {unique_memory()} kB after reinit')
@@ -0,0 +1,101 @@
+"""
+Memory benchmark of the Service Provider registry
+
+    python -m SamlIdP.RegistryBench [options]
+
+Registers generated SPs with a stand-in IdP - distinct entity IDs and
+ACS URLs, a handful of shared attribute release rules, and optionally a
+share of them with a signing certificate - and reports the memory the
+registry grew by (traced by tracemalloc) per SP.  One JSON line is
+written for each count, e.g. the default 1k, 10k and 50k SPs.
+"""
+from argparse import ArgumentParser
+from types import SimpleNamespace
+import json
+import sys
+import time
+import tracemalloc
+
+from .SPservice import SamlSPservice
+
+# Release rules the generated SPs are spread over
+_authAttrs = (
+    ['uid'],
+    ['uid', 'mail'],
+    ['uid', 'givenName', 'surname', 'mail'],
+    ['uid', 'groups', 'eduPersonAffiliation'],
+)
+
+
+def spConfig(index, cert=None):
+    """ Configuration of generated SP number index """
+
+    config = {
+        'SPEntityId': f'https://sp{index}.example.com/shibboleth',
+        'ACSList': [f'https://sp{index}.example.com/Shibboleth.sso/SAML2/POST'],
+        'AuthAttrs': _authAttrs[index % len(_authAttrs)],
+    }
+
+    if cert is not None:
+        config['sp_cert'] = cert
+
+    return config
+
+
+def measure(count, idp_id='urn:registrybench.idp', cert=None, signed=0.0):
+    """ Register count SPs, return a summary of the memory they take """
+
+    idP = SimpleNamespace(idp_id=idp_id)
+    signed_every = round(1 / signed) if cert is not None and signed else 0
+
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+
+        # configs are built inside the trace - the strings an SP keeps count against it
+        sps = [
+            SamlSPservice(idP=idP, sp_config=spConfig(n, cert if signed_every and n % signed_every == 0 else None))
+                for n in range(count)
+        ]
+
+        elapsed = time.perf_counter() - start
+        used = tracemalloc.get_traced_memory()[0] - before
+
+    finally:
+        tracemalloc.stop()
+
+    for sp in sps:
+        sp.unregister()
+
+    return {
+        'sps': count,
+        'signed': sum(1 for sp in sps if sp.sp_cert is not None),
+        'bytes': used,
+        'bytes_per_sp': round(used / count) if count else None,
+        'seconds': round(elapsed, 3),
+    }
+
+
+def main(argv=None):
+
+    parser = ArgumentParser(description='Measure SP registry memory per Service Provider')
+    parser.add_argument('--counts', type=int, nargs='+', default=[1000, 10000, 50000], help='SP counts to measure (default: 1000 10000 50000)')
+    parser.add_argument('--cert', default=None, help='PEM certificate for signing SPs (default: none)')
+    parser.add_argument('--signed', type=float, default=0.1, help='share of SPs given --cert (default: 0.1)')
+
+    args = parser.parse_args(argv)
+
+    cert = None
+    if args.cert:
+        with open(args.cert, 'rb') as f:
+            cert = f.read()
+
+    for count in args.counts:
+        print(json.dumps(measure(count, cert=cert, signed=args.signed)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
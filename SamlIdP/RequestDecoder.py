@@ -1,4 +1,6 @@
 from datetime import datetime, timedelta
+from hashlib import sha256
+from secrets import token_hex
 import json
 
 from flask import current_app
@@ -24,10 +26,31 @@ def saml_time(timestring):
 
 
 
+def parseRequest(saml_req_xml):
+    """ AuthnRequest XML as a dict """
+
+    return xmltodict.parse(
+        saml_req_xml,
+        process_namespaces=True, 
+        namespaces=SamlNS
+    )
+
+
+# Attributes that may change after decoding - frozen alongside the query string
+_mutable = ('@ForceAuthn', '@Consent')
+
+
+# Requests are accepted +/- 5 minutes - remember IDs long enough to cover that
+REPLAY_WINDOW = 600
+
+
 class RequestDecoder:
     """ Decode SAMLRequest, service the request """
 
-    def __init__(self, request_base, request_qs):
+    # Request IDs seen before are rejected (when the IdP has a state store)
+    checkReplay = True
+
+    def __init__(self, request_base, request_qs, idP=None):
 
         self.request_base = request_base
         self.request_qs = request_qs.decode()
@@ -35,14 +58,16 @@ class RequestDecoder:
         # deserialze query string without signing verification
         self.saml_req_xml, self.relayState = SamlRequestSerializer.deserializeSamlRequest(request_qs=self.request_qs)
         
-        self.root = xmltodict.parse(
-            self.saml_req_xml,
-            process_namespaces=True, 
-            namespaces=SamlNS
-        )
+        self.root = parseRequest(self.saml_req_xml)
 
         self.request = self.root['samlp:AuthnRequest']
+
+        # Only IdP-initiated requests are unsolicited
+        self.unsolicited = False
         
+        # The IdP (tenant) the request was sent to
+        self.tenant_id = idP.idp_id if idP else None
+
         # Can't set these until we'ver verified any query string signature
         self.sp = None
         self.idP = None
@@ -55,14 +80,23 @@ class RequestDecoder:
     def freeze(self):
         """ Return state as JSON string """
 
-        return json.dumps({
+        frozen = {
             'responseStatus': self.responseStatus,
             'responseStatusMessage': self.responseStatusMessage,
             'relayState': self.relayState,
-            'root': self.root,
-            'request_qs': self.request_qs,
             'request_base': self.request_base,
-        })
+            'unsolicited': self.unsolicited,
+            'idp_id': self.idP.idp_id,
+        }
+
+        if self.request_qs:
+            # rebuilt from the query string on thaw - only what can change since is kept
+            frozen['request_qs'] = self.request_qs
+            frozen['changed'] = {name: self.request[name] for name in _mutable if name in self.request}
+        else:
+            frozen['root'] = self.root
+
+        return json.dumps(frozen)
 
 
     @property
@@ -73,6 +107,11 @@ class RequestDecoder:
     def requestId(self):
         return self.request['@ID']
 
+    @property
+    def inResponseTo(self):
+        # Unsolicited responses have no InResponseTo
+        return None if self.unsolicited else self.requestId
+
     @property
     def issuedInstant(self):
         return saml_time(self.request['@IssueInstant'])
@@ -94,6 +133,11 @@ class RequestDecoder:
     def forceAuthn(self, v):
         self.request['@ForceAuthn'] = 'true' if v else 'false'
 
+    @property
+    def replayKey(self):
+        # entity IDs and request IDs are unbounded - state keys are not
+        return 'replay:' + sha256(f'{self.sp.sp_id}\0{self.requestId}'.encode('utf-8')).hexdigest()
+
     @property
     def issuer(self):
         issuer = self.request.get('saml:Issuer')
@@ -126,7 +170,11 @@ class RequestDecoder:
 
     @property
     def protocolBinding(self):
-        return self.request.get('@ProtocolBinding', bindPost)
+        # optional in the request - the SP's binding once it is known
+        binding = self.request.get('@ProtocolBinding')
+        if binding is None and self.sp is not None:
+            binding = self.sp.protocolBinding
+        return binding
     
     @property
     def consent(self):
@@ -140,10 +188,13 @@ class RequestDecoder:
     def findRequestErrors(self):
         """ Return error code or None if no errors """
 
+        if self.unsolicited:
+            return self.findUnsolicitedErrors()
+
         if self.version != '2.0':
             return SamlStatusVersionMismatch, f'Version 2.0 is required'
 
-        self.sp = SamlSPservice.getSamlSP(self.issuer)
+        self.sp = SamlSPservice.getSamlSP(self.issuer, self.tenant_id)
 
         if self.sp is None:
             raise Exception(f'Unknown Service Provider {self.issuer}')
@@ -152,7 +203,8 @@ class RequestDecoder:
 
         # validate any request signature
         try:
-            self.sp.deserializer.verifySamlRequest(request_qs=self.request_qs)
+            # already inflated by __init__ - only the signature is left to check
+            self.sp.deserializer.verifyQuerySignature(request_qs=self.request_qs)
 
         except Exception as e:
             current_app.logger.info(f'Request Verification Failed: {str(e)}')
@@ -166,6 +218,10 @@ class RequestDecoder:
 
         elif self.issuedInstant < datetime.utcnow() - timedelta(minutes=5):
             return SamlStatusAuthnFailed, 'Request has expired'
+
+        if self.checkReplay and self.idP.stateStore is not None:
+            if not self.idP.stateStore.add(self.replayKey, REPLAY_WINDOW):
+                return SamlStatusRequestDenied, 'Request has already been used'
         
         if self.isPassive and not self.idP.is_authenticated:
             return SamlStatusNoPassive, 'Passive authentication failed'
@@ -182,15 +238,28 @@ class RequestDecoder:
         # if self.consent is None:
         #     self.consent = self.sp.defConsent
         
-        if self.protocolBinding is None:
-            self.protocolBinding = self.sp.protocolBinding
-
-        elif self.protocolBinding != self.sp.protocolBinding:
+        if self.protocolBinding != self.sp.protocolBinding:
             return SamlStatusUnsupportedBinding, f'{self.protocolBinding} is unsupported'
         
         return SamlStatusSuccess, 'Successful Authentication'
 
 
+    def findUnsolicitedErrors(self):
+        """ Checks for an IdP-initiated request - there is no SAMLRequest to verify """
+
+        self.sp = SamlSPservice.getSamlSP(self.issuer, self.tenant_id)
+
+        if self.sp is None:
+            raise Exception(f'Unknown Service Provider {self.issuer}')
+
+        self.idP = self.sp.idP
+
+        if self.acs not in self.sp.acs:
+            return SamlStatusRequestor, 'Invalid Assertion Consumer Service'
+
+        return SamlStatusSuccess, 'Successful Authentication'
+
+
     def service(self):
         """ Service this request """
 
@@ -202,22 +271,70 @@ class RequestDecoder:
 
 
 
+class RequestUnsolicited(RequestDecoder):
+    """ IdP-initiated request built directly from a registered SP (no SAMLRequest) """
+
+    def __init__(self, request_base, sp, relayState=None):
+
+        self.request_base = request_base
+        self.request_qs = ''
+        self.relayState = sp.defRelayState if relayState is None else relayState
+
+        # Synthesize the AuthnRequest so freeze/thaw work unchanged
+        self.root = {
+            'samlp:AuthnRequest': {
+                '@ID': '_' + token_hex(16),
+                '@Version': '2.0',
+                '@IssueInstant': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                '@Destination': request_base,
+                '@AssertionConsumerServiceURL': sp.acs[0],
+                '@ProtocolBinding': sp.protocolBinding,
+                'saml:Issuer': sp.sp_id,
+                'samlp:NameIDPolicy': {
+                    '@Format': sp.defNameIdFmt,
+                },
+            }
+        }
+        self.request = self.root['samlp:AuthnRequest']
+
+        self.unsolicited = True
+
+        self.tenant_id = sp.idp_id
+        self.sp = sp
+        self.idP = sp.idP
+
+        self.responseStatus = SamlStatusAuthnFailed
+        self.responseStatusMessage = 'Request is unverified'
+
+
+
 class RequestThawed(RequestDecoder):
     """ Thaw frozen SAMLRequest (on return from authentication) """
 
+    # Already checked when first received
+    checkReplay = False
+
     def __init__(self, frozen):
 
         all = json.loads(frozen)
 
-        self.root = all['root']
+        if 'root' in all:
+            self.root = all['root']
+        else:
+            saml_req_xml, _ = SamlRequestSerializer.deserializeSamlRequest(request_qs=all['request_qs'])
+            self.root = parseRequest(saml_req_xml)
+            self.root['samlp:AuthnRequest'].update(all['changed'])
+
         self.request = self.root['samlp:AuthnRequest']
         
         self.relayState = all['relayState']
         self.responseStatus = all['responseStatus']
         self.responseStatusMessage = all['responseStatusMessage']
 
-        self.request_qs = all['request_qs']
+        self.request_qs = all.get('request_qs', '')
         self.request_base = all['request_base']
+        self.unsolicited = all.get('unsolicited', False)
+        self.tenant_id = all.get('idp_id')
         
-        self.sp = SamlSPservice.getSamlSP(self.issuer)
+        self.sp = SamlSPservice.getSamlSP(self.issuer, self.tenant_id)
         self.idP = self.sp.idP
@@ -1,28 +1,24 @@
 from base64 import b64encode
-from secrets import token_hex
 
 import xmltodict
 
-from .ResponseTemplate import samlResponseTemplate, samlErrorResponseTemplate
-from .SPservice import SamlSPservice
+from .ResponseTemplate import samlResponseTemplate, samlErrorResponseTemplate, systemClock
 
 from .constants import *
 
 
-newid = lambda: '_' + token_hex(16)
-
-
 class ResponseEncoder:
     """ Encode a SAMLResponse """
 
-    def __init__(self, saml_request):
+    def __init__(self, saml_request, clock=systemClock):
 
+        self.clock = clock
         self.sp_id = saml_request.issuer
-        self.sp = SamlSPservice.getSamlSP(self.sp_id)
+        self.sp = saml_request.sp
         self.idP = self.sp.idP
 
         # deep copy with fresh timestamps and id's
-        self.root = samlResponseTemplate()
+        self.root = samlResponseTemplate(clock=clock)
         self.resp = resp = self.root['samlp:Response']
 
         self.responseId = resp['@ID']
@@ -37,14 +33,39 @@ class ResponseEncoder:
         resp['@Destination'] = saml_request.acs
         resp['Assertion']['Subject']['SubjectConfirmation']['SubjectConfirmationData']['@Recipient'] = saml_request.acs
         
-        # The requesters request id
-        resp['@InResponseTo'] = saml_request.requestId
-        resp['Assertion']['Subject']['SubjectConfirmation']['SubjectConfirmationData']['@InResponseTo'] = saml_request.requestId
+        # The requesters request id (unsolicited responses have none)
+        in_response_to = saml_request.inResponseTo
+        if in_response_to:
+            resp['@InResponseTo'] = in_response_to
+            resp['Assertion']['Subject']['SubjectConfirmation']['SubjectConfirmationData']['@InResponseTo'] = in_response_to
+        else:
+            del resp['@InResponseTo']
+            del resp['Assertion']['Subject']['SubjectConfirmation']['SubjectConfirmationData']['@InResponseTo']
        
         # The SP URN id (i.e. issuer of the SAMLrequest)
         resp['Assertion']['Conditions']['AudienceRestriction']['Audience'] = saml_request.issuer 
 
 
+    @property
+    def nameId(self):
+        return self.resp['Assertion']['Subject']['NameID'].get('#text')
+
+
+    @property
+    def nameIdFormat(self):
+        return self.resp['Assertion']['Subject']['NameID']['@Format']
+
+
+    @property
+    def sessionIndex(self):
+        return self.resp['Assertion']['AuthnStatement']['@SessionIndex']
+
+
+    @property
+    def notOnOrAfter(self):
+        return self.resp['Assertion']['Conditions']['@NotOnOrAfter']
+
+
     @property
     def status_code(self):
         return self.resp['samlp:Status']['samlp:StatusCode']['@Value']
@@ -71,7 +92,7 @@ class ResponseEncoder:
         
 
     def auth_info(self,attrs, nameid=None):
-        """ Add attribute assertions to the response """
+        """ Add attribute assertions (dict or released <Attribute> list) to the response """
 
         # adding authentication information presumes staus is Success
         self.resp['samlp:Status']['samlp:StatusCode']['@Value'] = SamlStatusSuccess
@@ -80,19 +101,23 @@ class ResponseEncoder:
         format = self.resp['Assertion']['Subject']['NameID']['@Format']
         
         if nameid is None or format == SamlNameIdTransient:
-            nameid = newid()
+            nameid = self.clock.newid()
         
         self.resp['Assertion']['Subject']['NameID']['#text'] = nameid
         
         # create <Attribute> entries that will be added to <AttributeStatement>
-        attr_list = []
-
-        for attr in attrs:
-            
-            attr_list.append ({
-                '@Name': attr,
-                'AttributeValue' : attrs[attr],
-            })
+        if isinstance(attrs, dict):
+            attr_list = []
+
+            for attr in attrs:
+                
+                attr_list.append ({
+                    '@Name': attr,
+                    'AttributeValue' : attrs[attr],
+                })
+        else:
+            # already released by an AttributeReleasePolicy
+            attr_list = attrs
 
         # add (replace) the attributes to the response tree
         self.resp['Assertion']['AttributeStatement']['Attribute'] = attr_list
@@ -129,17 +154,20 @@ class ResponseEncoder:
 class ErrorResponseEncoder:
     """ Encode a SAML Error Reply """
 
-    def __init__(self, saml_request):
+    def __init__(self, saml_request, clock=systemClock):
 
         # start with a deep copy of a template
-        self.root = samlErrorResponseTemplate()
+        self.root = samlErrorResponseTemplate(clock=clock)
         self.resp = resp = self.root['samlp:Response']
         
         self.responseId = resp['@ID']
         
         # set required fields from saml_request
         resp['Issuer']['#text'] = saml_request.destination
-        resp['@InResponseTo'] = saml_request.requestId
+        if saml_request.inResponseTo:
+            resp['@InResponseTo'] = saml_request.inResponseTo
+        else:
+            del resp['@InResponseTo']
 
         self.status_code = saml_request.responseStatus
         self.status_message = saml_request.responseStatusMessage
@@ -170,9 +198,14 @@ class ErrorResponseEncoder:
         self.resp['samlp:Status']['samlp:StatusMessage'] = {'#text':message}
         
 
+    def sign(self):
+        """ Error responses are unsigned - return raw XML """
+
+        return xmltodict.unparse(self.root, full_document=False).encode('utf-8')
+
+
     def serialize(self):
         """ Serialize and encode XML response """
 
-        saml_data = xmltodict.unparse(self.root, full_document=False).encode('utf-8')
-        return b64encode(saml_data)
+        return b64encode(self.sign())
 
@@ -1,9 +1,12 @@
-from secrets import token_hex
+from base64 import b64encode
+from datetime import datetime
+from urllib.parse import urlencode
 
 from flask import (
     Response,
     abort, 
     current_app,
+    redirect,
     render_template,
     session, 
 )
@@ -14,6 +17,8 @@ from .ResponseEncoder import (
     ErrorResponseEncoder,
 )
 from .RequestDecoder import RequestThawed
+from .AuditLog import AuditTimer
+from .StatelessToken import TOKEN_PREFIX
 
 
 
@@ -22,6 +27,15 @@ class   ResponseHandler:
 
     post_redir_template = 'redir_post.html'
 
+    # Frozen requests wait here, rather than the session, when an IdP has a state store
+    stateStores = []
+
+    # (codec, state store) of IdPs carrying frozen requests in an encrypted token
+    pendingCodecs = []
+
+    # Time allowed for primary authentication
+    pending_ttl = 900
+
     def __init__(self, authn):
 
         self.authn = authn
@@ -35,11 +49,11 @@ class   ResponseHandler:
 
         status = saml_request.responseStatus
 
-        current_app.logger.info(f'Authn Request {saml_request.requestId} for SP "{saml_request.issuer}"')
+        current_app.logger.info('Authn Request %s for SP "%s"', saml_request.requestId, saml_request.issuer)
         
         if status == SamlStatusSuccess and saml_request.idP.is_authenticated and not saml_request.forceAuthn:
             # immediate success return
-            current_app.logger.info(f'Request {saml_request.requestId} satisfied by previous authentication')
+            current_app.logger.info('Request %s satisfied by previous authentication', saml_request.requestId)
             return this.send_success_response(saml_request)
 
         elif status != SamlStatusSuccess:
@@ -60,7 +74,16 @@ class   ResponseHandler:
 
             authId = 'Auth_' + saml_request.requestId
 
-            session[authId] = saml_request.freeze()
+            stateStore = saml_request.idP.stateStore
+            pendingCodec = saml_request.idP.pendingCodec
+
+            if pendingCodec is not None:
+                # stateless - the request travels in the reqid token
+                authId = pendingCodec.encode(saml_request.freeze())
+            elif stateStore is not None:
+                stateStore.set(authId, saml_request.freeze(), this.pending_ttl)
+            else:
+                session[authId] = saml_request.freeze()
             
             nkwargs={
                 'force_reauth': force_reauth,
@@ -68,7 +91,7 @@ class   ResponseHandler:
                 'after': 'SA',
             }
             
-            current_app.logger.info(f'Froze request {saml_request.requestId} for primary authentication')
+            current_app.logger.info('Froze request %s for primary authentication', saml_request.requestId)
 
             return saml_request.idP.initiate_login(**nkwargs)
     
@@ -81,9 +104,14 @@ class   ResponseHandler:
 
         short_stat = saml_request.responseStatus.split(':')[-1]
 
-        current_app.logger.info(f'Creating Error response {eresp.responseId} in reply to {saml_request.requestId}')
-        current_app.logger.info(f'Request {saml_request.requestId} with error: [{short_stat}], {saml_request.responseStatusMessage}')
+        current_app.logger.info('Creating Error response %s in reply to %s', eresp.responseId, saml_request.requestId)
+        current_app.logger.info('Request %s with error: [%s], %s', saml_request.requestId, short_stat, saml_request.responseStatusMessage)
+
+        this.audit(saml_request, eresp.responseId)
         
+        if saml_request.protocolBinding == bindArtifact:
+            return this.saml_artifact_redirect(saml_request, eresp.sign())
+
         return this.saml_post_redirect(
             url=saml_request.acs, payload={
             'SAMLResponse': eresp.serialize().decode(),
@@ -95,35 +123,134 @@ class   ResponseHandler:
     def send_success_response(this, saml_request):
         """ Create a SAMLResponse for a succesful return. """
 
+        timer = AuditTimer()
+
         resp = ResponseEncoder(saml_request)
 
         acs_url = saml_request.acs
 
-        current_app.logger.info(f'Creating Success response {resp.responseId} in reply to {saml_request.requestId}')
+        current_app.logger.info('Creating Success response %s in reply to %s', resp.responseId, saml_request.requestId)
         
-        desired_attrs = saml_request.sp.authn_attrs
         session_attrs = session.get('attributes',{})
 
-        resp_attrs = {}
-        for attr in desired_attrs:
-            if attr in session_attrs:
-                resp_attrs[attr] = session_attrs[attr]
+        resolvers = saml_request.idP.resolvers
+        if resolvers is not None:
+            # only the resolvers providing attributes this SP is released
+            session_attrs = resolvers.resolve(session_attrs, saml_request.sp.resolve_attrs)
+
+        resp_attrs = saml_request.sp.release_policy.release(session_attrs)
+        timer.stage('encode')
 
-        nameId = saml_request.sp.authn_nameIdAttr
+        nameId = this.subject_nameid(saml_request, resp.nameIdFormat, session_attrs)
         
         resp.auth_info(attrs=resp_attrs, nameid=nameId)
 
-        # sign, serialize, and b64encode:
-        bresp = resp.serialize().decode()
+        # sign
+        signed = resp.sign()
+        timer.stage('sign')
 
-        return this.saml_post_redirect( 
-            url=acs_url,
-            payload = {
-                'SAMLResponse':bresp,
-                'RelayState': saml_request.relayState
-            }
+        if saml_request.protocolBinding == bindArtifact:
+            # signed response stays here - browser only carries the artifact
+            result = this.saml_artifact_redirect(saml_request, signed)
+
+        else:
+            # serialize, and b64encode:
+            bresp = b64encode(signed).decode()
+
+            result = this.saml_post_redirect( 
+                url=acs_url,
+                payload = {
+                    'SAMLResponse':bresp,
+                    'RelayState': saml_request.relayState
+                }
+            )
+        timer.stage('render')
+
+        this.record_participant(saml_request, resp, saml_request.idP.principal(session_attrs))
+
+        this.audit(saml_request, resp.responseId, 
+            nameid=resp.nameId, 
+            attributes=[attr['@Name'] for attr in resp_attrs], 
+            timings=timer.timings,
         )
 
+        return result
+
+
+    @classmethod
+    def subject_nameid(this, saml_request, nameid_format, attributes):
+        """ NameID value for the subject, None for a random (transient) one """
+
+        sp = saml_request.sp
+        pairwise = saml_request.idP.pairwise
+
+        if nameid_format == SamlNameIdPersistent and pairwise is not None:
+            principal = pairwise.principal(attributes)
+            if principal is not None:
+                return pairwise.nameId(sp.sp_id, principal, sp.pairwise_version)
+
+        if sp.authn_nameIdAttr is None:
+            return None
+
+        # the value of the NameIdAttr attribute, not its name
+        value = attributes.get(sp.authn_nameIdAttr)
+        if isinstance(value, (list, tuple)):
+            value = value[0] if value else None
+
+        return value
+
+
+    @classmethod
+    def record_participant(this, saml_request, resp, principal=None):
+        """ Remember the SP session for Single Logout """
+
+        participants = [
+            p for p in session.get('saml_sessions', []) 
+            if p['sp'] != saml_request.issuer or p['idp'] != saml_request.idP.idp_id
+        ]
+
+        participants.append({
+            'idp': saml_request.idP.idp_id,
+            'sp': saml_request.issuer,
+            'nameid': resp.nameId,
+            'format': resp.nameIdFormat,
+            'session_index': resp.sessionIndex,
+        })
+
+        session['saml_sessions'] = participants
+
+        saml_request.idP.sessions.record(
+            saml_request.idP.idp_id,
+            saml_request.issuer,
+            principal,
+            resp.nameId,
+            resp.nameIdFormat,
+            resp.sessionIndex,
+            resp.notOnOrAfter,
+        )
+
+
+    @classmethod
+    def audit(this, saml_request, response_id, nameid=None, attributes=(), timings=None):
+        """ Queue a structured audit event for an issued response (if configured) """
+
+        auditLog = saml_request.idP.auditLog
+        if auditLog is None:
+            return
+
+        auditLog.emit({
+            'time': datetime.utcnow().isoformat() + 'Z',
+            'idp': saml_request.idP.idp_id,
+            'sp': saml_request.issuer,
+            'request_id': saml_request.inResponseTo,
+            'response_id': response_id,
+            'status': saml_request.responseStatus,
+            'nameid': nameid,
+            'attributes': attributes,
+            'binding': saml_request.protocolBinding,
+            'timings': timings,
+        })
+
 
     @classmethod
     def saml_post_redirect(this, url, payload):
@@ -138,23 +265,67 @@ class   ResponseHandler:
             })
 
 
+    @classmethod
+    def saml_artifact_redirect(this, saml_request, saml_data):
+        """ Store the response, return HTTP-Artifact redirect to the ACS """
+
+        artifact = saml_request.idP.artifacts.issue(saml_request.issuer, saml_data)
+
+        params = {'SAMLart': artifact}
+        if saml_request.relayState:
+            params['RelayState'] = saml_request.relayState
+
+        sep = '&' if '?' in saml_request.acs else '?'
+
+        resp = redirect(saml_request.acs + sep + urlencode(params))
+        resp.headers['Cache-Control'] = 'no-store, no-cache'
+        resp.headers['Pragma'] = 'no-cache'
+        
+        return resp
+
+
+    @classmethod
+    def thaw_token(this, token):
+        """ Frozen request from a stateless mode token """
+
+        for pendingCodec, stateStore in this.pendingCodecs:
+            try:
+                return pendingCodec.decode(token, stateStore)
+            except Exception as e:
+                error = e
+
+        raise error if this.pendingCodecs else Exception('stateless mode is not configured')
+
+
     @classmethod
     def after_authn(this, authId):
         """ Unthaw response and validate authentication """
         
         try:
-            iced_request = session[authId]
-            del session[authId]
+            if authId.startswith(TOKEN_PREFIX):
+                iced_request = this.thaw_token(authId)
+            else:
+                iced_request = session.pop(authId, None)
+
+            for stateStore in this.stateStores:
+                if iced_request is not None:
+                    break
+                iced_request = stateStore.pop(authId)
+
+            if iced_request is None:
+                raise Exception('frozen request not found')
 
         except Exception as e:
-            current_app.logger.info(f'Failed to restore frozen session {authId.replace("Auth_","")}')
+            current_app.logger.info('Failed to restore frozen session %s: %s', authId.replace("Auth_","")[:64], str(e))
             session.clear()
             abort(500, 'Something went wrong, please try again')
 
         saml_request = RequestThawed(iced_request)
         
-        current_app.logger.info(f'Thawed request {saml_request.requestId} after primary authentication')
-        
+        current_app.logger.info('Thawed request %s after primary authentication', saml_request.requestId)
+
+        saml_request.idP.authenticated()
+
         if not saml_request.idP.is_authenticated:
             # sanity check
             saml_request.responseStatus = SamlStatusAuthnFailed
@@ -1,24 +1,60 @@
 from copy import deepcopy
 from datetime import datetime, timedelta
+from random import Random
 from secrets import token_hex
 
-# Generate a random id
-newid = lambda: '_' + token_hex(16)   # Azure and SimpleSaml require a leading character
-
 # Time stamps in UTC time, ISO format
 TIMEFORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
-issue_instant_now = lambda: datetime.utcnow().strftime(TIMEFORMAT)
-expire_time = lambda minutes: (datetime.utcnow() + timedelta(minutes=minutes)).strftime(TIMEFORMAT)
 
 
-def samlResponseTemplate(expire_minutes=60):
+class   SamlClock:
+    """ Source of timestamps and identifiers for SAML messages
+
+    The default is the system clock and random ids.  Templates and
+    encoders take a clock so output can be made reproducible.
+    """
+
+    def now(self):
+        return datetime.utcnow()
+
+    def newid(self):
+        # Azure and SimpleSaml require a leading character
+        return '_' + token_hex(16)
+
+    def instant(self):
+        return self.now().strftime(TIMEFORMAT)
+
+    def expires(self, minutes):
+        return (self.now() + timedelta(minutes=minutes)).strftime(TIMEFORMAT)
+
+
+
+class   FixedClock(SamlClock):
+    """ Frozen time and seeded ids - the same seed gives the same sequence of messages """
+
+    def __init__(self, now=None, seed=0):
+        self.at = now or datetime(2000, 1, 1)
+        self.random = Random(seed)
+
+    def now(self):
+        return self.at
+
+    def newid(self):
+        return '_%032x' % self.random.getrandbits(128)
+
+
+systemClock = SamlClock()
+
+
+def samlResponseTemplate(expire_minutes=60, clock=systemClock):
     """ 
     response_dict = SamlResponseTemplate(expire_minutes)
 
     Return a new instance of the SamlResponse template with date/time fields
     set and identifiers created.
 
-    Expiration time - i.e. 'NotOnOrAfter' values default to 60 minutes
+    Expiration time - i.e. 'NotOnOrAfter' values default to 60 minutes.
+    Timestamps and identifiers come from clock.
     
     """
 
@@ -30,37 +66,47 @@ def samlResponseTemplate(expire_minutes=60):
     # add timestamps and identifiers to the template
 
     # issue instance/notbefore/authinstant time - we use the same
-    instant = issue_instant_now()
-    response['@ID'] = newid()
+    instant = clock.instant()
+    response['@ID'] = clock.newid()
     response['@IssueInstant'] = instant
     assertion['@IssueInstant'] = instant
     assertion['Conditions']['@NotBefore'] = instant
     assertion['AuthnStatement']['@AuthnInstant'] = instant
 
     # not on or after/expiration time
-    notonorafter = expire_time(expire_minutes)
+    notonorafter = clock.expires(expire_minutes)
     assertion['Subject']['SubjectConfirmation']['SubjectConfirmationData']['@NotOnOrAfter'] = notonorafter
     assertion['Conditions']['@NotOnOrAfter'] = notonorafter
 
     # assertion id & session index - override in caller if you want something different
-    authid = newid()
+    authid = clock.newid()
     assertion['@ID'] = authid
     assertion['AuthnStatement']['@SessionIndex'] = authid
 
     return root
 
 
-def samlErrorResponseTemplate():
+def samlErrorResponseTemplate(clock=systemClock):
 
     root = deepcopy(__saml_error_response_template)
     response = root['samlp:Response']
 
-    instant = issue_instant_now()
-    response['@ID'] = newid()
+    instant = clock.instant()
+    response['@ID'] = clock.newid()
     response['@IssueInstant'] = instant
 
     return root
 
+def samlLogoutRequestTemplate(clock=systemClock):
+
+    root = deepcopy(__saml_logout_request_template)
+    request = root['samlp:LogoutRequest']
+
+    request['@ID'] = clock.newid()
+    request['@IssueInstant'] = clock.instant()
+
+    return root
+
 """
 
 Python dict template of a SAMLResponse in xmltodict format
@@ -157,4 +203,25 @@ __saml_error_response_template = {
             }
         }
     }
-}
\ No newline at end of file
+}
+
+
+__saml_logout_request_template = {
+    'samlp:LogoutRequest': {
+        '@ID': '_id here',
+        '@Version': '2.0',
+        '@IssueInstant': 'issue_time_utc_iso',
+        '@Destination': 'SP SLO URL',
+        '@xmlns:samlp': 'urn:oasis:names:tc:SAML:2.0:protocol',
+        'Issuer': {
+            '@xmlns': 'urn:oasis:names:tc:SAML:2.0:assertion',
+            '#text': 'URN of IdP'
+        },
+        'NameID': {
+            '@xmlns': 'urn:oasis:names:tc:SAML:2.0:assertion',
+            '@Format': 'Name ID format',
+            '#text': 'Name ID'
+        },
+        'samlp:SessionIndex': '_session index from assertion'
+    }
+}
@@ -1,13 +1,58 @@
+import json
 import logging as logger
+import sys
 
 from .constants import *
-from .SamlSerializer import SamlRequestSerializer
+from .SamlSerializer import SamlRequestSerializer, SamlResponseSigner
 from .Metadata import loadSPMetadata
+from .AttributePolicy import AttributeReleasePolicy
+from .Admission import TokenBucket
 
+# Registry keyed by (IdP entity ID, SP entity ID) - one process can host several IdPs
 allServiceProviders = {}
 
+# SP entity ID -> first SamlSPservice registered for it (lookups without an IdP)
+defaultServiceProviders = {}
+
+# Immutable state shared by every SP that doesn't override it
+_defaultAuthnAttrs = ('uid',)
+_noSLO = ()
+_unsignedDeserializer = SamlRequestSerializer()
+_releasePolicies = {}
+
+_intern = lambda s: sys.intern(s) if type(s) is str else s
+
+
+def _releasePolicy(rules):
+    """ Compiled release policy - SPs with identical rules share one """
+
+    try:
+        key = json.dumps(rules, sort_keys=True)
+    except (TypeError, ValueError):
+        # rules holding other objects (e.g. a compiled Match) are not shared
+        return AttributeReleasePolicy(rules)
+
+    policy = _releasePolicies.get(key)
+    if policy is None:
+        policy = _releasePolicies[key] = AttributeReleasePolicy(rules)
+    return policy
+
+
 class SamlSPservice:
-    """ SAML Service Provider definition """
+    """ SAML Service Provider definition 
+
+    Registries may hold tens of thousands of these, so instances have no
+    __dict__, protocol URNs are interned and defaults are shared.
+    """
+
+    __slots__ = (
+        'idP', 'idp_id', 'sp_id', 'acs',
+        'sign_response', 'sign_assertion',
+        'defRelayState', 'defConsent', 'defNameIdFmt', 'protocolBinding',
+        'authn_attrs', 'authn_nameIdAttr', 'release_policy', 'resolve_attrs',
+        'sp_cert', 'rate_limit', 'slo', 'slo_timeout', 'pairwise_version',
+        'deserializer', 'verifier',
+    )
 
     def __init__(self, idP, sp_config):
 
@@ -17,11 +62,11 @@ class SamlSPservice:
         sp_config = loadSPMetadata(sp_config)
         
         self.sp_id = sp_config['SPEntityId']
-        self.acs = sp_config.get('ACSList',[])
+        self.acs = tuple(sp_config.get('ACSList',()))
 
         assert self.sp_id, 'Config error: SP Entity ID not specified'
         assert self.acs, f'Config error: ({self.sp_id}) SP Assertion Consumer URL not specified'
-        assert self.sp_id not in allServiceProviders, f'Config error: ({self.sp_id}) SP instance already defined'
+        assert (self.idp_id, self.sp_id) not in allServiceProviders, f'Config error: ({self.sp_id}) SP instance already defined for IdP {self.idp_id}'
 
         # Default is to sign response but not assertion
         self.sign_response = sp_config.get('SignResponse',True)
@@ -30,26 +75,82 @@ class SamlSPservice:
         assert self.sign_response or self.sign_assertion, f'Config error: ({self.sp_id}) Either Response or Assertions, or both must be signed'
 
         self.defRelayState = sp_config.get('RelayState','')
-        self.defConsent = sp_config.get('DefaultConsent',consUndefined)
-        self.defNameIdFmt = sp_config.get('DefaultNameIDPol', SamlNameIdTransient)
-        self.protocolBinding = sp_config.get('ProtocolBinding',bindPost)
+        self.defConsent = _intern(sp_config.get('DefaultConsent',consUndefined))
+        self.defNameIdFmt = _intern(sp_config.get('DefaultNameIDPol', SamlNameIdTransient))
+        self.protocolBinding = _intern(sp_config.get('ProtocolBinding',bindPost))
+
+        authn_attrs = sp_config.get('AuthAttrs')
+        self.authn_attrs = tuple(map(_intern, authn_attrs)) if authn_attrs else _defaultAuthnAttrs
+        self.authn_nameIdAttr = _intern(sp_config.get('NameIdAttr'))
 
-        self.authn_attrs = sp_config.get('AuthAttrs',['uid'])
-        self.authn_nameIdAttr = sp_config.get('NameIdAttr')
+        # Compile the attribute release plan (defaults to releasing AuthAttrs as-is)
+        self.release_policy = _releasePolicy(
+            sp_config.get('AttributePolicy', list(self.authn_attrs))
+        )
+
+        # Attribute names this SP needs from the IdP's attribute resolvers
+        self.resolve_attrs = self.release_policy.sources | ({self.authn_nameIdAttr} if self.authn_nameIdAttr else set())
 
         self.sp_cert = sp_config.get('sp_cert')
 
+        # the signed ArtifactResolve is the only thing authenticating an artifact's holder
+        assert self.protocolBinding != bindArtifact or self.sp_cert, f'Config error: ({self.sp_id}) HTTP-Artifact binding needs sp_cert'
+
+        # Pairwise NameID key this SP was provisioned with (None - the IdP's current key)
+        self.pairwise_version = sp_config.get('PairwiseKeyVersion')
+        pairwise = getattr(idP, 'pairwise', None)
+        assert self.pairwise_version is None or pairwise is None or pairwise.hasVersion(self.pairwise_version), \
+            f'Config error: ({self.sp_id}) PairwiseKeyVersion {self.pairwise_version} is not a pairwise_ids key'
+
+        # Requests per second allowed for this SP (None - unlimited)
+        self.rate_limit = TokenBucket.fromConfig(sp_config.get('RateLimit'))
+
+        # Back-channel (SOAP) Single Logout
+        self.slo = tuple(sp_config.get('SLOList', ())) or _noSLO
+        self.slo_timeout = sp_config.get('SLOTimeout', 5)
+
         # Use this to deserialize and maybe verify signed query string
-        self.deserializer = SamlRequestSerializer(cert=self.sp_cert)
+        self.deserializer = SamlRequestSerializer(cert=self.sp_cert) if self.sp_cert else _unsignedDeserializer
+
+        # Use this to verify signed back-channel (SOAP) requests
+        self.verifier = SamlResponseSigner(cert=self.sp_cert) if self.sp_cert else None
     
-        allServiceProviders[self.sp_id] = self
+        allServiceProviders[(self.idp_id, self.sp_id)] = self
+        defaultServiceProviders.setdefault(self.sp_id, self)
 
         logger.info(f'IdP: {idP.idp_id} added Service Provider: {self.sp_id}')
 
 
+    def unregister(self):
+        """ Remove this SP from the registry """
+
+        allServiceProviders.pop((self.idp_id, self.sp_id), None)
+
+        if defaultServiceProviders.get(self.sp_id) is self:
+            del defaultServiceProviders[self.sp_id]
+
+            # another IdP's SP with this entity id becomes the default
+            for (idp_id, sp_id), sp in allServiceProviders.items():
+                if sp_id == self.sp_id:
+                    defaultServiceProviders[sp_id] = sp
+                    break
+
+
+    def reinit(self):
+        """ Rebuild crypto handles and parsers (e.g. in a forked worker) """
+
+        self.deserializer.reinit()
+
+        if self.verifier:
+            self.verifier.reinit()
+
+
     @classmethod
-    def getSamlSP(this,sp_id):
-        """ Find SamlSPs for an entity id"""
+    def getSamlSP(this,sp_id, idp_id=None):
+        """ Find SamlSPs for an entity id (of an IdP entity id, or the first registered) """
+
+        if idp_id is not None:
+            return allServiceProviders.get((idp_id, sp_id))
 
-        return allServiceProviders.get(sp_id)
+        return defaultServiceProviders.get(sp_id)
 
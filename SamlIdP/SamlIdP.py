@@ -1,92 +1,428 @@
+from datetime import datetime
+from secrets import token_hex
 import os
+import threading
 
 from flask import (
     Blueprint, 
     Response, 
     abort, 
     current_app, 
+    jsonify,
+    render_template,
     request, 
     session,
     url_for
 )
 from .IdPservice import IdPservice
-from .RequestDecoder import RequestDecoder
-from .IdpMetaEncoder import encodeIdPMetaData
+from .RequestDecoder import RequestDecoder, RequestUnsolicited
+from .SPservice import SamlSPservice
+from .SamlSerializer import SamlRequestSerializer
+from .constants import SamlStatusSuccess
+from .Admission import AdmissionError
+from .ResponseEncoder import ResponseEncoder
+from .ResponseHandler import ResponseHandler
 
 DIR=os.path.dirname(__file__)
 abspath = lambda p : os.path.join(DIR,p)
 
 class   SamlIdP(Blueprint):
-    """ SAML Identity Provider Flask Blueprint """
+    """ SAML Identity Provider Flask Blueprint 
 
-    def __init__(self, *, auth, idp_config, app=None):
+    Several IdPs (tenants) can be served by one app - give each its own
+    'name' and either its own 'url_prefix' or 'host' (host routing needs
+    the app created with host_matching=True).  Tenants sharing one auth
+    share its login, but each asks for primary authentication once before
+    it treats the user as authenticated.
+
+    slo_transport(url, soap_request, timeout) -> bytes replaces the SOAP
+    POST of back-channel Single Logout, e.g. with a local stand-in.
+    """
+
+    def __init__(self, *, auth, idp_config, app=None, slo_transport=None):
+
+        name = idp_config.get('name','samlidp')
+        assert app is None or name not in app.blueprints, f'Config error: blueprint name {name} already registered - give each IdP its own name'
 
         # create the IdP (and underling SP's)
-        self.idP = IdPservice(auth=auth, idp_config=idp_config)
+        self.idP = IdPservice(auth=auth, idp_config=idp_config, slo_transport=slo_transport)
 
         # make this a Blueprint
         url_prefix = idp_config.get('url_prefix','')
         Blueprint.__init__(self, 
-            name='samlidp', 
+            name=name, 
             import_name=__name__,
             template_folder=abspath('templates')
             )
 
+        # Route by host when configured
+        host = idp_config.get('host')
+        self.rule_options = {'host': host} if host else {}
+
+        # Not ready for traffic until warmed up (after registration with an app) - per process
+        self.app = None
+        self.warm_pid = None
+        self.ready_pid = None
+        self.warm_lock = threading.Lock()
+        self.record_once(lambda state: self.startWarmup(state.app))
+
         # Set up endpoint to handle SAML requests
         self.add_url_rule(
             '/saml2',
             'saml2',
             self.saml2req,
-            methods=['GET']
+            methods=['GET'],
+            **self.rule_options
+        )
+
+        self.add_url_rule(
+            '/saml2/idp-init',
+            'saml2init',
+            self.saml2init,
+            methods=['GET'],
+            **self.rule_options
         )
 
         self.add_url_rule(
             '/saml2/metadata',
             'saml2meta',
             self.saml2Meta,
-            methods=['GET']   
+            methods=['GET'],
+            **self.rule_options
+        )
+
+        self.add_url_rule(
+            '/saml2/artifact',
+            'saml2artifact',
+            self.saml2artifact,
+            methods=['POST'],
+            **self.rule_options
         )
 
         self.add_url_rule(
             '/saml2/.logout',
             'logout',
             self.logout,
+            **self.rule_options
         )
 
+        self.add_url_rule(
+            '/saml2/ready',
+            'saml2ready',
+            self.saml2ready,
+            methods=['GET'],
+            **self.rule_options
+        )
+
+        if idp_config.get('export_stats'):
+            self.add_url_rule(
+                '/saml2/stats',
+                'saml2stats',
+                self.saml2stats,
+                methods=['GET'],
+                **self.rule_options
+            )
+
         if app:
             # self register blueprint if app is specified
             app.register_blueprint(self, url_prefix=url_prefix)
 
 
+    @classmethod
+    def tenants(this, *, auth, idp_configs, app=None, slo_transport=None):
+        """ Create a SamlIdP blueprint for each IdP (tenant) configuration """
+
+        names = [idp_config.get('name','samlidp') for idp_config in idp_configs]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        assert not duplicates, f'Config error: tenant names {duplicates} are not unique'
+
+        return [this(auth=auth, idp_config=idp_config, app=app, slo_transport=slo_transport) for idp_config in idp_configs]
+
+
     def saml2req(self):
         """ /saml2 API endpoint for SAMLRequest """
 
+        try:
+            # shed load before any decoding
+            issuer = SamlRequestSerializer.peekIssuer(request.query_string.decode())
+            sp = SamlSPservice.getSamlSP(issuer, self.idP.idp_id)
+            self.idP.admission.admit(request.remote_addr, sp)
+
+        except AdmissionError as e:
+            return self.refused(e)
+
+        if sp is None:
+            # unknown, oversized or undecodable - refused before full inflate or XML parsing
+            # (the peek is only a hint: a known issuer is checked against the parsed one)
+            current_app.logger.info('Refused SAMLRequest from unknown issuer %s', issuer)
+            abort(Response(status=400, response=f'Failure decoding SAMLRequest'))
+
+        coalescer = self.idP.coalescer
+
+        if coalescer is not None and self.idP.is_authenticated:
+            # duplicates (double clicks, retries) share one signed response
+            # not the session cookie - that is reissued with every response
+            session_id = session.setdefault('_coalesce_id', token_hex(16))
+            return coalescer.run(coalescer.key(request.query_string, session_id), lambda: self.serviceRequest(issuer))
+
+        return self.serviceRequest(issuer)
+
+
+    def serviceRequest(self, issuer):
+        """ Decode and service the SAMLRequest of this request (admitted for issuer) """
+
+        try:
+            # a signing slot is held from before the decode until the response
+            with self.idP.admission.signing():
+                return self.serviceDecoded(issuer)
+
+        except AdmissionError as e:
+            return self.refused(e)
+
+
+    def serviceDecoded(self, issuer):
+        """ Decode the SAMLRequest, check it is the issuer's and service it """
+
         try:
             url_base = request.url.split('?')[0]
-            saml_request = RequestDecoder(url_base, request.query_string)
+            saml_request = RequestDecoder(url_base, request.query_string, idP=self.idP)
         
         except Exception as e:
             current_app.logger.info(f'Failed to decode SAMLrequest {str(e)}', exc_info=True)
             abort(Response(status=400, response=f'Failure decoding SAMLRequest'))
+
+        if saml_request.issuer != issuer:
+            # the peek was fooled (comment, foreign element) - it was charged to the wrong SP
+            current_app.logger.info('Refused SAMLRequest from %s admitted as %s', saml_request.issuer, issuer)
+            abort(Response(status=400, response=f'Failure decoding SAMLRequest'))
         
         try:
             # Returns either direct response, or redirect to authenticate
             return saml_request.service()
 
+        except AdmissionError as e:
+            return self.refused(e)
+
         except Exception as e:
             current_app.logger.error(f'Error handling SAMLRequest: {str(e)}',exc_info=True)
             abort(Response(status=500, response=f'Error handling SAMLRequest: {str(e)}'))
     
 
+    def saml2init(self):
+        """ /saml2/idp-init?sp=<entityID> endpoint for IdP-initiated (unsolicited) SSO """
+
+        sp = SamlSPservice.getSamlSP(request.args.get('sp'), self.idP.idp_id)
+
+        if sp is None:
+            abort(Response(status=404, response='Unknown Service Provider'))
+
+        try:
+            self.idP.admission.admit(request.remote_addr, sp)
+
+        except AdmissionError as e:
+            return self.refused(e)
+
+        try:
+            with self.idP.admission.signing():
+                url_base = url_for('.saml2', _external=True)
+                saml_request = RequestUnsolicited(url_base, sp, relayState=request.args.get('RelayState'))
+
+                # Returns either direct response, or redirect to authenticate
+                return saml_request.service()
+
+        except AdmissionError as e:
+            return self.refused(e)
+
+        except Exception as e:
+            current_app.logger.error(f'Error handling IdP-initiated login: {str(e)}',exc_info=True)
+            abort(Response(status=500, response=f'Error handling IdP-initiated login: {str(e)}'))
+
+
+    def saml2artifact(self):
+        """ /saml2/artifact SOAP endpoint for SP <ArtifactResolve> """
+
+        try:
+            soapxml = self.idP.artifacts.resolve(request.get_data())
+
+        except Exception as e:
+            current_app.logger.info(f'Failed to resolve artifact {str(e)}', exc_info=True)
+            abort(Response(status=400, response='Failure resolving artifact'))
+
+        return Response(response=soapxml, headers={
+            'Content-Type': 'text/xml',
+            'Cache-Control': 'no-store, no-cache',
+        })
+
+
+    @property
+    def ready(self):
+        # a forked worker (e.g. gunicorn preload_app) isn't ready because its parent was
+        return self.ready_pid == os.getpid()
+
+
+    def startWarmup(self, app):
+        """ Warm up in the background - the port can open, /saml2/ready says when to send traffic """
+
+        with self.warm_lock:
+            if self.warm_pid == os.getpid():
+                return
+
+            self.app = app
+            self.warm_pid = os.getpid()
+
+        warmer = threading.Thread(target=self.warmup, args=(app,), name='samlidp-warmup', daemon=True)
+        warmer.start()
+
+
+    def warmup(self, app):
+        """ Run a synthetic decode -> respond -> sign -> render cycle, then mark ready """
+
+        try:
+            session_dir = app.config.get('SESSION_FILE_DIR')
+            if session_dir:
+                os.makedirs(session_dir, exist_ok=True)
+
+            with app.test_request_context():
+                self.selfTest()
+
+            self.ready_pid = os.getpid()
+            app.logger.info(f'IdP {self.idP.idp_id} warmed up and ready in process {self.ready_pid}')
+
+        except Exception as e:
+            app.logger.error(f'IdP {self.idP.idp_id} warm-up failed, not ready: {str(e)}', exc_info=True)
+
+
+    def selfTest(self):
+        """ One full request/response cycle against a temporary self-test SP """
+
+        sp = SamlSPservice(idP=self.idP, sp_config={
+            'SPEntityId': self.idP.idp_id + '/.selftest',
+            'ACSList': ['https://selftest.invalid/acs'],
+            'AuthAttrs': ['uid'],
+        })
+
+        try:
+            instant = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+            authn_request = f'<samlp:AuthnRequest xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="_{token_hex(16)}" Version="2.0" IssueInstant="{instant}" AssertionConsumerServiceURL="{sp.acs[0]}"><saml:Issuer>{sp.sp_id}</saml:Issuer></samlp:AuthnRequest>'
+            request_qs = SamlRequestSerializer().serializeSamlRequest(authn_request.encode('utf-8'), 'selftest', sign=False)
+
+            # decode and validate
+            saml_request = RequestDecoder('https://selftest.invalid/saml2', request_qs.encode('utf-8'), idP=self.idP)
+            status, reason = saml_request.findRequestErrors()
+            if status != SamlStatusSuccess:
+                raise Exception(f'self-test request rejected: {reason}')
+
+            # respond, sign and verify
+            resp = ResponseEncoder(saml_request)
+            resp.auth_info(attrs=sp.release_policy.release({'uid': 'selftest'}))
+            signed = resp.sign()
+
+            if not self.idP.signer.verifySignedSamlResponse(signed):
+                raise Exception('self-test response failed signature verification')
+
+            # render
+            render_template(ResponseHandler.post_redir_template, url=sp.acs[0], payload={
+                'SAMLResponse': resp.serialize().decode(),
+                'RelayState': saml_request.relayState,
+            })
+
+        finally:
+            sp.unregister()
+
+
+    def saml2ready(self):
+        """ Readiness - 200 only after warm-up and registry loading """
+
+        if self.ready:
+            return Response(status=200, response='READY')
+
+        if self.app is not None:
+            # threads don't survive fork - warm up in this worker if that hasn't started
+            self.startWarmup(self.app)
+
+        return Response(status=503, response='NOT READY', headers={'Retry-After': '1'})
+
+
+    def refused(self, e):
+        """ Fast 429/503 for requests shed by admission control """
+
+        current_app.logger.info('Refused request: %s', e.reason)
+
+        return Response(status=e.status, response=e.reason, headers={
+            'Retry-After': str(e.retry_after),
+        })
+
+
+    def saml2stats(self):
+        """ Exported counters """
+
+        stats = {
+            'admission': self.idP.admission.counters,
+        }
+        if self.idP.auditLog:
+            stats['audit'] = self.idP.auditLog.counters
+        if self.idP.resolvers:
+            resolvers = self.idP.resolvers
+            stats['resolvers'] = dict(resolvers.counters, cache_hits=resolvers.cache.hits, cache_misses=resolvers.cache.misses)
+        if getattr(self.idP.stateStore, 'counters', None):
+            stats['state'] = self.idP.stateStore.counters
+        if self.idP.coalescer:
+            stats['coalescer'] = self.idP.coalescer.counters
+
+        return jsonify(stats)
+
+
+    def metadata(self):
+        """ Metadata XML with the endpoint URLs of the current (or test) request """
+
+        return self.idP.metadata(
+            ssologin=url_for(f'{self.name}.saml2',_external=True),
+            artifact_url=url_for(f'{self.name}.saml2artifact',_external=True),
+        )
+
+
+    def prebuildMetadata(self, app):
+        """ Encode metadata ahead of the first request - False if the external host isn't configured """
+
+        # endpoint URLs come from the request's host unless routed by host or SERVER_NAME is set
+        host = self.rule_options.get('host') or app.config.get('SERVER_NAME')
+        if not host:
+            return False
+
+        with app.test_request_context(base_url=f"{app.config.get('PREFERRED_URL_SCHEME') or 'http'}://{host}"):
+            self.metadata()
+
+        return True
+
+
     def saml2Meta(self):
         """ SAML IdP Metadata """
         
-        metaxml = encodeIdPMetaData(self.idP, ssologin=url_for('.saml2',_external=True))
+        metaxml = self.metadata()
         return Response(response=metaxml, headers={
             'Content-Type':'application/xml',
         })
 
 
     def logout(self):
+        """ Single Logout - back-channel LogoutRequests to participating SPs, then clear the session """
+
+        participants = [
+            p for p in session.get('saml_sessions', []) 
+            if p['idp'] == self.idP.idp_id
+        ]
+
+        # and the user's sessions at SPs signed in to from other browsers
+        principal = self.idP.principal(session.get('attributes', {}))
+        if principal is not None:
+            known = {p['session_index'] for p in participants}
+            participants.extend(
+                sso._asdict() for sso in self.idP.sessions.byPrincipal(principal)
+                if sso.idp == self.idP.idp_id and sso.session_index not in known
+            )
+
+        if participants:
+            self.idP.singleLogout.logout(participants)
+
         session.clear()
         return 'OK'
\ No newline at end of file
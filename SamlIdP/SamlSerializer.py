@@ -1,13 +1,16 @@
 from base64 import b64encode, b64decode
 from urllib.parse import parse_qs, quote, urlencode
+from xml.sax.saxutils import unescape
 from lxml import etree
+import re
+import threading
 import zlib
 
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography import x509
 
 from .constants import *
+from .KeyMaterial import keyRegistry
 
 
 class   _Signer:
@@ -15,6 +18,10 @@ class   _Signer:
 
     def __init__(self, cert, key=None, password=None):
 
+        # kept to rebuild crypto handles after fork
+        self.pem_key = key
+        self.password = password
+
         if key:
             self.key = serialization.load_pem_private_key(key, password)
         else:
@@ -22,9 +29,23 @@ class   _Signer:
             self.key = None
 
         if cert:
-            self.serial_cert = serialize_cert(cert)
-            self.cert = x509.load_pem_x509_certificate(cert)
-            self.public_key = self.cert.public_key()
+            # Shared with every other signer using the same certificate
+            self.material = keyRegistry.load(cert)
+            self.serial_cert = self.material.b64
+            self.cert = self.material.cert
+
+
+    @property
+    def public_key(self):
+        # from the registry, so a post-fork reinit is seen by every signer
+        return self.material.public_key
+
+
+    def reinit(self):
+        """ Rebuild the private key handle (e.g. in a forked worker) """
+
+        if self.pem_key:
+            self.key = serialization.load_pem_private_key(self.pem_key, self.password)
 
 
     def sign(self, data):
@@ -61,8 +82,7 @@ class   _Signer:
     def validateCert(self, cert):
         """ Validate the certificate matches ours """
 
-        cert = serialize_cert(cert)
-        if cert != self.serial_cert:
+        if not self.material.matches(cert):
             raise Exception('Incorrect Certificate')
         return True
 
@@ -77,6 +97,52 @@ class   _Signer:
         return dig.finalize()
 
 
+    @classmethod
+    def digest(this, element):
+        """ SHA256 digest of the exclusive c14n of element - streamed, never held in memory """
+
+        writer = _DigestWriter()
+        etree.ElementTree(element).write_c14n(writer, exclusive=True, with_comments=False)
+
+        return writer.dig.finalize()
+
+
+
+class   _DigestWriter:
+    """ File-like sink feeding canonical XML straight into SHA256 """
+
+    def __init__(self):
+        self.dig = hashes.Hash(hashes.SHA256())
+
+    def write(self, data):
+        self.dig.update(data)
+        return len(data)
+
+
+class   ThreadParsers:
+    """ One lxml XMLParser per thread - a parser must not be used by two threads at once """
+
+    def __init__(self, **options):
+
+        self.options = options
+        self.local = threading.local()
+
+
+    def get(self):
+
+        parser = getattr(self.local, 'parser', None)
+        if parser is None:
+            parser = self.local.parser = etree.XMLParser(**self.options)
+        return parser
+
+
+    def reinit(self):
+        """ Drop every thread's parser (e.g. in a forked worker) """
+
+        self.local = threading.local()
+
+
+
 def serialize_cert(cert):
     """ Remove PEM headers and new lines """
 
@@ -95,6 +161,25 @@ def serialize_cert(cert):
 
 
 
+# <saml:Issuer> text - found without parsing the XML, only as the first child of the
+# root element (skipping comments, and '>' in quoted attribute values)
+_issuer_re = re.compile(rb'''
+    \s* (?: <\?.*?\?> \s* )?                        # XML declaration
+    (?: <!--.*?--> \s* )*
+    <(?:[\w.-]+:)?AuthnRequest\b (?: [^>"'] | "[^"]*" | '[^']*' )* >
+    (?: \s | <!--.*?--> )*
+    <(?:[\w.-]+:)?Issuer\b (?: [^>"'] | "[^"]*" | '[^']*' )* >
+    \s* ([^<\s]+) \s* </
+''', re.VERBOSE | re.DOTALL)
+
+# Issuer follows the AuthnRequest start tag - no need to inflate further
+ISSUER_PEEK_SIZE = 4096
+
+# Inbound limits - larger requests are refused before any inflating or XML parsing
+MAX_QUERY_STRING = 16384
+MAX_SAML_REQUEST = 65536
+
+
 class SamlRequestSerializer:
     """ Serialize and deserialize Http-REDIRECT SAMLRequests """
 
@@ -109,6 +194,13 @@ class SamlRequestSerializer:
         self.verifyok = cert is not None
 
 
+    def reinit(self):
+        """ Rebuild crypto handles (e.g. in a forked worker) """
+
+        if self.signok or self.verifyok:
+            self.signer.reinit()
+
+
     def serializeSamlRequest(self,samlRequest, relayState, sign=True):
         """ Creates Query String with optional Signature """
 
@@ -136,68 +228,109 @@ class SamlRequestSerializer:
 
 
     @classmethod
-    def deserializeSamlRequest(this, request_qs):
-        """ Deserialize with no verification """
+    def peekIssuer(this, request_qs):
+        """ Cheap look at the SAMLRequest <Issuer> - inflates only the start, no XML parsing """
+
+        if len(request_qs) > MAX_QUERY_STRING:
+            return None
+
+        try:
+            reqargs = parse_qs(request_qs, keep_blank_values=True)
+            deflated = b64decode(reqargs['SAMLRequest'][0])
+            head = zlib.decompressobj(wbits=-15).decompress(deflated, ISSUER_PEEK_SIZE)
+
+        except Exception:
+            return None
+
+        # a hint only - the request must still be checked against its parsed Issuer
+        match = _issuer_re.match(head)
+        return unescape(match.group(1).decode('utf-8', 'replace')) if match else None
+
+
+    @classmethod
+    def inflate(this, deflated):
+        """ Inflate a SAMLRequest, refusing to produce more than MAX_SAML_REQUEST bytes """
+
+        inflater = zlib.decompressobj(wbits=-15)
+        samlRequest = inflater.decompress(deflated, MAX_SAML_REQUEST)
+
+        if inflater.unconsumed_tail:
+            raise Exception(f'SAMLRequest inflates to more than {MAX_SAML_REQUEST} bytes')
+
+        if not inflater.eof:
+            raise Exception('SAMLRequest is truncated')
+
+        return samlRequest.decode()
+
+
+    @classmethod
+    def parseQueryString(this, request_qs):
+        """ Query string arguments, SAMLRequest XML and RelayState - size limited """
+
+        if len(request_qs) > MAX_QUERY_STRING:
+            raise Exception(f'Query string longer than {MAX_QUERY_STRING} bytes')
 
         reqargs = parse_qs(request_qs, keep_blank_values=True)
         
         if 'SAMLRequest' not in reqargs:
             raise Exception('Deserialization - SAMLRequest parameter missing')
-        
-        # decode and deflate SAMLRequest XML        
-        samlRequest = zlib.decompress(
-                b64decode(reqargs['SAMLRequest'][0]),
-                wbits=-15,
-            ).decode()
+
+        # decode and inflate SAMLRequest XML
+        samlRequest = this.inflate(b64decode(reqargs['SAMLRequest'][0]))
         
         if 'RelayState' not in reqargs:
             raise Exception(f'RelayState parameter missing')
         
         relayState = reqargs['RelayState'][0] 
 
+        return reqargs, samlRequest, relayState
+
+
+    @classmethod
+    def deserializeSamlRequest(this, request_qs):
+        """ Deserialize with no verification """
+
+        reqargs, samlRequest, relayState = this.parseQueryString(request_qs)
+
         return samlRequest, relayState
 
 
     def verifySamlRequest(self, request_qs):
         """ Deserialize http-REDIRECT SAMLRequest and optionally verify signature """
 
-        reqargs = parse_qs(request_qs, keep_blank_values=True)
-        
-        if 'SAMLRequest' not in reqargs:
-            raise Exception('verification - SAMLRequest parameter missing')
+        reqargs, samlRequest, relayState = self.parseQueryString(request_qs)
 
-        # decode and deflate SAMLRequest XML        
-        samlRequest = zlib.decompress(
-                b64decode(reqargs['SAMLRequest'][0]),
-                wbits=-15,
-            ).decode()
-        
-        if 'RelayState' not in reqargs:
-            raise Exception(f'RelayState parameter missing')
-        
-        relayState = reqargs['RelayState'][0] 
-        
-        if self.verifyok:
+        self.verifyQuerySignature(request_qs, reqargs)
+            
+        return samlRequest, relayState
+
+
+    def verifyQuerySignature(self, request_qs, reqargs=None):
+        """ Verify the query string signature only - the SAMLRequest is not inflated again """
+
+        if not self.verifyok:
             # We only verifiy if we have a x509 certificate for this SP
+            return
+
+        if reqargs is None:
+            reqargs = parse_qs(request_qs, keep_blank_values=True)
         
-            if 'Signature' not in reqargs:
-                raise Exception('SAMLRequest is unsigned')
+        if 'Signature' not in reqargs:
+            raise Exception('SAMLRequest is unsigned')
 
-            signature = b64decode(reqargs['Signature'][0])
+        signature = b64decode(reqargs['Signature'][0])
 
-            if 'SigAlg' not in reqargs:
-                raise Exception('SigAlg parameter missing')
-            
-            sigalg = reqargs['SigAlg'][0]
+        if 'SigAlg' not in reqargs:
+            raise Exception('SigAlg parameter missing')
+        
+        sigalg = reqargs['SigAlg'][0]
 
-            if sigalg != dsSigAlgValue:
-                raise Exception(f'Unsupported signature algorithm {sigalg}')
+        if sigalg != dsSigAlgValue:
+            raise Exception(f'Unsupported signature algorithm {sigalg}')
 
-            signed_part = request_qs.split('&Signature')[0]
+        signed_part = request_qs.split('&Signature')[0]
 
-            self.signer.verify(signature, signed_part.encode('utf-8'))
-            
-        return samlRequest, relayState
+        self.signer.verify(signature, signed_part.encode('utf-8'))
         
 
 
@@ -208,7 +341,29 @@ class SamlResponseSigner:
 
         self.signer = _Signer(cert=cert, key=key, password=password)
 
-        self.parser = etree.XMLParser(remove_blank_text=True)
+        # Signers are shared by request threads - each thread parses with its own parser
+        self.parsers = ThreadParsers(remove_blank_text=True)
+
+        # Verification keeps white space - it is covered by the digests
+        self.verify_parsers = ThreadParsers(resolve_entities=False, no_network=True)
+
+
+    @property
+    def parser(self):
+        return self.parsers.get()
+
+
+    @property
+    def verify_parser(self):
+        return self.verify_parsers.get()
+
+
+    def reinit(self):
+        """ Rebuild crypto handles and parsers (e.g. in a forked worker) """
+
+        self.signer.reinit()
+        self.parsers.reinit()
+        self.verify_parsers.reinit()
 
 
     def signSaml(self, saml_response, sign_assertion, sign_response):
@@ -230,10 +385,8 @@ class SamlResponseSigner:
         xmlroot = etree.XML(saml_response,parser=self.parser)
         document_id = xmlroot.attrib['ID']
 
-        c14n_response = etree.tostring(xmlroot, method='c14n2')
-
-        # Calculate digest on body
-        digest_value = self.signer.hash(c14n_response)
+        # Calculate digest on the exclusive c14n of the body
+        digest_value = self.signer.digest(xmlroot)
 
         # Create <ds:SignedInfo> document with ID and calculated digest
         signed_info = self.nodeSignedInfo(document_id, digest_value)
@@ -267,10 +420,8 @@ class SamlResponseSigner:
 
         document_id = xmlroot.attrib['ID']
 
-        c14n_response = etree.tostring(xmlroot, method='c14n2')
-
-        # Calculate digest on body
-        digest_value = self.signer.hash(c14n_response)
+        # Calculate digest on the exclusive c14n of the body
+        digest_value = self.signer.digest(xmlroot)
 
         # Create <ds:SignedInfo> document with ID and calculated digest
         signed_info = self.nodeSignedInfo(document_id, digest_value)
@@ -294,55 +445,133 @@ class SamlResponseSigner:
     def verifySignedSamlResponse(self, saml_response, noexcept=True):
         """ Verify the SAMLResponse has a valid signature """
 
-        return self.verifySamlResponse(saml_response, noexcept) and self.verifySamlAssertion(saml_response, noexcept)
+        try:
+            xmlroot = etree.XML(saml_response, parser=self.verify_parser)
+
+        except Exception as e:
+            if noexcept:
+                return False
+            raise e
+
+        return self.verifyTree(xmlroot, noexcept)
+
+
+    def verifyTree(self, xmlroot, noexcept=True):
+        """ Verify Response and Assertion signatures on one parsed tree (tree is modified) - fails closed
+
+        The Response and its Assertion may each carry an enveloped signature
+        over itself (see verifyReferenced).  At least one must be signed,
+        every such signature must verify, and signatures anywhere else in
+        the tree don't count.
+        """
+
+        assertions = xmlroot.findall(f'./{samlAssertionTag}')
+
+        # Response signature first - its digest covers any Assertion signature
+        signed = [element for element in [xmlroot] + assertions if element.find(f'./{dsSignatureTag}') is not None]
+
+        valid = len(assertions) <= 1 and bool(signed) and all(self.verifyReferenced(element) for element in signed)
+
+        if not valid and not noexcept:
+            raise Exception('SAMLResponse has no valid enveloped <Signature>')
+
+        return valid
+
+
+    def verify_many(self, saml_responses, noexcept=True):
+        """ Verify an iterable of SAMLResponses (XML, or b64 str/bytes), yield True/False for each """
+
+        parser = self.verify_parser
+
+        for saml_response in saml_responses:
+
+            try:
+                if saml_response.lstrip()[:1] not in ('<', b'<'):
+                    saml_response = b64decode(saml_response)
+
+                xmlroot = etree.XML(saml_response, parser=parser)
+
+            except Exception as e:
+                if noexcept:
+                    yield False
+                    continue
+                raise e
+
+            yield self.verifyTree(xmlroot, noexcept)
 
 
     def verifySamlResponse(self, saml_response, noexcept=True):
-        """ Verify signed SAMLResponse Response """
+        """ Verify the enveloped signature of the SAMLResponse Response """
 
-        xmlroot = etree.XML(saml_response)
+        xmlroot = etree.XML(saml_response, parser=self.verify_parser)
 
-        # Validate there is at least one signature on the response
-        anysig = xmlroot.find(f'.//{dsSignatureTag}')
-        if anysig is None:
+        if not self.verifyReferenced(xmlroot):
             if noexcept:
                 return False
-            raise Exception('No <Signature> found on SAMLRequest')
+            raise Exception('No valid <Signature> on the Response')
+
+        return True
+
 
-        # Remove <ds:Signature> from response
-        sigroot = xmlroot.find(f'./{dsSignatureTag}')
+    def verifySamlAssertion(self, saml_response, noexcept=True):
+        """ Verify the enveloped signature of the SAMLResponse Assertion """
 
-        if sigroot is not None:
-            xmlroot.remove(sigroot)
+        xmlroot = etree.XML(saml_response, parser=self.verify_parser)
+        assertion = xmlroot.find(f'./{samlAssertionTag}')
 
-            # Calculate digest on saml_response
-            c14n_response = etree.tostring(xmlroot,method='c14n2')
-            hash_value = b64encode(self.signer.hash(c14n_response)).decode()
-            # verify signed info
-            return self.verifySignature(sigroot, hash_value, noexcept=noexcept)
+        if assertion is None or not self.verifyReferenced(assertion):
+            if noexcept:
+                return False
+            raise Exception('No valid <Signature> on the Assertion')
 
-        # Response is not signed
         return True
 
 
-    def verifySamlAssertion(self, saml_response, noexcept=True):
-        """ Verify signed SAMLResponse Assertions """
+    def verifyEnveloped(self, xmlroot, noexcept=True):
+        """ Verify (and remove) the enveloped <ds:Signature> of an element - unsigned is invalid
 
-        xmlroot = etree.XML(saml_response)
+        The Reference is not checked here - use verifyReferenced.
+        """
 
-        sigroot = xmlroot.find(f'./{samlAssertionTag}/{dsSignatureTag}')
+        sigroot = xmlroot.find(f'./{dsSignatureTag}') if xmlroot is not None else None
 
-        if sigroot is not None:
-            asseroot = xmlroot.find(f'./{samlAssertionTag}')
-            asseroot.remove(sigroot)
+        if sigroot is None:
+            if noexcept:
+                return False
+            raise Exception('Element has no enveloped <Signature>')
 
-            c14n_assertions = etree.tostring(asseroot,method='c14n2')
-            hash_value = b64encode(self.signer.hash(c14n_assertions)).decode()
-            
-            return self.verifySignature(sigroot, hash_value, noexcept=noexcept)
+        xmlroot.remove(sigroot)
 
-        # Assertion is not signed        
-        return True
+        # Calculate digest on the element without its signature
+        hash_value = b64encode(self.signer.digest(xmlroot)).decode()
+
+        # verify signed info
+        return self.verifySignature(sigroot, hash_value, noexcept=noexcept)
+
+
+    def verifyReferenced(self, xmlroot):
+        """ True only if the element carries a valid enveloped signature over itself - fails closed
+
+        The <ds:Signature> must be a direct child and its single Reference
+        must point at the element's own ID - a signature anywhere else in
+        the tree (e.g. an empty one in <Extensions>) doesn't count.
+        """
+
+        try:
+            sigroot = xmlroot.find(f'./{dsSignatureTag}')
+            if sigroot is None:
+                return False
+
+            element_id = xmlroot.get('ID')
+            references = sigroot.findall(f'./{dsSignedInfoTag}/{dsReferenceTag}')
+
+            if not element_id or len(references) != 1 or references[0].get('URI') != '#' + element_id:
+                return False
+
+            return self.verifyEnveloped(xmlroot, noexcept=True) is True
+
+        except Exception:
+            return False
 
 
     def verifySignature(self, sigroot, response_digest, noexcept=True):
@@ -353,16 +582,12 @@ class SamlResponseSigner:
             x509_cert = sigroot.find(f'.//{dsX509CertificateTag}').text
             self.signer.validateCert(x509_cert)
             
-            # Get the <ds:SignedInfo> as XML
+            # Canonicalize <ds:SignedInfo> in place, as advertised by its CanonicalizationMethod
             signed_info = sigroot.find(f'./{dsSignedInfoTag}')
-            
-            # play games to get c14n2 of the <SignedInfo> subtree
-            signed_info_xml = etree.tostring(signed_info,method='xml')
-            sinforoot = etree.XML(signed_info_xml)
-            signed_info_xml = etree.tostring(sinforoot, method='c14n2')
+            signed_info_xml = etree.tostring(signed_info, method='c14n', exclusive=True, with_comments=False)
             
             # Validate the signature for <SignedInfo>
-            signature_value = sigroot.find(f'.//{dsSignatureValueTag}').text
+            signature_value = sigroot.find(f'./{dsSignatureValueTag}').text
             self.signer.verify(b64decode(signature_value), signed_info_xml)
         
             # Return digest value
@@ -0,0 +1,135 @@
+from calendar import timegm
+from collections import deque, namedtuple
+from datetime import datetime
+import heapq
+import threading
+import time
+
+from .ResponseTemplate import TIMEFORMAT
+
+SsoSession = namedtuple('SsoSession', 'session_index idp sp principal nameid format expires')
+
+# Apply queued writes once this many are waiting
+DRAIN_BATCH = 256
+
+
+class   SessionRegistry:
+    """ Issued SSO sessions indexed by SessionIndex, principal, NameID and SP
+
+    The principal is the authenticated user - transient and pairwise
+    NameIDs differ per SP and per login, so only the principal finds
+    every SP a user is signed in to.  record() only appends to a queue (atomic, no lock) so the response
+    path never waits on the indexes.  Queued writes are applied in
+    batches, and before every lookup.  Sessions are evicted when their
+    assertion's NotOnOrAfter passes, so memory tracks active sessions.
+    """
+
+    def __init__(self):
+
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+        self.sessions = {}
+        self.by_principal = {}
+        self.by_nameid = {}
+        self.by_sp = {}
+        self.expiry = []
+
+
+    def record(self, idp_id, sp_id, principal, nameid, nameid_format, session_index, not_on_or_after):
+        """ Queue an issued session (not_on_or_after is the assertion's SAML time string) """
+
+        self.pending.append((idp_id, sp_id, principal, nameid, nameid_format, session_index, not_on_or_after))
+
+        if len(self.pending) >= DRAIN_BATCH and self.lock.acquire(blocking=False):
+            try:
+                self._drain()
+            finally:
+                self.lock.release()
+
+
+    def _drain(self):
+        """ Apply queued writes and evict expired sessions (lock held) """
+
+        while self.pending:
+            idp_id, sp_id, principal, nameid, nameid_format, session_index, not_on_or_after = self.pending.popleft()
+
+            expires = timegm(datetime.strptime(not_on_or_after, TIMEFORMAT).timetuple())
+            sso = SsoSession(session_index, idp_id, sp_id, principal, nameid, nameid_format, expires)
+
+            self._remove(session_index)
+            self.sessions[session_index] = sso
+            if principal is not None:
+                self.by_principal.setdefault(principal, set()).add(session_index)
+            self.by_nameid.setdefault(nameid, set()).add(session_index)
+            self.by_sp.setdefault(sp_id, set()).add(session_index)
+            heapq.heappush(self.expiry, (expires, session_index))
+
+        now = time.time()
+        while self.expiry and self.expiry[0][0] <= now:
+            expires, session_index = heapq.heappop(self.expiry)
+            sso = self.sessions.get(session_index)
+            if sso is not None and sso.expires <= now:
+                self._remove(session_index)
+
+
+    def _remove(self, session_index):
+        """ Remove a session from all indexes (lock held) """
+
+        sso = self.sessions.pop(session_index, None)
+        if sso is None:
+            return None
+
+        for index, key in ((self.by_principal, sso.principal), (self.by_nameid, sso.nameid), (self.by_sp, sso.sp)):
+            entries = index.get(key)
+            if entries is not None:
+                entries.discard(session_index)
+                if not entries:
+                    del index[key]
+
+        return sso
+
+
+    def _lookup(self, index, key):
+
+        with self.lock:
+            self._drain()
+            return [self.sessions[si] for si in index.get(key, ())]
+
+
+    def get(self, session_index):
+        """ Session for a SessionIndex, or None """
+
+        with self.lock:
+            self._drain()
+            return self.sessions.get(session_index)
+
+
+    def byPrincipal(self, principal):
+        """ Sessions issued to a user (i.e. which SPs is this user signed in to) """
+        return self._lookup(self.by_principal, principal)
+
+
+    def byNameId(self, nameid):
+        """ Sessions issued to a NameID (e.g. the subject of an SP's LogoutRequest) """
+        return self._lookup(self.by_nameid, nameid)
+
+
+    def bySp(self, sp_id):
+        """ Sessions issued to an SP """
+        return self._lookup(self.by_sp, sp_id)
+
+
+    def remove(self, session_index):
+        """ Forget a session (e.g. after logout or revocation) """
+
+        with self.lock:
+            self._drain()
+            return self._remove(session_index)
+
+
+    def __len__(self):
+
+        with self.lock:
+            self._drain()
+            return len(self.sessions)
@@ -0,0 +1,238 @@
+from hashlib import blake2b
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+
+from .StateBackend import StateBackend
+
+# File header: magic, slot count, key size, value size
+_HEADER = struct.Struct('<8sIHI')
+_HEADER_SIZE = 32
+_MAGIC = b'SAMLTBL1'
+
+# Slot header: state, expiry (epoch seconds), key hash, key length, value length
+_SLOT = struct.Struct('<BdQHI')
+
+_EMPTY = 0
+_USED = 1
+_DELETED = 2
+
+# Give up after this many probes - keeps every operation O(1)
+MAX_PROBES = 64
+
+
+class   SharedTable(StateBackend):
+    """ Fixed size open-addressing hash table in a shared mmap file
+
+    Every process on the host that opens the same path sees the same
+    table - e.g. gunicorn workers share replay IDs and pending logins
+    without a network hop.  Each slot carries its own expiry; expired
+    slots are reused.  Keys and values are str or bytes up to the sizes
+    fixed when the file was created - longer keys are stored as their
+    digest.
+    """
+
+    def __init__(self, path, slots=65536, key_size=128, value_size=8192):
+
+        self.path = path
+        self.slot_size = _SLOT.size + key_size + value_size
+
+        self.open(slots, key_size, value_size)
+
+
+    @classmethod
+    def fromConfig(this, shared_config):
+        """ SharedTable from idp_config['shared_state'], None if not configured """
+
+        if not shared_config:
+            return None
+
+        return this(
+            shared_config['path'],
+            slots=shared_config.get('slots', 65536),
+            key_size=shared_config.get('key_size', 128),
+            value_size=shared_config.get('value_size', 8192),
+        )
+
+
+    def open(self, slots, key_size, value_size):
+        """ Open (creating if needed) and map the table file """
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = _HEADER_SIZE + slots * self.slot_size
+
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, size)
+                os.pwrite(fd, _HEADER.pack(_MAGIC, slots, key_size, value_size), 0)
+
+            magic, fslots, fkey_size, fvalue_size = _HEADER.unpack(os.pread(fd, _HEADER.size, 0))
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+        if magic != _MAGIC or (fslots, fkey_size, fvalue_size) != (slots, key_size, value_size):
+            os.close(fd)
+            raise Exception(f'Shared table {self.path} exists with a different layout')
+
+        self.fd = fd
+        self.map = mmap.mmap(fd, size, mmap.MAP_SHARED)
+        self.slots = slots
+        self.key_size = key_size
+        self.value_size = value_size
+
+        # flock excludes other processes, this excludes our own threads
+        self.lock = threading.Lock()
+
+
+    def reinit(self):
+        """ Reopen after fork - a flock on an inherited descriptor excludes nothing """
+
+        self.map.close()
+        os.close(self.fd)
+        self.open(self.slots, self.key_size, self.value_size)
+
+
+    def _locked(self):
+        return _TableLock(self)
+
+
+    def _probe(self, key, now):
+        """ Return (slot offset of key or None, first reusable slot offset or None) """
+
+        khash = int.from_bytes(blake2b(key, digest_size=8).digest(), 'little')
+        index = khash % self.slots
+        free = None
+
+        for _ in range(min(MAX_PROBES, self.slots)):
+
+            offset = _HEADER_SIZE + index * self.slot_size
+            state, expiry, shash, klen, vlen = _SLOT.unpack_from(self.map, offset)
+
+            if state == _EMPTY:
+                return None, free if free is not None else offset
+
+            if state == _USED and expiry > now:
+                if shash == khash and self.map[offset + _SLOT.size:offset + _SLOT.size + klen] == key:
+                    return offset, free
+
+            elif free is None:
+                # deleted or expired - reusable
+                free = offset
+
+            index = (index + 1) % self.slots
+
+        return None, free
+
+
+    def _write(self, offset, key, value, ttl):
+
+        khash = int.from_bytes(blake2b(key, digest_size=8).digest(), 'little')
+        _SLOT.pack_into(self.map, offset, _USED, time.time() + ttl, khash, len(key), len(value))
+
+        start = offset + _SLOT.size
+        self.map[start:start + len(key)] = key
+        start += self.key_size
+        self.map[start:start + len(value)] = value
+
+
+    def _read(self, offset):
+
+        state, expiry, shash, klen, vlen = _SLOT.unpack_from(self.map, offset)
+        start = offset + _SLOT.size + self.key_size
+        return self.map[start:start + vlen]
+
+
+    def _check(self, key, value=b''):
+
+        if type(key) is str:
+            key = key.encode('utf-8')
+        if type(value) is str:
+            value = value.encode('utf-8')
+
+        if len(key) > self.key_size:
+            # stand in a digest rather than fail every request carrying it
+            key = blake2b(key, digest_size=min(32, self.key_size)).digest()
+        if len(value) > self.value_size:
+            raise Exception(f'Shared table value longer than {self.value_size} bytes')
+
+        return key, value
+
+
+    def get(self, key):
+        """ Return value (bytes) or None """
+
+        key, _ = self._check(key)
+
+        with self._locked():
+            offset, _ = self._probe(key, time.time())
+            return None if offset is None else self._read(offset)
+
+
+    def set(self, key, value, ttl):
+        """ Store value for ttl seconds """
+
+        key, value = self._check(key, value)
+
+        with self._locked():
+            offset, free = self._probe(key, time.time())
+
+            if offset is None:
+                offset = free
+                if offset is None:
+                    raise Exception('Shared table is full')
+
+            self._write(offset, key, value, ttl)
+
+
+    def add(self, key, ttl, value=b''):
+        """ Store key only if absent - False if it is already present (e.g. a replay) """
+
+        key, value = self._check(key, value)
+
+        with self._locked():
+            offset, free = self._probe(key, time.time())
+
+            if offset is not None:
+                return False
+
+            if free is None:
+                raise Exception('Shared table is full')
+
+            self._write(free, key, value, ttl)
+            return True
+
+
+    def pop(self, key):
+        """ Remove and return value (bytes), or None """
+
+        key, _ = self._check(key)
+
+        with self._locked():
+            offset, _ = self._probe(key, time.time())
+
+            if offset is None:
+                return None
+
+            value = self._read(offset)
+            self.map[offset] = _DELETED
+            return value
+
+
+
+class   _TableLock:
+    """ Thread and process exclusive lock on a SharedTable """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        self.table.lock.acquire()
+        fcntl.flock(self.table.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        fcntl.flock(self.table.fd, fcntl.LOCK_UN)
+        self.table.lock.release()
@@ -0,0 +1,140 @@
+"""
+Concurrent signing stress test and benchmark
+
+    python -m SamlIdP.SignerStress [options]
+
+Signs generated SAMLResponses from 1, 2, 4 ... threads sharing one
+SamlResponseSigner, as request threads share IdPservice.signer under
+gunicorn gthread or mod_wsgi threads.  RSA PKCS#1 v1.5 signatures are
+deterministic, so every output must be byte for byte the one signed
+single threaded, and must verify - a parser or digest state shared
+between threads shows up as a mismatch.  One JSON line is written per
+thread count with its throughput and speedup over one thread.
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+from importlib import import_module
+from random import Random
+import json
+import sys
+import threading
+import time
+
+from .AttributePolicy import AttributeReleasePolicy
+from .Differential import DIFF_IDP_URL, DiffTarget, randomCase, referenceEngine
+from .KeySet import KeySet
+from .RequestDecoder import RequestDecoder
+from .ResponseTemplate import FixedClock
+
+
+class   _Unsigned(DiffTarget):
+    """ Target whose responses come back unsigned """
+
+    def signResponse(self, saml_response, sign_assertion=False, sign_response=True):
+        return saml_response
+
+
+def unsignedCases(idp_id, count, seed=0):
+    """ [(unsigned SAMLResponse, sign_assertion)] for generated AuthnRequests """
+
+    rnd = Random(seed)
+    cases = []
+
+    for index in range(count):
+        case = randomCase(rnd)
+        saml_request = RequestDecoder(DIFF_IDP_URL, case['request_qs'].encode('utf-8'))
+
+        target = _Unsigned(idp_id, saml_request.issuer, saml_request.acs, None,
+            AttributeReleasePolicy(list(case['attributes'])), nameid_attr=case['nameid_attr'])
+
+        unsigned = referenceEngine(case['request_qs'].encode('utf-8'), case['attributes'], target, FixedClock(datetime(2000, 1, 1), seed=index))
+        cases.append((unsigned, case['sign_assertion']))
+
+    return cases
+
+
+def run(signer, cases, threads, rounds=1):
+    """ Sign every case rounds times across threads, return ({index: [outputs]}, seconds, errors) """
+
+    outputs = {index: [] for index in range(len(cases))}
+    errors = []
+    start = threading.Barrier(threads + 1)
+
+    def worker(offset):
+
+        start.wait()
+        for _ in range(rounds):
+            for index in range(offset, len(cases), threads):
+                unsigned, sign_assertion = cases[index]
+                try:
+                    outputs[index].append(signer.signSaml(unsigned, sign_assertion, True))
+                except Exception as e:
+                    errors.append(f'case {index}: {str(e)}')
+
+    workers = [threading.Thread(target=worker, args=(n,), name=f'samlidp-stress-{n}') for n in range(threads)]
+    for thread in workers:
+        thread.start()
+
+    start.wait()
+    began = time.perf_counter()
+
+    for thread in workers:
+        thread.join()
+
+    return outputs, time.perf_counter() - began, errors
+
+
+def stress(signer, cases, thread_counts=(1, 2, 4, 8), rounds=1):
+    """ Summary per thread count - mismatched, unverified and errors must all be 0 """
+
+    expected = [signer.signSaml(unsigned, sign_assertion, True) for unsigned, sign_assertion in cases]
+    verified = [signer.verifySignedSamlResponse(signed) for signed in expected]
+
+    base = None
+    summaries = []
+
+    for threads in thread_counts:
+
+        outputs, seconds, errors = run(signer, cases, threads, rounds)
+
+        responses = sum(len(signed) for signed in outputs.values())
+        per_second = responses / seconds if seconds else None
+        base = base or per_second
+
+        summaries.append({
+            'threads': threads,
+            'responses': responses,
+            'responses_per_second': round(per_second, 1) if per_second else None,
+            'speedup': round(per_second / base, 2) if per_second and base else None,
+            'mismatched': sum(1 for index, signed in outputs.items() for output in signed if output != expected[index]),
+            'unverified': sum(1 for ok in verified if not ok),
+            'errors': len(errors),
+        })
+
+    return summaries
+
+
+def main(argv=None):
+
+    parser = ArgumentParser(description='Sign SAMLResponses from concurrent threads sharing one signer')
+    parser.add_argument('--config', default='config', help='module containing idp_config (default: config)')
+    parser.add_argument('--cases', type=int, default=200, help='generated responses (default: 200)')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8], help='thread counts (default: 1 2 4 8)')
+    parser.add_argument('--rounds', type=int, default=5, help='times each thread count signs every response (default: 5)')
+    parser.add_argument('--seed', type=int, default=0, help='seed for generated cases')
+
+    args = parser.parse_args(argv)
+
+    idp_config = import_module(args.config).idp_config
+    signer = KeySet.fromConfig(idp_config).active
+
+    failed = 0
+    for summary in stress(signer, unsignedCases(idp_config['entityId'], args.cases, args.seed), args.threads, args.rounds):
+        print(json.dumps(summary))
+        failed += summary['mismatched'] + summary['unverified'] + summary['errors']
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
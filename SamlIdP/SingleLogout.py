@@ -0,0 +1,124 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging as logger
+
+from lxml import etree
+import xmltodict
+
+from .constants import *
+from .ResponseTemplate import samlLogoutRequestTemplate
+from .SPservice import SamlSPservice
+
+samlpStatusCodeTag = '{urn:oasis:names:tc:SAML:2.0:protocol}StatusCode'
+
+# Back-channel calls for all logouts share one bounded pool (threads start on the first submit)
+SLO_MAX_WORKERS = 16
+_pool = ThreadPoolExecutor(SLO_MAX_WORKERS, thread_name_prefix='samlidp-slo')
+
+
+def reinitPool():
+    """ Fresh pool in a forked worker - its threads aren't inherited """
+
+    global _pool
+    _pool = ThreadPoolExecutor(SLO_MAX_WORKERS, thread_name_prefix='samlidp-slo')
+
+
+def soapTransport(url, soap_request, timeout):
+    """ POST a SOAP message, return the response body """
+
+    from requests import post
+
+    res = post(url, data=soap_request, timeout=timeout, headers={
+        'Content-Type': 'text/xml; charset=utf-8',
+        'SOAPAction': 'http://www.oasis-open.org/committees/security',
+    })
+
+    if not res.ok:
+        raise Exception(f'SLO endpoint error: {res.status_code} {res.reason}')
+
+    return res.content
+
+
+
+class   SingleLogout:
+    """ Back-channel SAML Single Logout to every SP a user signed in to
+
+    Participants are recorded by ResponseHandler as dicts of sp, nameid,
+    format and session_index.  Signed <LogoutRequest>s go out concurrently,
+    so a logout takes as long as the slowest SP rather than the sum.
+    The transport is a callable(url, soap_request, timeout) -> bytes and
+    can be replaced by a local stand-in (SamlIdP's slo_transport).
+    """
+
+    def __init__(self, idP, transport=None):
+
+        self.idP = idP
+        self.transport = transport or soapTransport
+
+
+    def logoutRequest(self, sp, participant, url):
+        """ Signed <LogoutRequest> for one participant, SOAP wrapped """
+
+        root = samlLogoutRequestTemplate()
+        req = root['samlp:LogoutRequest']
+
+        req['@Destination'] = url
+        req['Issuer']['#text'] = self.idP.idp_id
+        req['NameID']['@Format'] = participant['format']
+        req['NameID']['#text'] = participant['nameid']
+        req['samlp:SessionIndex'] = participant['session_index']
+
+        saml_data = xmltodict.unparse(root, full_document=False).encode('utf-8')
+        signed = self.idP.signer.signSamlResponse(saml_data)
+
+        return b'<SOAP-ENV:Envelope xmlns:SOAP-ENV="' + soapEnvelopeNS.encode() + b'"><SOAP-ENV:Body>' \
+            + signed + b'</SOAP-ENV:Body></SOAP-ENV:Envelope>'
+
+
+    def notify(self, sp, participant):
+        """ Send LogoutRequest to one SP, return its status """
+
+        url = sp.slo[0]
+        soap_response = self.transport(url, self.logoutRequest(sp, participant, url), sp.slo_timeout)
+
+        status = etree.XML(soap_response, parser=etree.XMLParser(resolve_entities=False, no_network=True)).find(f'.//{samlpStatusCodeTag}')
+
+        return status.get('Value') if status is not None else None
+
+
+    def logout(self, participants):
+        """ Log participants out of their SPs, return {(sp_id, session_index): status or error} """
+
+        futures = {}
+        timeout = 0
+
+        for participant in participants:
+
+            sp = SamlSPservice.getSamlSP(participant['sp'], self.idP.idp_id)
+
+            if sp is None or not sp.slo:
+                continue
+
+            # an SP can hold several sessions of the user (other browsers)
+            futures[_pool.submit(self.notify, sp, participant)] = (sp.sp_id, participant['session_index'])
+            timeout = max(timeout, sp.slo_timeout)
+
+        done, not_done = wait(futures, timeout=timeout + 1)
+
+        results = {}
+        for future in done:
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = f'error: {str(e)}'
+
+        for future in not_done:
+            results[futures[future]] = 'error: timeout'
+
+        for (sp_id, session_index), status in results.items():
+            if status != SamlStatusSuccess:
+                logger.info(f'Single Logout from {sp_id} session {session_index}: {status}')
+
+        for participant in participants:
+            self.idP.sessions.remove(participant['session_index'])
+
+        return results
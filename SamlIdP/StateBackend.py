@@ -0,0 +1,455 @@
+from collections import OrderedDict
+import logging as logger
+import queue
+import socket
+import threading
+import time
+
+from .Counters import Counters
+
+
+class   StateUnavailable(ConnectionError):
+    """ The state backend can't be reached """
+    pass
+
+
+
+class   StateBackend:
+    """ Key/value state with per-key expiry - pending logins, replay IDs, tokens
+
+    Keys are str, values str or bytes (always returned as bytes).
+    execute() runs a batch of operations in one round trip where the
+    backend supports it; the default runs them one by one.
+    """
+
+    def get(self, key):
+        """ Return value (bytes) or None """
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        """ Store value for ttl seconds """
+        raise NotImplementedError
+
+    def add(self, key, ttl, value=b''):
+        """ Store key only if absent - False if it is already present (e.g. a replay) """
+        raise NotImplementedError
+
+    def pop(self, key):
+        """ Remove and return value (bytes), or None """
+        raise NotImplementedError
+
+    def expire(self, key, ttl):
+        """ Reset the time to live of a key - False if it is absent """
+
+        value = self.get(key)
+        if value is None:
+            return False
+
+        self.set(key, value, ttl)
+        return True
+
+    def execute(self, operations):
+        """ Run (method name, args) operations, return their results """
+        return [getattr(self, name)(*args) for name, args in operations]
+
+    def reinit(self):
+        """ Rebuild what isn't fork safe """
+        pass
+
+
+
+def _bytes(value):
+    return value.encode('utf-8') if type(value) is str else value
+
+
+class   LocalState(StateBackend):
+    """ State in this process only - expired and least recently used keys are dropped """
+
+    def __init__(self, size=100000):
+
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def _live(self, key, now):
+        """ (expiry, value) of a live key or None (lock held) """
+
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] <= now:
+            del self.entries[key]
+            return None
+        return entry
+
+
+    def _store(self, key, value, ttl, now):
+
+        self.entries[key] = (now + ttl, _bytes(value))
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+    def get(self, key):
+
+        with self.lock:
+            entry = self._live(key, time.monotonic())
+            return None if entry is None else entry[1]
+
+
+    def set(self, key, value, ttl):
+
+        with self.lock:
+            self._store(key, value, ttl, time.monotonic())
+
+
+    def add(self, key, ttl, value=b''):
+
+        with self.lock:
+            now = time.monotonic()
+            if self._live(key, now) is not None:
+                return False
+
+            self._store(key, value, ttl, now)
+            return True
+
+
+    def pop(self, key):
+
+        with self.lock:
+            entry = self._live(key, time.monotonic())
+            if entry is None:
+                return None
+
+            del self.entries[key]
+            return entry[1]
+
+
+    def expire(self, key, ttl):
+
+        with self.lock:
+            now = time.monotonic()
+            entry = self._live(key, now)
+            if entry is None:
+                return False
+
+            self._store(key, entry[1], ttl, now)
+            return True
+
+
+
+class   RedisState(StateBackend):
+    """ State in a Redis (RESP protocol) server shared by every node
+
+    Connections come from a bounded pool - a request waits up to timeout
+    for one rather than opening more.  Batches are sent in one write
+    and their replies read back together.  Connection failures raise
+    StateUnavailable.  pop() uses GETDEL (Redis 6.2 or later).
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, prefix='samlidp:', pool_size=8, timeout=1.0):
+
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.prefix = prefix
+        self.pool_size = pool_size
+        self.timeout = timeout
+
+        self.reinit()
+
+
+    def reinit(self):
+        """ Fresh pool - sockets inherited over a fork must not be shared """
+
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(self.pool_size)
+
+
+    def connect(self):
+
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        except OSError as e:
+            raise StateUnavailable(f'Redis {self.host}:{self.port} unreachable: {str(e)}')
+
+        conn = _RespConnection(sock)
+
+        setup = []
+        if self.password:
+            setup.append((b'AUTH', self.password))
+        if self.db:
+            setup.append((b'SELECT', self.db))
+
+        if setup:
+            try:
+                conn.call(setup)
+            except Exception:
+                conn.close()
+                raise
+
+        return conn
+
+
+    def call(self, commands):
+        """ Send commands in one write, return their replies """
+
+        if not self.slots.acquire(timeout=self.timeout):
+            raise StateUnavailable('Redis connection pool exhausted')
+
+        conn = None
+        try:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+
+            replies = conn.call(commands)
+
+        except StateUnavailable:
+            raise
+
+        except (OSError, EOFError) as e:
+            if conn is not None:
+                conn.close()
+            raise StateUnavailable(f'Redis {self.host}:{self.port} failed: {str(e)}')
+
+        except Exception:
+            if conn is not None:
+                conn.close()
+            raise
+
+        else:
+            self.idle.put(conn)
+            return replies
+
+        finally:
+            self.slots.release()
+
+
+    def command(self, name, args):
+        """ RESP command for a StateBackend operation """
+
+        key = self.prefix + args[0]
+
+        if name == 'get':
+            return (b'GET', key)
+        if name == 'set':
+            return (b'SET', key, args[1], b'EX', max(1, int(args[2])))
+        if name == 'add':
+            return (b'SET', key, args[2] if len(args) > 2 else b'', b'EX', max(1, int(args[1])), b'NX')
+        if name == 'pop':
+            return (b'GETDEL', key)
+        if name == 'expire':
+            return (b'EXPIRE', key, max(1, int(args[1])))
+
+        raise Exception(f'Unknown state operation {name}')
+
+
+    @staticmethod
+    def result(name, reply):
+
+        if isinstance(reply, RedisError):
+            raise reply
+
+        if name == 'add':
+            return reply is not None
+        if name == 'expire':
+            return reply == 1
+        if name == 'set':
+            return None
+
+        return reply
+
+
+    def execute(self, operations):
+
+        replies = self.call([self.command(name, args) for name, args in operations])
+        return [self.result(name, reply) for (name, args), reply in zip(operations, replies)]
+
+
+    def get(self, key):
+        return self.execute([('get', (key,))])[0]
+
+    def set(self, key, value, ttl):
+        return self.execute([('set', (key, value, ttl))])[0]
+
+    def add(self, key, ttl, value=b''):
+        return self.execute([('add', (key, ttl, value))])[0]
+
+    def pop(self, key):
+        return self.execute([('pop', (key,))])[0]
+
+    def expire(self, key, ttl):
+        return self.execute([('expire', (key, ttl))])[0]
+
+
+
+class   RedisError(Exception):
+    """ Error reply from the server """
+    pass
+
+
+
+class   _RespConnection:
+    """ One socket speaking RESP2 """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+
+
+    @staticmethod
+    def encode(command):
+
+        out = [b'*%d\r\n' % len(command)]
+        for arg in command:
+            if type(arg) is int:
+                arg = str(arg)
+            arg = _bytes(arg)
+            out.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+
+        return b''.join(out)
+
+
+    def read(self):
+
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise EOFError('Redis connection closed')
+
+        kind, body = line[:1], line[1:-2]
+
+        if kind == b'+':
+            return body
+        if kind == b'-':
+            return RedisError(body.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(body)
+        if kind == b'$':
+            size = int(body)
+            if size < 0:
+                return None
+            data = self.reader.read(size + 2)
+            if len(data) != size + 2:
+                raise EOFError('Redis connection closed')
+            return data[:-2]
+        if kind == b'*':
+            size = int(body)
+            return None if size < 0 else [self.read() for _ in range(size)]
+
+        raise EOFError(f'Bad Redis reply {line[:32]}')
+
+
+    def call(self, commands):
+
+        self.sock.sendall(b''.join(self.encode(command) for command in commands))
+        replies = [self.read() for _ in commands]
+
+        for reply in replies:
+            if isinstance(reply, RedisError) and reply.args[0].startswith(('NOAUTH', 'WRONGPASS')):
+                raise reply
+
+        return replies
+
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+
+class   FallbackState(StateBackend):
+    """ A shared backend that degrades to local state while it is unreachable
+
+    After a failure the shared backend is left alone for retry_interval
+    seconds.  Local state is only seen by this process, so while degraded
+    a login finishing on another node fails and replays are only caught
+    per node - but logins keep working on this one.
+    """
+
+    def __init__(self, primary, fallback=None, retry_interval=5):
+
+        self.primary = primary
+        self.fallback = fallback if fallback is not None else LocalState()
+        self.retry_interval = retry_interval
+        self.down_until = 0
+
+        self.counters = Counters('fallbacks')
+
+
+    def execute(self, operations):
+
+        if time.monotonic() >= self.down_until:
+            try:
+                return self.primary.execute(operations)
+
+            except StateUnavailable as e:
+                # logged at most once per retry interval
+                logger.error(f'Shared state unavailable, using local state: {str(e)}')
+                self.down_until = time.monotonic() + self.retry_interval
+
+        self.counters.add('fallbacks')
+        return self.fallback.execute(operations)
+
+
+    def get(self, key):
+        return self.execute([('get', (key,))])[0]
+
+    def set(self, key, value, ttl):
+        return self.execute([('set', (key, value, ttl))])[0]
+
+    def add(self, key, ttl, value=b''):
+        return self.execute([('add', (key, ttl, value))])[0]
+
+    def pop(self, key):
+        return self.execute([('pop', (key,))])[0]
+
+    def expire(self, key, ttl):
+        return self.execute([('expire', (key, ttl))])[0]
+
+    def reinit(self):
+        self.primary.reinit()
+        self.counters.reinit()
+        self.fallback.reinit()
+
+
+
+def createStateBackend(idp_config):
+    """ StateBackend from idp_config['state_backend'] (or the older 'shared_state'), None if neither
+
+        {'type': 'redis', 'host': ..., 'port': 6379, 'pool_size': 8, 'timeout': 1.0, 'fallback': True}
+        {'type': 'shared', 'path': '/dev/shm/samlidp.tbl', ...}     # SharedTable, one host
+        {'type': 'local'}                                          # this process only
+    """
+
+    from .SharedTable import SharedTable
+
+    state_config = idp_config.get('state_backend')
+
+    if not state_config:
+        return SharedTable.fromConfig(idp_config.get('shared_state'))
+
+    state_config = dict(state_config)
+    kind = state_config.pop('type', 'redis')
+    fallback = state_config.pop('fallback', True)
+    retry_interval = state_config.pop('retry_interval', 5)
+
+    if kind == 'local':
+        return LocalState(**state_config)
+
+    if kind == 'shared':
+        return SharedTable.fromConfig(state_config)
+
+    assert kind == 'redis', f'Config error: unknown state backend {kind}'
+
+    backend = RedisState(**state_config)
+
+    return FallbackState(backend, retry_interval=retry_interval) if fallback else backend
@@ -0,0 +1,127 @@
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from secrets import token_bytes
+import struct
+import time
+import zlib
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from .StateBackend import LocalState
+
+# Pending request tokens are recognized by this prefix
+TOKEN_PREFIX = 'SAT.'
+
+_epoch = struct.Struct('>I')
+_expires = struct.Struct('>Q')
+
+
+class   PendingRequestCodec:
+    """ Carry a frozen SAMLRequest through primary authentication in an encrypted token
+
+    token = 'SAT.' + b64url(epoch | nonce | AES-GCM(expiry | deflated request))
+
+    The AES key rotates every `rotation` seconds - each epoch's key is
+    derived (HKDF) from the configured secret, so every node computes the
+    same keys with no coordination.  Tokens from the current and previous
+    epoch are accepted, so rotation must be longer than ttl.
+
+    Tokens are single use: the nonce of a decoded token is recorded in
+    the IdP's state store, or - without one - in this process only.
+    """
+
+    def __init__(self, idp_id, secret, rotation=3600, ttl=900):
+
+        assert secret and len(secret) >= 32, 'Config error: stateless secret must be at least 32 bytes'
+        assert rotation > ttl, 'Config error: stateless key rotation must be longer than the token ttl'
+
+        self.idp_id = idp_id.encode('utf-8')
+        self.secret = secret if type(secret) is bytes else secret.encode('utf-8')
+        self.rotation = rotation
+        self.ttl = ttl
+
+        self.keys = {}
+
+        # nonces of used tokens when there is no shared state store
+        self.used = LocalState()
+
+
+    @classmethod
+    def fromConfig(this, idp_id, stateless_config):
+        """ PendingRequestCodec from idp_config['stateless'], None if not configured """
+
+        if not stateless_config:
+            return None
+
+        return this(
+            idp_id,
+            stateless_config['secret'],
+            rotation=stateless_config.get('rotation', 3600),
+            ttl=stateless_config.get('ttl', 900),
+        )
+
+
+    def key(self, epoch):
+        """ AES-GCM for an epoch (cached - only two are ever live) """
+
+        aes = self.keys.get(epoch)
+
+        if aes is None:
+            key = HKDF(
+                algorithm=hashes.SHA256(),
+                length=32,
+                salt=None,
+                info=b'samlidp-pending|' + self.idp_id + b'|' + _epoch.pack(epoch),
+            ).derive(self.secret)
+
+            aes = AESGCM(key)
+            self.keys = {e: k for e, k in self.keys.items() if e >= epoch - 1}
+            self.keys[epoch] = aes
+
+        return aes
+
+
+    def encode(self, frozen):
+        """ Token for a frozen request (str) """
+
+        now = int(time.time())
+        epoch = now // self.rotation
+        nonce = token_bytes(12)
+        header = _epoch.pack(epoch)
+
+        plaintext = _expires.pack(now + self.ttl) + zlib.compress(frozen.encode('utf-8'), 9)
+        ciphertext = self.key(epoch).encrypt(nonce, plaintext, self.idp_id + header)
+
+        return TOKEN_PREFIX + urlsafe_b64encode(header + nonce + ciphertext).decode().rstrip('=')
+
+
+    def decode(self, token, stateStore=None):
+        """ Frozen request (str) from a token - raises if invalid, expired or reused """
+
+        if not token.startswith(TOKEN_PREFIX):
+            raise Exception('Not a pending request token')
+
+        data = token[len(TOKEN_PREFIX):]
+        raw = urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+        header, nonce, ciphertext = raw[:4], raw[4:16], raw[16:]
+        epoch, = _epoch.unpack(header)
+
+        now = int(time.time())
+        if epoch not in (now // self.rotation, now // self.rotation - 1):
+            raise Exception('Pending request token key has expired')
+
+        plaintext = self.key(epoch).decrypt(nonce, ciphertext, self.idp_id + header)
+
+        expires, = _expires.unpack(plaintext[:8])
+        if expires < now:
+            raise Exception('Pending request token has expired')
+
+        if stateStore is None:
+            stateStore = self.used
+
+        if not stateStore.add('pending:' + nonce.hex(), self.ttl):
+            raise Exception('Pending request token has already been used')
+
+        return zlib.decompress(plaintext[8:]).decode('utf-8')
@@ -4,6 +4,8 @@ authCPSSL = 'urn:oasis:names:tc:SAML:2.0:ac:classes:PasswordProtectedTransport'
 authCPAS = 'urn:oasis:names:tc:SAML:2.0:ac:classes:Password'
 
 bindPost = 'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST'
+bindArtifact = 'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Artifact'
+bindSOAP = 'urn:oasis:names:tc:SAML:2.0:bindings:SOAP'
 
 consUndefined = 'urn:oasis:names:tc:SAML:2.0:consent:undefined'
 consImplicit = 'urn:oasis:names:tc:SAML:2.0:consent:current-implicit'
@@ -24,6 +26,10 @@ SamlNameIdEmailAddress = 'urn:oasis:names:tc:SAML:2.0:nameid-format:emailAddress
 SamlNameIdTransient = 'urn:oasis:names:tc:SAML:2.0:nameid-format:transient'
 SamlNameIdPersistent = 'urn:oasis:names:tc:SAML:2.0:nameid-format:persistent'
 
+SamlAttrNameFmtBasic = 'urn:oasis:names:tc:SAML:2.0:attrname-format:basic'
+SamlAttrNameFmtURI = 'urn:oasis:names:tc:SAML:2.0:attrname-format:uri'
+SamlAttrNameFmtUnspecified = 'urn:oasis:names:tc:SAML:2.0:attrname-format:unspecified'
+
 SamlStatusSuccess = 'urn:oasis:names:tc:SAML:2.0:status:Success'
 
 SamlStatusAuthnFailed = 'urn:oasis:names:tc:SAML:2.0:status:AuthnFailed'
@@ -43,10 +49,16 @@ SamlC14nAlgorithm = 'http://www.w3.org/2001/10/xml-exc-c14n#'
 # lxml etree tags
 dsSignatureTag = '{http://www.w3.org/2000/09/xmldsig#}Signature'
 dsSignedInfoTag = '{http://www.w3.org/2000/09/xmldsig#}SignedInfo'
+dsReferenceTag = '{http://www.w3.org/2000/09/xmldsig#}Reference'
 dsDigestValueTag = '{http://www.w3.org/2000/09/xmldsig#}DigestValue'
 dsSignatureValueTag = '{http://www.w3.org/2000/09/xmldsig#}SignatureValue'
 dsX509CertificateTag = '{http://www.w3.org/2000/09/xmldsig#}X509Certificate'
 
+soapEnvelopeNS = 'http://schemas.xmlsoap.org/soap/envelope/'
+soapBodyTag = '{http://schemas.xmlsoap.org/soap/envelope/}Body'
+samlpArtifactResolveTag = '{urn:oasis:names:tc:SAML:2.0:protocol}ArtifactResolve'
+samlpArtifactTag = '{urn:oasis:names:tc:SAML:2.0:protocol}Artifact'
+
 samlAssertionTag = '{urn:oasis:names:tc:SAML:2.0:assertion}Assertion'
 samlIssuerTag = '{urn:oasis:names:tc:SAML:2.0:assertion}Issuer'
 
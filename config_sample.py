@@ -69,19 +69,75 @@ with open(abspath('certs/idp.example.com.crt'),'rb') as f:
 with open(abspath('certs/idp.examle.com.pem'),'rb') as f:
     idp_private_key = f.read()
 
+#
+# Several IdPs (tenants) can share the process - use SamlIdP.tenants() with a
+# list of these, each with its own 'name' and 'url_prefix' (or 'host')
+#
 idp_config = {
     'entityId' : 'https://idp.example.com',
+    # 'name': 'samlidp',
+    # 'url_prefix': '',
     'destination': 'https://idp.examlpe.com/saml2',
     'x509Cert' : idp_cert,
     'priv_key' : idp_private_key,
+    # Additional signing keys for rollover - states are 'next', 'active', 'retiring'
+    # 'signing_keys': [{'x509Cert': next_cert, 'priv_key': next_key, 'state': 'next'}],
+    # JSON file {"active": "<hex sha256 fingerprint>"} watched to switch the active key
+    # 'key_state_file': '/var/tmp/samlidp/keystate.json',
+    # HTTP-Artifact binding store: 'memory' (default) or 'sqlite:<path>'
+    # 'artifact_store': 'sqlite:/var/tmp/samlidp/artifacts.db',
+    # Structured audit log of issued responses - sink is a path, tcp://host:port or unix:///path
+    # backpressure is 'drop' (count and discard when the queue is full) or 'block'
+    # 'audit_log': {'sink': '/var/tmp/samlidp/audit.jsonl', 'queue_size': 10000, 'backpressure': 'drop'},
+    # Shared memory table for replay detection and pending logins (shared by all workers on a host)
+    # 'shared_state': {'path': '/dev/shm/samlidp.tbl', 'slots': 65536, 'value_size': 8192},
+    # Cluster-wide state (replaces shared_state): Redis, falling back to local state while unreachable
+    # 'state_backend': {'type': 'redis', 'host': 'redis.example.com', 'port': 6379, 'pool_size': 8, 'timeout': 0.5, 'fallback': True},
+    # Stateless login: carry the pending request through primary authentication in an
+    # AES-GCM token (keys derived from secret, rotated every 'rotation' seconds)
+    # 'stateless': {'secret': b'at least 32 bytes of random secret!!', 'rotation': 3600, 'ttl': 900},
+    # Attribute resolvers: attributes added to the session's for release, looked up by 'uid'
+    # 'attribute_resolvers': [
+    #     {'type': 'sqlite', 'name': 'entitlements', 'path': 'entitlements.db', 'provides': ['entitlement'],
+    #      'query': 'SELECT entitlement FROM grants WHERE uid = ?', 'timeout': 0.5, 'ttl': 300},
+    #     {'type': 'ldap', 'name': 'directory', 'url': 'ldaps://ldap.example.com', 'base': 'ou=people,dc=example,dc=com',
+    #      'bind_dn': 'cn=idp,dc=example,dc=com', 'password': '...', 'provides': ['mail', 'memberOf']},
+    # ],
+    # 'resolver_principal': 'uid',
+    # 'resolver_cache_size': 10000,
+    # Pairwise persistent NameIDs: HMAC(key, SP entity ID, uid) - SPs may pin 'PairwiseKeyVersion'
+    # 'pairwise_ids': {'keys': {1: b'at least 32 bytes of random secret!!'}, 'current': 1, 'attribute': 'uid'},
+    # Session attribute identifying the user - Single Logout finds all of a user's SP sessions by it
+    # 'principal_attr': 'uid',
+    # Load shedding: per client IP rate limit and concurrent signing limit
+    # 'ip_rate_limit': {'rate': 5, 'burst': 20},
+    # 'max_inflight_signing': 32,
+    # 'export_stats': True,     # counters at /saml2/stats
+    # Duplicate requests from one session within 'window' seconds share the first response
+    # 'coalesce': {'window': 2.0, 'wait': 10.0},
     # SP's - there can be any number of these
     'splist': [{
         'SPEntityId' : 'https://sp.example.com',
         # list of authorizes ACS URLs (fist is the default)
         'ACSList': ['https://sp.example.com/saml2/acs',],
         'RelayState':'',
+        # HTTP-Artifact needs 'sp_cert' - the SP's signed ArtifactResolve is what authenticates it
+        # 'ProtocolBinding': 'urn:oasis:names:tc:SAML:2.0:bindings:HTTP-Artifact',
+        # 'RateLimit': {'rate': 50, 'burst': 100},
+        # Back-channel (SOAP) Single Logout endpoints and per-SP timeout (seconds)
+        # 'SLOList': ['https://sp.example.com/saml2/slo/soap'],
+        # 'SLOTimeout': 5,
         'AuthAttrs': ['uid', 'surname', 'givenname', 'groups', 'suny_global_id'],
         'NameIdAttr': 'emailaddress',
+        # Pairwise NameID key version this SP was provisioned with (persistent format)
+        # 'PairwiseKeyVersion': 1,
+        # Optional attribute release policy (replaces AuthAttrs)
+        # 'AttributePolicy': [
+        #     {'Name': 'uid', 'ReleaseAs': 'urn:oid:0.9.2342.19200300.100.1.1',
+        #       'NameFormat': 'urn:oasis:names:tc:SAML:2.0:attrname-format:uri'},
+        #     {'Name': 'groups', 'Match': '^staff-'},
+        #     {'Name': 'surname'},
+        # ],
     }],
 }
 
@@ -0,0 +1,27 @@
+#
+# gunicorn configuration for a preloaded IdP
+#
+#   gunicorn -c gunicorn_conf_sample.py app:application
+#
+# The app (IdPs, SP registry, certificates, templates) is built once in the
+# master and shared copy-on-write by the workers.  Compare per-worker USS
+# logged by post_fork with preload_app = False to measure the saving.
+#
+from SamlIdP.Preload import preload, post_fork as samlidp_post_fork, unique_memory
+
+bind = '127.0.0.1:8001'
+workers = 4
+preload_app = True
+
+
+def when_ready(server):
+    # runs in the master, before the first worker is forked
+    preload(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    samlidp_post_fork()
+
+
+def post_worker_init(worker):
+    worker.log.info(f'Worker {worker.pid} ready: USS {unique_memory()} kB')
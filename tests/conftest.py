@@ -0,0 +1,149 @@
+from datetime import datetime, timedelta
+
+from importlib.util import find_spec
+import time
+
+import pytest
+
+# The package needs its runtime dependencies - without them there is nothing to test
+if not all(find_spec(name) for name in ('flask', 'lxml', 'xmltodict', 'cryptography')):
+    collect_ignore_glob = ['test_*.py']
+
+
+def make_keypair(common_name='test'):
+    """ (PEM certificate, PEM private key) of a throwaway self-signed RSA key """
+
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+
+    cert = x509.CertificateBuilder() \
+        .subject_name(name) \
+        .issuer_name(name) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(datetime.utcnow() - timedelta(days=1)) \
+        .not_valid_after(datetime.utcnow() + timedelta(days=1)) \
+        .sign(key, hashes.SHA256())
+
+    return (
+        cert.public_bytes(serialization.Encoding.PEM),
+        key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()),
+    )
+
+
+@pytest.fixture(scope='session')
+def keypair():
+    return make_keypair('idp')
+
+
+@pytest.fixture(scope='session')
+def sp_keypair():
+    return make_keypair('sp')
+
+
+class   FakeAuth:
+    """ Primary authentication stand-in - login only records what was asked for """
+
+    def __init__(self):
+        self.after_auth_hooks = {}
+        self.is_authenticated = False
+        self.logins = []
+
+    def initiate_login(self, **kwargs):
+        self.logins.append(kwargs)
+        return 'LOGIN'
+
+    def unauthenticate(self):
+        self.is_authenticated = False
+
+
+@pytest.fixture
+def make_idp(keypair):
+    """ factory(slo_transport=None, auth=None, app=None, **idp_config) -> (Flask app, SamlIdP blueprint) with urn:sp-a and urn:sp-b registered """
+
+    from flask import Flask
+    from SamlIdP import SamlIdP
+    from SamlIdP.IdPservice import allIdentityProviders
+    from SamlIdP.SPservice import allServiceProviders
+
+    created = []
+
+    def factory(slo_transport=None, auth=None, app=None, **config):
+
+        cert, key = keypair
+        idp_config = {
+            'entityId': f'urn:idp{len(created)}',
+            'name': f'samlidp{len(created)}',
+            'x509Cert': cert,
+            'priv_key': key,
+            'splist': [
+                {'SPEntityId': 'urn:sp-a', 'ACSList': ['https://sp-a.example.com/acs']},
+                {'SPEntityId': 'urn:sp-b', 'ACSList': ['https://sp-b.example.com/acs']},
+            ],
+        }
+        idp_config.update(config)
+
+        if app is None:
+            app = Flask(__name__)
+            app.secret_key = 'test'
+
+        blueprint = SamlIdP(auth=auth or FakeAuth(), idp_config=idp_config, app=app, slo_transport=slo_transport)
+        created.append(blueprint.idP.idp_id)
+
+        # warm-up signs too - let it finish first
+        deadline = time.monotonic() + 10
+        while not blueprint.ready and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert blueprint.ready
+
+        return app, blueprint
+
+    yield factory
+
+    for idp_id in created:
+        allIdentityProviders.pop(idp_id, None)
+        for sp in [sp for key, sp in allServiceProviders.items() if key[0] == idp_id]:
+            sp.unregister()
+
+
+def authn_request_qs(issuer, before_issuer='', request_id=None, acs=None, attributes=''):
+    """ Redirect binding query string of an unsigned AuthnRequest (from make_idp's urn:sp-x SPs) """
+
+    from secrets import token_hex
+    from SamlIdP.SamlSerializer import SamlRequestSerializer
+
+    instant = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    acs = acs or 'https://' + issuer.split(':')[-1] + '.example.com/acs'
+    xml = f'<samlp:AuthnRequest xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="{request_id or "_" + token_hex(16)}" Version="2.0" IssueInstant="{instant}" AssertionConsumerServiceURL="{acs}"{attributes}>{before_issuer}<saml:Issuer>{issuer}</saml:Issuer></samlp:AuthnRequest>'
+
+    return SamlRequestSerializer().serializeSamlRequest(xml.encode('utf-8'), relayState='', sign=False)
+
+
+def issue_response(keypair, sign_assertion=False, sign_response=True, seed=0, clock=None):
+    """ A SAMLResponse from the production pipeline for a generated AuthnRequest - (signed, DiffTarget) """
+
+    from random import Random
+    from SamlIdP.AttributePolicy import AttributeReleasePolicy
+    from SamlIdP.Differential import DIFF_IDP_URL, DiffTarget, randomCase, referenceEngine
+    from SamlIdP.KeySet import KeySet
+    from SamlIdP.RequestDecoder import RequestDecoder
+    from SamlIdP.ResponseTemplate import FixedClock
+
+    cert, key = keypair
+    case = randomCase(Random(seed))
+    saml_request = RequestDecoder(DIFF_IDP_URL, case['request_qs'].encode('utf-8'))
+
+    target = DiffTarget('urn:idp.example.com', saml_request.issuer, saml_request.acs,
+        KeySet.fromConfig({'x509Cert': cert, 'priv_key': key}),
+        AttributeReleasePolicy(list(case['attributes'])),
+        sign_assertion=sign_assertion, sign_response=sign_response, nameid_attr='uid')
+
+    signed = referenceEngine(case['request_qs'].encode('utf-8'), case['attributes'], target,
+        clock or FixedClock(datetime(2000, 1, 1), seed=seed))
+
+    return signed, target
@@ -0,0 +1,100 @@
+import threading
+
+from SamlIdP.Admission import AdmissionControl, AdmissionError
+
+from conftest import authn_request_qs
+
+
+def test_nested_signing_shares_the_outer_slot():
+
+    admission = AdmissionControl({'max_inflight_signing': 1})
+
+    with admission.signing():
+        with admission.signing():
+            pass
+
+        # still held by the outer use - another thread is refused
+        refused = []
+        def other():
+            try:
+                with admission.signing():
+                    pass
+            except AdmissionError as e:
+                refused.append(e.status)
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+        assert refused == [503]
+
+    with admission.signing():
+        pass
+
+    assert admission.counters['signing_overloaded'] == 1
+
+
+def test_slot_is_taken_before_the_decode(make_idp):
+
+    app, blueprint = make_idp(max_inflight_signing=1)
+
+    with blueprint.idP.admission.signing():
+        # another request in flight - refused without decoding
+        thread_status = []
+        def other():
+            with app.test_client() as client:
+                thread_status.append(client.get('/saml2?' + authn_request_qs('urn:sp-a')).status_code)
+
+        thread = threading.Thread(target=other)
+        thread.start()
+        thread.join()
+
+    assert thread_status == [503]
+
+    with app.test_client() as client:
+        response = client.get('/saml2?' + authn_request_qs('urn:sp-a'))
+        assert response.get_data() == b'LOGIN'
+
+
+def test_peeked_issuer_must_match(make_idp):
+
+    app, blueprint = make_idp(max_inflight_signing=1)
+
+    # an Issuer of another namespace fools the peek - the request is not serviced as either SP
+    spoofed = authn_request_qs('urn:sp-a', before_issuer='<x:Issuer xmlns:x="urn:other">urn:sp-b</x:Issuer>')
+
+    with app.test_client() as client:
+        response = client.get('/saml2?' + spoofed)
+
+    assert response.status_code == 400
+    assert blueprint.idP.auth.logins == []
+
+
+def test_counts_are_exact_across_threads():
+
+    admission = AdmissionControl({})
+
+    def requests():
+        for _ in range(2000):
+            admission.admit('192.0.2.1')
+
+    threads = [threading.Thread(target=requests) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert admission.counters['admitted'] == 8 * 2000
+
+
+def test_reinit_frees_slots_held_at_fork():
+
+    admission = AdmissionControl({'max_inflight_signing': 1})
+
+    # a slot held by a thread that won't exist in the forked worker
+    admission.signing_slots.acquire()
+    admission.reinit()
+
+    with admission.signing():
+        pass
+
+    assert admission.counters['signing_overloaded'] == 0
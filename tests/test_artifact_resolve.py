@@ -0,0 +1,183 @@
+from base64 import b64encode
+from types import SimpleNamespace
+
+from lxml import etree
+import pytest
+
+from SamlIdP.ArtifactBinding import ArtifactResolver
+from SamlIdP.constants import SamlStatusRequestDenied, SamlStatusSuccess, bindArtifact, bindPost
+from SamlIdP.SamlSerializer import SamlResponseSigner
+from SamlIdP.SPservice import SamlSPservice
+
+from conftest import authn_request_qs
+
+ARTIFACT_RESOLVE = (
+    '<samlp:ArtifactResolve xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" '
+    'xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="_resolve1" Version="2.0" '
+    'IssueInstant="2026-01-01T00:00:00Z"><saml:Issuer>urn:sp.example.com</saml:Issuer>'
+    '{extensions}<samlp:Artifact>AAQAAartifact</samlp:Artifact></samlp:ArtifactResolve>'
+)
+
+DUMMY_SIGNATURE = '<samlp:Extensions><ds:Signature xmlns:ds="http://www.w3.org/2000/09/xmldsig#"/></samlp:Extensions>'
+
+
+def parse(xml):
+    return etree.XML(xml, parser=etree.XMLParser(resolve_entities=False, no_network=True))
+
+
+def test_signed_artifact_resolve_verifies(sp_keypair):
+
+    cert, key = sp_keypair
+    signed = SamlResponseSigner(cert, key).signSamlResponse(ARTIFACT_RESOLVE.format(extensions='').encode())
+
+    assert SamlResponseSigner(cert).verifyReferenced(parse(signed)) is True
+
+
+def test_nested_dummy_signature_is_rejected(sp_keypair):
+
+    cert, key = sp_keypair
+    unsigned = ARTIFACT_RESOLVE.format(extensions=DUMMY_SIGNATURE).encode()
+
+    assert SamlResponseSigner(cert).verifyReferenced(parse(unsigned)) is False
+
+
+def test_misplaced_signature_is_rejected(sp_keypair):
+
+    cert, key = sp_keypair
+    signed = parse(SamlResponseSigner(cert, key).signSamlResponse(ARTIFACT_RESOLVE.format(extensions='').encode()))
+
+    # move the valid signature into <Extensions>
+    signature = signed.find('{http://www.w3.org/2000/09/xmldsig#}Signature')
+    extensions = etree.SubElement(signed, '{urn:oasis:names:tc:SAML:2.0:protocol}Extensions')
+    extensions.append(signature)
+
+    assert SamlResponseSigner(cert).verifyReferenced(signed) is False
+
+
+def test_tampered_artifact_resolve_is_rejected(sp_keypair):
+
+    cert, key = sp_keypair
+    signed = SamlResponseSigner(cert, key).signSamlResponse(ARTIFACT_RESOLVE.format(extensions='').encode())
+
+    assert SamlResponseSigner(cert).verifyReferenced(parse(signed.replace(b'AAQAAartifact', b'AAQAAother'))) is False
+
+
+def test_wrong_key_is_rejected(sp_keypair, keypair):
+
+    cert, key = sp_keypair
+    signed = SamlResponseSigner(cert, key).signSamlResponse(ARTIFACT_RESOLVE.format(extensions='').encode())
+
+    assert SamlResponseSigner(keypair[0]).verifyReferenced(parse(signed)) is False
+
+
+
+def sign_as_is(xml, cert, key):
+    """ Enveloped signature over xml exactly as written (white space included) """
+
+    signer = SamlResponseSigner(cert, key)
+    root = parse(xml)
+
+    signed_info = signer.nodeSignedInfo(root.get('ID'), signer.signer.digest(root))
+    signature_value = b64encode(signer.signer.sign(signed_info)).decode()
+    signer.insertAfterTag(root, etree.XML(signer.nodeSignature(signed_info, signature_value)))
+
+    return etree.tostring(root)
+
+
+def test_pretty_printed_artifact_resolve_verifies(sp_keypair):
+
+    cert, key = sp_keypair
+    pretty = etree.tostring(parse(ARTIFACT_RESOLVE.format(extensions='').encode()), pretty_print=True)
+    signed = sign_as_is(pretty, cert, key)
+
+    soap = b'<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/"><SOAP-ENV:Body>' \
+        + signed + b'</SOAP-ENV:Body></SOAP-ENV:Envelope>'
+
+    resolver = ArtifactResolver(SimpleNamespace(idp_id='urn:idp.example.com'), store='memory')
+    envelope = etree.XML(soap, parser=resolver.parsers.get())
+    resolve = envelope.find('{http://schemas.xmlsoap.org/soap/envelope/}Body/{urn:oasis:names:tc:SAML:2.0:protocol}ArtifactResolve')
+
+    assert SamlResponseSigner(cert).verifyReferenced(resolve) is True
+
+
+def soap(xml):
+    return b'<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/"><SOAP-ENV:Body>' \
+        + xml + b'</SOAP-ENV:Body></SOAP-ENV:Envelope>'
+
+
+ARTIFACT_SP = {'SPEntityId': 'urn:sp.example.com', 'ACSList': ['https://sp.example.com/acs'], 'ProtocolBinding': bindArtifact}
+
+
+def test_artifact_sp_needs_a_certificate(make_idp):
+
+    app, blueprint = make_idp()
+
+    with pytest.raises(AssertionError, match='sp_cert'):
+        SamlSPservice(idP=blueprint.idP, sp_config=ARTIFACT_SP)
+
+
+@pytest.mark.parametrize('has_cert', [True, False])
+def test_unsigned_artifact_resolve_is_denied(make_idp, sp_keypair, has_cert):
+
+    cert, key = sp_keypair
+    app, blueprint = make_idp(splist=[dict(ARTIFACT_SP, sp_cert=cert)])
+
+    sp = SamlSPservice.getSamlSP('urn:sp.example.com', blueprint.idP.idp_id)
+    if not has_cert:
+        # registered some other way - resolve must still refuse it
+        sp.sp_cert = None
+
+    artifact = blueprint.idP.artifacts.issue(sp.sp_id, b'<saml:Assertion xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion">secret</saml:Assertion>')
+    unsigned = ARTIFACT_RESOLVE.format(extensions='').replace('AAQAAartifact', artifact).encode()
+
+    with app.test_client() as client:
+        response = client.post('/saml2/artifact', data=soap(unsigned))
+
+    assert response.status_code == 200
+    assert SamlStatusRequestDenied.encode() in response.get_data()
+    assert b'secret' not in response.get_data()
+
+
+def test_signed_artifact_resolve_gets_the_message(make_idp, sp_keypair):
+
+    cert, key = sp_keypair
+    app, blueprint = make_idp(splist=[dict(ARTIFACT_SP, sp_cert=cert)])
+
+    artifact = blueprint.idP.artifacts.issue('urn:sp.example.com', b'<saml:Assertion xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion">secret</saml:Assertion>')
+    signed = SamlResponseSigner(cert, key).signSamlResponse(ARTIFACT_RESOLVE.format(extensions='').replace('AAQAAartifact', artifact).encode())
+
+    with app.test_client() as client:
+        response = client.post('/saml2/artifact', data=soap(signed))
+
+    assert SamlStatusSuccess.encode() in response.get_data()
+    assert b'secret' in response.get_data()
+
+
+def test_artifact_sp_binding_is_the_default(make_idp, sp_keypair):
+
+    cert, key = sp_keypair
+    app, blueprint = make_idp(splist=[dict(ARTIFACT_SP, sp_cert=cert)])
+    blueprint.idP.auth.is_authenticated = True
+
+    # ProtocolBinding is optional - the SP's binding applies
+    with app.test_client() as client:
+        response = client.get('/saml2?' + authn_request_qs('urn:sp.example.com', acs='https://sp.example.com/acs'))
+
+    assert response.status_code == 302
+    assert response.headers['Location'].startswith('https://sp.example.com/acs?SAMLart=')
+
+
+def test_other_binding_is_unsupported(make_idp, sp_keypair):
+
+    cert, key = sp_keypair
+    app, blueprint = make_idp(splist=[dict(ARTIFACT_SP, sp_cert=cert)])
+    blueprint.idP.auth.is_authenticated = True
+
+    request_qs = authn_request_qs('urn:sp.example.com', acs='https://sp.example.com/acs',
+        attributes=f' ProtocolBinding="{bindPost}"')
+
+    with app.test_client() as client:
+        response = client.get('/saml2?' + request_qs)
+
+    assert b'SAMLart' not in response.get_data()
+    assert b'SAMLResponse' in response.get_data()
@@ -0,0 +1,72 @@
+import re
+from types import SimpleNamespace
+
+from SamlIdP.AttributePolicy import AttributeReleasePolicy
+from SamlIdP.SPservice import SamlSPservice
+
+
+def released(rules, attributes):
+    return {entry['@Name']: entry['AttributeValue'] for entry in AttributeReleasePolicy(rules).release(attributes)}
+
+
+def test_plain_names_release_as_is():
+
+    assert released(['uid', 'mail'], {'uid': 'alice', 'groups': ['a']}) == {'uid': 'alice'}
+
+
+def test_match_values_and_scope():
+
+    rules = [
+        {'Name': 'groups', 'ReleaseAs': 'memberOf', 'Match': '^staff-'},
+        {'Name': 'affiliation', 'Values': ['member', 'student'], 'Scope': 'example.com'},
+    ]
+    attributes = {'groups': ['staff-it', 'guests', 'staff-hr'], 'affiliation': ['member', 'alum']}
+
+    assert released(rules, attributes) == {'memberOf': ['staff-it', 'staff-hr'], 'affiliation': 'member@example.com'}
+
+
+def test_non_str_values_are_text():
+
+    rules = [
+        {'Name': 'employeeNumber', 'Scope': 'example.com'},
+        {'Name': 'quota', 'Match': '^[0-9]+$'},
+        {'Name': 'cn', 'Values': ['Zoë']},
+    ]
+    attributes = {'employeeNumber': 1234, 'quota': [10, 'unlimited', 20], 'cn': [b'Zo\xc3\xab']}
+
+    assert released(rules, attributes) == {'employeeNumber': '1234@example.com', 'quota': ['10', '20'], 'cn': 'Zoë'}
+
+
+def test_values_without_text_are_left_out(caplog):
+
+    rules = [{'Name': 'groups', 'Match': '.'}]
+
+    assert released(rules, {'groups': [{'nested': 1}, 'staff']}) == {'groups': 'staff'}
+    assert released(rules, {'groups': None}) == {}
+    assert 'Attribute groups: value of type dict not released' in caplog.text
+
+
+def test_non_json_rules_compile():
+
+    idP = SimpleNamespace(idp_id='urn:policy.idp')
+    rules = [{'Name': 'groups', 'Match': re.compile('^staff-'), 'Values': {'staff-it', 'staff-hr'}}]
+
+    sp = SamlSPservice(idP=idP, sp_config={'SPEntityId': 'urn:policy.sp', 'ACSList': ['https://sp.example.com/acs'], 'AttributePolicy': rules})
+    try:
+        assert sp.release_policy.release({'groups': ['staff-it', 'staff-ops']}) == [{'@Name': 'groups', 'AttributeValue': 'staff-it'}]
+    finally:
+        sp.unregister()
+
+
+def test_identical_rules_share_a_policy():
+
+    idP = SimpleNamespace(idp_id='urn:policy.idp')
+    sps = [
+        SamlSPservice(idP=idP, sp_config={'SPEntityId': f'urn:policy.sp{n}', 'ACSList': ['https://sp.example.com/acs'], 'AttributePolicy': [{'Name': 'uid', 'Scope': 'example.com'}]})
+            for n in range(2)
+    ]
+    try:
+        assert sps[0].release_policy is sps[1].release_policy
+    finally:
+        for sp in sps:
+            sp.unregister()
@@ -0,0 +1,162 @@
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from SamlIdP.AttributeResolver import AttributeResolver, AttributeResolvers, LdapResolver, ResolverCache, SqliteResolver
+
+
+class   StubResolver(AttributeResolver):
+    """ Resolver answering from a dict, optionally slowly """
+
+    def __init__(self, name, answers, delay=0, timeout=1.0, ttl=300):
+
+        super().__init__(name, {attr for attrs in answers.values() for attr in attrs}, timeout, ttl)
+        self.answers = answers
+        self.delay = delay
+        self.calls = 0
+
+    def lookup(self, principal):
+
+        self.calls += 1
+        time.sleep(self.delay)
+        return self.answers.get(principal, {})
+
+
+@pytest.fixture
+def entitlements(tmp_path):
+
+    path = str(tmp_path / 'entitlements.db')
+    with sqlite3.connect(path) as conn:
+        conn.execute('CREATE TABLE grants (uid TEXT, entitlement TEXT, quota INTEGER)')
+        conn.executemany('INSERT INTO grants VALUES (?, ?, ?)', [
+            ('alice', 'urn:wiki', 10),
+            ('alice', 'urn:mail', None),
+            ('bob', 'urn:wiki', 5),
+        ])
+
+    return path
+
+
+def test_sqlite_rows_become_values(entitlements):
+
+    resolver = SqliteResolver('grants', entitlements, 'SELECT entitlement, quota FROM grants WHERE uid = ? ORDER BY rowid', ['entitlement', 'quota'])
+
+    assert resolver.lookup('alice') == {'entitlement': ['urn:wiki', 'urn:mail'], 'quota': '10'}
+    assert resolver.lookup('bob') == {'entitlement': 'urn:wiki', 'quota': '5'}
+    assert resolver.lookup('carol') == {}
+
+
+def test_ldap_entry_via_connect():
+
+    pytest.importorskip('ldap3')
+
+    searches = []
+
+    class   Connection:
+        entries = []
+
+        def search(self, base, search_filter, attributes, size_limit):
+            searches.append((base, search_filter))
+            self.entries = [{
+                'mail': SimpleNamespace(values=['alice@example.com']),
+                'memberOf': SimpleNamespace(values=['cn=staff', 'cn=admins']),
+            }]
+
+    resolver = LdapResolver('directory', 'ou=people,dc=example,dc=com', ['mail', 'memberOf'], connect=Connection)
+
+    assert resolver.lookup('al*ce') == {'mail': 'alice@example.com', 'memberOf': ['cn=staff', 'cn=admins']}
+    assert searches == [('ou=people,dc=example,dc=com', '(uid=al\\2ace)')]
+
+
+def test_resolve_merges_needed_attributes(entitlements):
+
+    grants = SqliteResolver('grants', entitlements, 'SELECT entitlement FROM grants WHERE uid = ?', ['entitlement'])
+    directory = StubResolver('directory', {'alice': {'mail': 'alice@example.com', 'uid': 'other'}})
+    resolvers = AttributeResolvers([grants, directory])
+
+    session = {'uid': ['alice']}
+
+    assert resolvers.resolve(session, frozenset(['entitlement'])) == {'uid': ['alice'], 'entitlement': ['urn:wiki', 'urn:mail']}
+    assert directory.calls == 0
+
+    # session attributes are not overridden
+    assert resolvers.resolve(session, frozenset(['mail', 'uid'])) == {'uid': ['alice'], 'mail': 'alice@example.com'}
+    assert resolvers.resolve({}, frozenset(['mail'])) == {}
+
+
+def test_results_are_cached_for_ttl():
+
+    directory = StubResolver('directory', {'alice': {'mail': 'alice@example.com'}}, ttl=0.1)
+    resolvers = AttributeResolvers([directory])
+
+    for _ in range(3):
+        assert resolvers.resolve({'uid': 'alice'}, frozenset(['mail']))['mail'] == 'alice@example.com'
+    assert directory.calls == 1
+    assert (resolvers.cache.hits, resolvers.cache.misses) == (2, 1)
+
+    time.sleep(0.15)
+    resolvers.resolve({'uid': 'alice'}, frozenset(['mail']))
+    assert directory.calls == 2
+
+
+def test_cache_evicts_least_recently_used():
+
+    cache = ResolverCache(size=2)
+
+    cache.set('a', {'n': 1}, 60)
+    cache.set('b', {'n': 2}, 60)
+    assert cache.get('a') == {'n': 1}
+
+    cache.set('c', {'n': 3}, 60)
+    assert cache.get('b') is None
+    assert cache.get('a') == {'n': 1}
+    assert cache.get('c') == {'n': 3}
+
+
+def test_slow_resolver_times_out():
+
+    slow = StubResolver('slow', {'alice': {'mail': 'alice@example.com'}}, delay=0.5, timeout=0.05)
+    fast = StubResolver('fast', {'alice': {'title': 'Dr'}})
+    resolvers = AttributeResolvers([slow, fast])
+
+    began = time.monotonic()
+    assert resolvers.resolve({'uid': 'alice'}, frozenset(['mail', 'title'])) == {'uid': 'alice', 'title': 'Dr'}
+    assert time.monotonic() - began < 0.4
+    assert resolvers.counters['timeouts'] == 1
+
+
+def test_failing_resolver_is_left_out():
+
+    class   Broken(StubResolver):
+        def lookup(self, principal):
+            raise OSError('directory down')
+
+    resolvers = AttributeResolvers([Broken('broken', {'alice': {'mail': ''}})])
+
+    assert resolvers.resolve({'uid': 'alice'}, frozenset(['mail'])) == {'uid': 'alice'}
+    assert resolvers.counters['errors'] == 1
+
+
+def test_one_pool_under_concurrent_requests():
+
+    resolvers = AttributeResolvers([StubResolver('directory', {'alice': {'mail': 'alice@example.com'}})])
+    pool = resolvers.pool
+    start = threading.Barrier(8)
+
+    def request(n):
+        start.wait()
+        resolvers.resolve({'uid': f'user{n}'}, frozenset(['mail']))
+
+    threads = [threading.Thread(target=request, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert resolvers.pool is pool
+
+    resolvers.reinit()
+    assert resolvers.pool is not pool
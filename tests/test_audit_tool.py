@@ -0,0 +1,76 @@
+from base64 import b64encode
+from io import StringIO
+import json
+
+from lxml import etree
+
+from SamlIdP import AuditTool
+from SamlIdP.constants import dsSignatureTag
+from SamlIdP.ResponseTemplate import systemClock
+
+from conftest import issue_response
+
+samlpStatusTag = '{urn:oasis:names:tc:SAML:2.0:protocol}Status'
+samlNameIDTag = '{urn:oasis:names:tc:SAML:2.0:assertion}NameID'
+
+
+def audit(keypair, responses, tmp_path):
+    """ (summary, failures) of auditing [(signed, target)] with the default options """
+
+    cert, key = keypair
+    archive = tmp_path / 'archive.jsonl'
+    registered = {}
+
+    with open(archive, 'w') as f:
+        for n, (signed, target) in enumerate(responses):
+            registered.setdefault(target.sp_id, set()).update(target.acs)
+            f.write(json.dumps({'id': n, 'SAMLResponse': b64encode(signed).decode()}) + '\n')
+
+    idp_config = {
+        'entityId': 'urn:idp.example.com', 'x509Cert': cert, 'priv_key': key,
+        'splist': [{'SPEntityId': sp_id, 'ACSList': sorted(acs)} for sp_id, acs in registered.items()],
+    }
+
+    out = StringIO()
+    summary = AuditTool.audit([str(archive)], idp_config, workers=1, out=out)
+
+    return summary, [json.loads(line) for line in out.getvalue().splitlines()]
+
+
+def issued(keypair, count):
+
+    # as issued - system clock, default 60 minute validity
+    return [issue_response(keypair, sign_assertion=n % 2 == 1, seed=n, clock=systemClock) for n in range(count)]
+
+
+def test_fresh_responses_pass_with_defaults(keypair, tmp_path):
+
+    summary, failures = audit(keypair, issued(keypair, 20), tmp_path)
+
+    assert failures == []
+    assert summary['passed'] == 20
+    assert summary['failed'] == 0
+
+
+def test_tampered_responses_are_flagged(keypair, tmp_path):
+
+    responses = issued(keypair, 3)
+
+    # NameID changed in place
+    root = etree.XML(responses[1][0])
+    root.find(f'.//{samlNameIDTag}').text = 'mallory'
+    responses[1] = (etree.tostring(root), responses[1][1])
+
+    # genuine signature moved into the Status, then the NameID changed
+    root = etree.XML(responses[2][0])
+    root.find(f'./{samlpStatusTag}').append(root.find(f'./{dsSignatureTag}'))
+    root.find(f'.//{samlNameIDTag}').text = 'mallory'
+    responses[2] = (etree.tostring(root), responses[2][1])
+
+    summary, failures = audit(keypair, responses, tmp_path)
+
+    assert summary['passed'] == 1
+    assert [(failure['id'], failure['reason']) for failure in failures] == [
+        (1, 'signature or digest mismatch'),
+        (2, 'signature or digest mismatch'),
+    ]
@@ -0,0 +1,37 @@
+from conftest import authn_request_qs
+
+
+def test_duplicates_in_one_session_share_a_response(make_idp):
+
+    app, blueprint = make_idp(coalesce={'window': 60})
+    blueprint.idP.auth.is_authenticated = True
+
+    coalescer = blueprint.idP.coalescer
+    request_qs = authn_request_qs('urn:sp-a')
+
+    with app.test_client() as client:
+        first = client.get('/saml2?' + request_qs)
+        second = client.get('/saml2?' + request_qs)
+
+    assert first.status_code == 200
+    assert second.get_data() == first.get_data()
+    assert coalescer.counters['serviced'] == 1
+    assert coalescer.counters['coalesced'] == 1
+
+
+def test_other_sessions_are_serviced(make_idp):
+
+    app, blueprint = make_idp(coalesce={'window': 60})
+    blueprint.idP.auth.is_authenticated = True
+
+    coalescer = blueprint.idP.coalescer
+    request_qs = authn_request_qs('urn:sp-a')
+
+    with app.test_client() as client:
+        client.get('/saml2?' + request_qs)
+
+    with app.test_client() as client:
+        client.get('/saml2?' + request_qs)
+
+    assert coalescer.counters['serviced'] == 2
+    assert coalescer.counters['coalesced'] == 0
@@ -0,0 +1,36 @@
+from io import StringIO
+import json
+
+from SamlIdP.Differential import compare, readCorpus, referenceEngine
+
+
+def idp_config(keypair):
+
+    cert, key = keypair
+    return {'entityId': 'urn:idp.example.com', 'x509Cert': cert, 'priv_key': key}
+
+
+def test_reference_matches_itself(keypair, tmp_path):
+
+    corpus = tmp_path / 'corpus.jsonl'
+    recorded = next(readCorpus([], 1, seed=99))
+    corpus.write_text(json.dumps(recorded) + '\n\n')
+
+    out = StringIO()
+    summary = compare({'reference': referenceEngine, 'candidate': referenceEngine}, readCorpus([str(corpus)], 50, seed=0), idp_config(keypair), out=out)
+
+    assert summary['cases'] == 51
+    assert (summary['mismatched'], summary['unverified'], summary['errors']) == (0, 0, 0)
+    assert out.getvalue() == ''
+
+
+def test_differing_candidate_is_reported(keypair):
+
+    def candidate(request_qs, attributes, target, clock):
+        return referenceEngine(request_qs, dict(attributes, uid='mallory'), target, clock)
+
+    out = StringIO()
+    summary = compare({'reference': referenceEngine, 'candidate': candidate}, readCorpus([], 5, seed=0), idp_config(keypair), out=out)
+
+    assert summary['mismatched'] == 5
+    assert [json.loads(line)['reason'] for line in out.getvalue().splitlines()] == ['canonical output differs'] * 5
@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+import pytest
+
+from SamlIdP.PairwiseId import PairwiseIdGenerator
+from SamlIdP.SPservice import SamlSPservice, allServiceProviders
+
+SECRET = b'0123456789abcdef0123456789abcdef'
+
+
+def test_current_defaults_to_highest_version():
+
+    assert PairwiseIdGenerator({9: SECRET, 10: SECRET + b'x'}).current == '10'
+    assert PairwiseIdGenerator({'9': SECRET, '10': SECRET + b'x'}).current == '10'
+
+
+def test_named_versions_need_current():
+
+    with pytest.raises(AssertionError, match='needs current'):
+        PairwiseIdGenerator({'spring': SECRET, 'autumn': SECRET})
+
+    assert PairwiseIdGenerator({'spring': SECRET, 'autumn': SECRET}, current='autumn').current == 'autumn'
+
+
+def test_ids_per_sp_and_version():
+
+    generator = PairwiseIdGenerator({1: SECRET, 2: SECRET + b'x'})
+
+    assert generator.nameId('urn:sp-a', 'alice') == generator.nameId('urn:sp-a', 'alice', 2)
+    assert generator.nameId('urn:sp-a', 'alice') != generator.nameId('urn:sp-b', 'alice')
+    assert generator.nameId('urn:sp-a', 'alice', 1) != generator.nameId('urn:sp-a', 'alice', 2)
+
+    with pytest.raises(KeyError, match='version 3 is not defined'):
+        generator.nameId('urn:sp-a', 'alice', 3)
+
+
+def test_sp_with_unknown_version_is_refused():
+
+    idP = SimpleNamespace(idp_id='urn:pairwise.idp', pairwise=PairwiseIdGenerator({1: SECRET, 2: SECRET}))
+    config = {'SPEntityId': 'urn:pairwise.sp', 'ACSList': ['https://sp.example.com/acs']}
+
+    with pytest.raises(AssertionError, match='PairwiseKeyVersion 3 is not a pairwise_ids key'):
+        SamlSPservice(idP=idP, sp_config=dict(config, PairwiseKeyVersion=3))
+    assert ('urn:pairwise.idp', 'urn:pairwise.sp') not in allServiceProviders
+
+    sp = SamlSPservice(idP=idP, sp_config=dict(config, PairwiseKeyVersion=1))
+    sp.unregister()
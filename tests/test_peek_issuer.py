@@ -0,0 +1,46 @@
+import pytest
+
+from SamlIdP.SamlSerializer import SamlRequestSerializer
+
+from conftest import authn_request_qs
+
+
+def peek(request_qs):
+    return SamlRequestSerializer.peekIssuer(request_qs)
+
+
+def test_issuer_is_peeked():
+
+    assert peek(authn_request_qs('urn:sp-a')) == 'urn:sp-a'
+    assert peek(authn_request_qs('https://sp.example.com/?a=1&amp;b=2')) == 'https://sp.example.com/?a=1&b=2'
+
+
+@pytest.mark.parametrize('decoy', [
+    '<!-- <saml:Issuer>urn:sp-b</saml:Issuer> -->',
+    '<!-- a comment --> <!-- <saml:Issuer>urn:sp-b</saml:Issuer> -->',
+])
+def test_comments_are_skipped(decoy):
+
+    assert peek(authn_request_qs('urn:sp-a', before_issuer=decoy)) == 'urn:sp-a'
+
+
+@pytest.mark.parametrize('decoy', [
+    '<samlp:Extensions><saml:Issuer>urn:sp-b</saml:Issuer></samlp:Extensions>',
+    '<saml:Subject/><saml:Issuer>urn:sp-b</saml:Issuer>',
+])
+def test_issuer_must_be_the_first_child(decoy):
+
+    # the real Issuer isn't first either - no hint, refused as unknown
+    assert peek(authn_request_qs('urn:sp-a', before_issuer=decoy)) is None
+
+
+def test_attribute_values_are_skipped():
+
+    from base64 import b64encode
+    from urllib.parse import urlencode
+    import zlib
+
+    xml = b'<samlp:AuthnRequest xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" ID="_1" x="><saml:Issuer>urn:sp-b</saml:Issuer>"><saml:Issuer xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion">urn:sp-a</saml:Issuer></samlp:AuthnRequest>'
+    request_qs = urlencode({'SAMLRequest': b64encode(zlib.compress(xml)[2:-4])})
+
+    assert peek(request_qs) == 'urn:sp-a'
@@ -0,0 +1,58 @@
+import gc
+
+from flask import Flask
+import pytest
+
+from SamlIdP import IdPservice, Preload
+import SamlIdP.SingleLogout as singleLogout
+
+
+@pytest.fixture
+def preloaded():
+
+    yield Preload.preload
+    gc.unfreeze()
+
+
+def test_metadata_is_prebuilt(make_idp, preloaded, monkeypatch):
+
+    app = Flask(__name__)
+    app.secret_key = 'test'
+    app.config['SERVER_NAME'] = 'idp.example.com'
+    app.config['PREFERRED_URL_SCHEME'] = 'https'
+
+    app, blueprint = make_idp(app=app, url_prefix='/idp')
+    preloaded(app)
+
+    # served from the cache - nothing is encoded per worker
+    def encode(*args, **kwargs):
+        raise AssertionError('metadata encoded after preload')
+    monkeypatch.setattr(IdPservice, 'encodeIdPMetaData', encode)
+
+    res = app.test_client().get('/idp/saml2/metadata', base_url='https://idp.example.com')
+
+    assert res.status_code == 200
+    assert b'Location="https://idp.example.com/idp/saml2"' in res.data
+
+
+def test_metadata_without_host_is_left_to_workers(make_idp, preloaded):
+
+    app, blueprint = make_idp()
+    preloaded(app)
+
+    assert blueprint.idP.metadata_cache == {}
+
+
+def test_post_fork_renews_pools(make_idp):
+
+    app, blueprint = make_idp(attribute_resolvers=[
+        {'type': 'sqlite', 'name': 'grants', 'path': ':memory:', 'query': 'SELECT 1 WHERE ? IS NULL', 'provides': ['entitlement']},
+    ])
+
+    slo_pool = singleLogout._pool
+    resolver_pool = blueprint.idP.resolvers.pool
+
+    Preload.post_fork()
+
+    assert singleLogout._pool is not slo_pool
+    assert blueprint.idP.resolvers.pool is not resolver_pool
@@ -0,0 +1,14 @@
+from SamlIdP.RegistryBench import measure
+from SamlIdP.SPservice import allServiceProviders
+
+
+def test_registry_memory_per_sp(sp_keypair):
+
+    cert, key = sp_keypair
+    summary = measure(1000, cert=cert, signed=0.1)
+
+    assert summary['signed'] == 100
+    # slotted records with shared defaults - well under a kilobyte and a half each
+    assert 0 < summary['bytes_per_sp'] < 1536
+
+    assert not any(idp_id == 'urn:registrybench.idp' for idp_id, sp_id in allServiceProviders)
@@ -0,0 +1,47 @@
+from types import SimpleNamespace
+
+from SamlIdP.Differential import DIFF_IDP_URL
+from SamlIdP.RequestDecoder import RequestDecoder, REPLAY_WINDOW
+from SamlIdP.SamlSerializer import SamlRequestSerializer
+from SamlIdP.SharedTable import SharedTable
+
+LONG_ENTITY_ID = 'https://sso.example.com/' + 'federation/' * 20 + 'metadata.xml'
+
+
+def authn_request(sp_id, request_id):
+
+    xml = f'<samlp:AuthnRequest xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol" xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion" ID="{request_id}" Version="2.0" IssueInstant="2000-01-01T00:00:00Z" Destination="{DIFF_IDP_URL}"><saml:Issuer>{sp_id}</saml:Issuer></samlp:AuthnRequest>'
+
+    request_qs = SamlRequestSerializer().serializeSamlRequest(xml.encode('utf-8'), relayState='', sign=False)
+    saml_request = RequestDecoder(DIFF_IDP_URL, request_qs.encode('utf-8'))
+    saml_request.sp = SimpleNamespace(sp_id=sp_id)
+
+    return saml_request
+
+
+def test_replay_key_fits_shared_table(tmp_path):
+
+    table = SharedTable(str(tmp_path / 'state.tbl'), slots=64)
+    saml_request = authn_request(LONG_ENTITY_ID, '_' + 'a' * 200)
+
+    assert len(saml_request.replayKey) <= table.key_size
+    assert table.add(saml_request.replayKey, REPLAY_WINDOW)
+    assert not table.add(saml_request.replayKey, REPLAY_WINDOW)
+
+
+def test_replay_keys_differ_per_sp():
+
+    assert authn_request(LONG_ENTITY_ID, '_1').replayKey != authn_request(LONG_ENTITY_ID + 'x', '_1').replayKey
+    assert authn_request('urn:sp', '_1').replayKey != authn_request('urn:sp', '_2').replayKey
+
+
+def test_overlong_keys_are_digested(tmp_path):
+
+    table = SharedTable(str(tmp_path / 'state.tbl'), slots=64)
+    key = 'pending:' + LONG_ENTITY_ID
+
+    assert table.add(key, 60, b'value')
+    assert not table.add(key, 60)
+    assert table.get(key) == b'value'
+    assert table.get(key + 'x') is None
+    assert table.pop(key) == b'value'
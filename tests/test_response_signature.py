@@ -0,0 +1,88 @@
+from base64 import b64encode
+
+from lxml import etree
+import pytest
+
+from SamlIdP.constants import dsSignatureTag, samlAssertionTag
+from SamlIdP.SamlSerializer import SamlResponseSigner
+
+from conftest import issue_response
+
+samlpStatusTag = '{urn:oasis:names:tc:SAML:2.0:protocol}Status'
+samlNameIDTag = '{urn:oasis:names:tc:SAML:2.0:assertion}NameID'
+
+
+def parse(xml):
+    return etree.XML(xml, parser=etree.XMLParser(resolve_entities=False, no_network=True))
+
+
+def verified(cert, xml):
+    """ (verifySignedSamlResponse, verify_many) results - they must agree """
+
+    signer = SamlResponseSigner(cert)
+    return signer.verifySignedSamlResponse(xml), list(signer.verify_many([b64encode(xml)]))[0]
+
+
+def rename(root):
+    root.find(f'.//{samlNameIDTag}').text = 'mallory'
+
+
+@pytest.mark.parametrize('sign_assertion, sign_response', [(False, True), (True, False), (True, True)])
+def test_issued_responses_verify(keypair, sign_assertion, sign_response):
+
+    signed, target = issue_response(keypair, sign_assertion, sign_response)
+    assert verified(keypair[0], signed) == (True, True)
+
+
+def test_unsigned_response_is_refused(keypair):
+
+    unsigned, target = issue_response(keypair, sign_assertion=False, sign_response=False)
+    assert verified(keypair[0], unsigned) == (False, False)
+
+
+@pytest.mark.parametrize('sign_assertion', [False, True])
+def test_tampered_response_is_refused(keypair, sign_assertion):
+
+    signed, target = issue_response(keypair, sign_assertion)
+    root = parse(signed)
+    rename(root)
+
+    assert verified(keypair[0], etree.tostring(root)) == (False, False)
+
+
+def test_relocated_signature_is_refused(keypair):
+
+    signed, target = issue_response(keypair)
+    root = parse(signed)
+
+    # the genuine signature moved out of the way, then the NameID changed
+    root.find(f'./{samlpStatusTag}').append(root.find(f'./{dsSignatureTag}'))
+    rename(root)
+
+    assert verified(keypair[0], etree.tostring(root)) == (False, False)
+
+
+def test_signature_for_another_element_is_refused(keypair):
+
+    signed, target = issue_response(keypair, sign_assertion=True, sign_response=False)
+    root = parse(signed)
+
+    # the Assertion's genuine signature presented as the Response's
+    assertion = root.find(f'./{samlAssertionTag}')
+    root.insert(1, assertion.find(f'./{dsSignatureTag}'))
+    rename(root)
+
+    assert verified(keypair[0], etree.tostring(root)) == (False, False)
+
+
+def test_second_assertion_is_refused(keypair):
+
+    signed, target = issue_response(keypair, sign_assertion=True, sign_response=False)
+    root = parse(signed)
+
+    forged = parse(etree.tostring(root.find(f'./{samlAssertionTag}')))
+    forged.remove(forged.find(f'./{dsSignatureTag}'))
+    rename(forged)
+    root.append(forged)
+
+    assert verified(keypair[0], etree.tostring(root)) == (False, False)
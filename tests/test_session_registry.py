@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+from SamlIdP.constants import SamlNameIdTransient
+from SamlIdP.ResponseTemplate import TIMEFORMAT
+from SamlIdP.SessionRegistry import SessionRegistry
+
+
+def expires(minutes=60):
+    return (datetime.utcnow() + timedelta(minutes=minutes)).strftime(TIMEFORMAT)
+
+
+def test_principal_finds_every_sp():
+
+    registry = SessionRegistry()
+
+    # transient NameIDs - a different one per SP and per login
+    registry.record('urn:idp', 'urn:sp1', 'alice', '_t1', SamlNameIdTransient, '_s1', expires())
+    registry.record('urn:idp', 'urn:sp2', 'alice', '_t2', SamlNameIdTransient, '_s2', expires())
+    registry.record('urn:idp', 'urn:sp1', 'bob', '_t3', SamlNameIdTransient, '_s3', expires())
+
+    assert sorted(sso.sp for sso in registry.byPrincipal('alice')) == ['urn:sp1', 'urn:sp2']
+    assert [sso.sp for sso in registry.byNameId('_t2')] == ['urn:sp2']
+
+    registry.remove('_s1')
+    assert [sso.session_index for sso in registry.byPrincipal('alice')] == ['_s2']
+
+    registry.remove('_s2')
+    assert registry.byPrincipal('alice') == []
+    assert 'alice' not in registry.by_principal
+
+
+def test_expired_sessions_leave_the_principal_index():
+
+    registry = SessionRegistry()
+
+    registry.record('urn:idp', 'urn:sp1', 'alice', '_t1', SamlNameIdTransient, '_s1', expires(-1))
+    registry.record('urn:idp', 'urn:sp1', None, '_t2', SamlNameIdTransient, '_s2', expires())
+
+    assert registry.byPrincipal('alice') == []
+    assert len(registry) == 1
+    assert None not in registry.by_principal
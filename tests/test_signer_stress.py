@@ -0,0 +1,18 @@
+from SamlIdP.KeySet import KeySet
+from SamlIdP.SignerStress import stress, unsignedCases
+
+
+def test_concurrent_signing_matches_single_threaded(keypair):
+
+    cert, key = keypair
+    signer = KeySet.fromConfig({'x509Cert': cert, 'priv_key': key}).active
+
+    summaries = stress(signer, unsignedCases('urn:idp.example.com', 40), thread_counts=(1, 4, 8), rounds=2)
+
+    assert [summary['threads'] for summary in summaries] == [1, 4, 8]
+
+    for summary in summaries:
+        assert summary['responses'] == 80
+        assert summary['mismatched'] == 0
+        assert summary['unverified'] == 0
+        assert summary['errors'] == 0
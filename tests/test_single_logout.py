@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta
+import threading
+
+from lxml import etree
+
+from SamlIdP.ResponseTemplate import TIMEFORMAT
+import SamlIdP.SingleLogout as singleLogout
+
+SUCCESS = 'urn:oasis:names:tc:SAML:2.0:status:Success'
+SAMLP = '{urn:oasis:names:tc:SAML:2.0:protocol}'
+
+SLO_SPLIST = [
+    {'SPEntityId': 'urn:sp-a', 'ACSList': ['https://sp-a.example.com/acs'], 'SLOList': ['https://sp-a.example.com/slo'], 'SLOTimeout': 1},
+    {'SPEntityId': 'urn:sp-b', 'ACSList': ['https://sp-b.example.com/acs'], 'SLOList': ['https://sp-b.example.com/slo'], 'SLOTimeout': 1},
+]
+
+
+class   SloEndpoint:
+    """ Stand-in SOAP SLO endpoints - records each LogoutRequest, answers with status """
+
+    def __init__(self, status=SUCCESS, fail=()):
+        self.status = status
+        self.fail = fail
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, url, soap_request, timeout):
+
+        request = etree.XML(soap_request).find(f'.//{SAMLP}LogoutRequest')
+        with self.lock:
+            self.calls.append((url, request.findtext(f'{SAMLP}SessionIndex')))
+
+        if url in self.fail:
+            raise OSError('connection refused')
+
+        return f'<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/"><SOAP-ENV:Body><samlp:LogoutResponse xmlns:samlp="urn:oasis:names:tc:SAML:2.0:protocol"><samlp:Status><samlp:StatusCode Value="{self.status}"/></samlp:Status></samlp:LogoutResponse></SOAP-ENV:Body></SOAP-ENV:Envelope>'.encode()
+
+
+def record(idP, sp_id, session_index, principal='alice'):
+
+    expires = (datetime.utcnow() + timedelta(hours=1)).strftime(TIMEFORMAT)
+    idP.sessions.record(idP.idp_id, sp_id, principal, f'nameid-{session_index}', 'urn:oasis:names:tc:SAML:2.0:nameid-format:transient', session_index, expires)
+
+
+def test_logout_uses_blueprint_transport(make_idp):
+
+    endpoint = SloEndpoint()
+    app, blueprint = make_idp(slo_transport=endpoint, splist=SLO_SPLIST)
+    idP = blueprint.idP
+
+    # two browsers signed in to sp-a, one to sp-b
+    record(idP, 'urn:sp-a', '_s1')
+    record(idP, 'urn:sp-a', '_s2')
+    record(idP, 'urn:sp-b', '_s3')
+    record(idP, 'urn:sp-b', '_other', principal='bob')
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['attributes'] = {'uid': ['alice']}
+
+    assert client.get('/saml2/.logout').data == b'OK'
+
+    assert sorted(endpoint.calls) == [
+        ('https://sp-a.example.com/slo', '_s1'),
+        ('https://sp-a.example.com/slo', '_s2'),
+        ('https://sp-b.example.com/slo', '_s3'),
+    ]
+    assert idP.sessions.byPrincipal('alice') == []
+    assert len(idP.sessions.byPrincipal('bob')) == 1
+
+
+def test_results_per_session(make_idp):
+
+    endpoint = SloEndpoint(fail=('https://sp-b.example.com/slo',))
+    app, blueprint = make_idp(slo_transport=endpoint, splist=SLO_SPLIST)
+    idP = blueprint.idP
+
+    for session_index, sp_id in (('_s1', 'urn:sp-a'), ('_s2', 'urn:sp-a'), ('_s3', 'urn:sp-b')):
+        record(idP, sp_id, session_index)
+
+    participants = [sso._asdict() for sso in idP.sessions.byPrincipal('alice')]
+    results = idP.singleLogout.logout(participants)
+
+    assert results == {
+        ('urn:sp-a', '_s1'): SUCCESS,
+        ('urn:sp-a', '_s2'): SUCCESS,
+        ('urn:sp-b', '_s3'): 'error: connection refused',
+    }
+
+
+def test_pool_is_renewed():
+
+    pool = singleLogout._pool
+    singleLogout.reinitPool()
+
+    assert singleLogout._pool is not pool
@@ -0,0 +1,247 @@
+import socketserver
+import threading
+import time
+
+import pytest
+
+from SamlIdP.StateBackend import FallbackState, LocalState, RedisError, RedisState, StateUnavailable
+
+
+class   FakeRedis(socketserver.ThreadingTCPServer):
+    """ In-process RESP2 server with the commands RedisState sends """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, password=None):
+
+        super().__init__(('127.0.0.1', 0), _RespHandler)
+
+        self.password = password
+        self.data = {}
+        self.lock = threading.Lock()
+        self.commands = []
+        self.connections = 0
+        self.drop = False
+
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def live(self, key):
+        """ Value of a live key or None (lock held) """
+
+        entry = self.data.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del self.data[key]
+            return None
+        return None if entry is None else entry[1]
+
+    def ttl(self, key):
+        return self.data[key][0] - time.monotonic()
+
+    def run(self, command, authed):
+
+        name, args = command[0].upper(), command[1:]
+        self.commands.append(name)
+
+        if name == b'AUTH':
+            return (b'+OK\r\n', True) if args[0].decode() == self.password else (b'-WRONGPASS invalid password\r\n', False)
+        if self.password and not authed:
+            return b'-NOAUTH Authentication required.\r\n', authed
+        if name == b'SELECT':
+            return b'+OK\r\n', authed
+
+        with self.lock:
+            key = args[0]
+            value = self.live(key)
+
+            if name == b'GET':
+                return _bulk(value), authed
+            if name == b'GETDEL':
+                self.data.pop(key, None)
+                return _bulk(value), authed
+            if name == b'EXPIRE':
+                if value is None:
+                    return b':0\r\n', authed
+                self.data[key] = (time.monotonic() + int(args[1]), value)
+                return b':1\r\n', authed
+            if name == b'SET':
+                options = [arg.upper() for arg in args[2:]]
+                if b'NX' in options and value is not None:
+                    return b'$-1\r\n', authed
+                ttl = int(options[options.index(b'EX') + 1]) if b'EX' in options else 1e9
+                self.data[key] = (time.monotonic() + ttl, args[1])
+                return b'+OK\r\n', authed
+
+        return b'-ERR unknown command\r\n', authed
+
+
+def _bulk(value):
+    return b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+class   _RespHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+
+        self.server.connections += 1
+        authed = False
+
+        while True:
+            line = self.rfile.readline()
+            if not line or self.server.drop:
+                return
+
+            command = []
+            for _ in range(int(line[1:-2])):
+                size = int(self.rfile.readline()[1:-2])
+                command.append(self.rfile.read(size + 2)[:-2])
+
+            reply, authed = self.server.run(command, authed)
+            self.wfile.write(reply)
+
+
+@pytest.fixture
+def redis():
+
+    server = FakeRedis(password='secret')
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def unused_port():
+
+    server = socketserver.TCPServer(('127.0.0.1', 0), socketserver.BaseRequestHandler)
+    port = server.server_address[1]
+    server.server_close()
+    return port
+
+
+def test_set_get_pop(redis):
+
+    state = RedisState('127.0.0.1', redis.port, db=1, password='secret', prefix='t:')
+
+    assert state.get('k') is None
+    state.set('k', 'value', 60)
+    assert state.get('k') == b'value'
+    assert b't:k' in redis.data
+
+    assert state.pop('k') == b'value'
+    assert state.pop('k') is None
+    assert redis.commands[:2] == [b'AUTH', b'SELECT']
+    assert b'GETDEL' in redis.commands
+
+
+def test_add_is_set_nx_ex(redis):
+
+    state = RedisState('127.0.0.1', redis.port, password='secret')
+
+    assert state.add('replay', 30)
+    assert not state.add('replay', 30)
+    assert 25 < redis.ttl(b'samlidp:replay') <= 30
+
+    assert state.expire('replay', 300)
+    assert 295 < redis.ttl(b'samlidp:replay') <= 300
+    assert not state.expire('absent', 300)
+
+
+def test_batch_in_one_round_trip(redis):
+
+    state = RedisState('127.0.0.1', redis.port, password='secret')
+
+    assert state.execute([('set', ('a', b'1', 60)), ('add', ('a', 60)), ('get', ('a',)), ('pop', ('a',))]) == [None, False, b'1', b'1']
+    assert redis.connections == 1
+
+
+def test_wrong_password_fails(redis):
+
+    state = RedisState('127.0.0.1', redis.port, password='wrong')
+
+    with pytest.raises(RedisError):
+        state.get('k')
+
+
+def test_reconnects_after_dropped_connection(redis):
+
+    state = RedisState('127.0.0.1', redis.port, password='secret')
+    state.set('k', 'v', 60)
+
+    redis.drop = True
+    with pytest.raises(StateUnavailable):
+        state.get('k')
+
+    redis.drop = False
+    assert state.get('k') == b'v'
+    assert redis.connections == 2
+
+
+def test_unreachable_server():
+
+    with pytest.raises(StateUnavailable):
+        RedisState('127.0.0.1', unused_port(), timeout=0.5).get('k')
+
+
+def test_fallback_while_down_then_recovers(redis):
+
+    state = FallbackState(RedisState('127.0.0.1', redis.port, password='secret'), retry_interval=0.2)
+
+    redis.drop = True
+    assert state.add('k', 60)
+    assert not state.add('k', 60)
+    assert state.counters['fallbacks'] == 2
+    assert b'samlidp:k' not in redis.data
+
+    # the shared backend is left alone until retry_interval has passed
+    redis.drop = False
+    assert not state.add('k', 60)
+    assert state.counters['fallbacks'] == 3
+
+    time.sleep(0.3)
+    assert state.add('k', 60)
+    assert not state.add('k', 60)
+    assert b'samlidp:k' in redis.data
+    assert state.counters['fallbacks'] == 3
+
+
+def test_fallback_counter_is_exact_across_threads():
+
+    class   Down(LocalState):
+        def execute(self, operations):
+            raise StateUnavailable('down')
+
+    state = FallbackState(Down(), retry_interval=0)
+
+    def worker():
+        for _ in range(500):
+            state.get('k')
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert state.counters['fallbacks'] == 8 * 500
+
+
+def test_local_state_expiry_and_size():
+
+    state = LocalState(size=2)
+
+    assert state.add('a', 60)
+    assert not state.add('a', 60)
+    state.set('b', 'x', 60)
+    state.set('c', 'y', 60)
+    assert state.get('a') is None
+    assert state.get('c') == b'y'
+
+    state.set('short', 'z', 0.05)
+    time.sleep(0.1)
+    assert state.get('short') is None
+    assert not state.expire('short', 60)
+    assert state.pop('c') == b'y'
+    assert state.pop('c') is None
@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from SamlIdP.constants import SamlStatusSuccess
+from SamlIdP.RequestDecoder import RequestDecoder, RequestThawed, RequestUnsolicited
+from SamlIdP.SPservice import SamlSPservice
+from SamlIdP.StatelessToken import PendingRequestCodec
+
+from conftest import authn_request_qs
+
+SECRET = b'0123456789abcdef0123456789abcdef'
+
+
+def decoded(blueprint, issuer='urn:sp-a'):
+
+    saml_request = RequestDecoder('https://idp.example.com/saml2', authn_request_qs(issuer).encode(), idP=blueprint.idP)
+    saml_request.sp = SamlSPservice.getSamlSP(issuer, blueprint.idP.idp_id)
+    saml_request.idP = blueprint.idP
+    saml_request.responseStatus, saml_request.responseStatusMessage = SamlStatusSuccess, None
+
+    return saml_request
+
+
+def test_frozen_request_carries_the_query_string_only(make_idp):
+
+    app, blueprint = make_idp()
+
+    saml_request = decoded(blueprint)
+    saml_request.forceAuthn = False
+
+    frozen = saml_request.freeze()
+    assert 'root' not in json.loads(frozen)
+
+    thawed = RequestThawed(frozen)
+    assert thawed.root == saml_request.root
+    assert thawed.request['@ForceAuthn'] == 'false'
+    assert thawed.requestId == saml_request.requestId
+    assert thawed.sp is saml_request.sp
+
+
+def test_unsolicited_request_keeps_its_root(make_idp):
+
+    app, blueprint = make_idp()
+
+    sp = SamlSPservice.getSamlSP('urn:sp-b', blueprint.idP.idp_id)
+    saml_request = RequestUnsolicited('https://idp.example.com/saml2', sp)
+
+    thawed = RequestThawed(saml_request.freeze())
+    assert thawed.root == saml_request.root
+    assert thawed.unsolicited
+
+
+def test_token_is_single_use_without_a_state_store(make_idp):
+
+    app, blueprint = make_idp()
+
+    codec = PendingRequestCodec(blueprint.idP.idp_id, SECRET)
+    frozen = decoded(blueprint).freeze()
+    token = codec.encode(frozen)
+
+    assert codec.decode(token) == frozen
+
+    with pytest.raises(Exception, match='already been used'):
+        codec.decode(token)
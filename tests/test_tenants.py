@@ -0,0 +1,81 @@
+from flask import Flask, request
+import pytest
+
+from SamlIdP import SamlIdP
+
+from conftest import FakeAuth, authn_request_qs
+
+
+@pytest.fixture
+def tenants(make_idp):
+    """ (test client, auth) of two tenants at /a and /b sharing one auth """
+
+    auth = FakeAuth()
+    app = Flask(__name__)
+    app.secret_key = 'test'
+
+    # primary authentication completing - the auth calls back the IdP's hook
+    app.add_url_rule('/after', 'after', lambda: auth.after_auth_hooks['SA'](request.args['reqid']))
+
+    make_idp(auth=auth, app=app, url_prefix='/a')
+    make_idp(auth=auth, app=app, url_prefix='/b')
+
+    return app.test_client(), auth
+
+
+def login(client, auth, tenant):
+    """ Send an AuthnRequest to a tenant, return its response body """
+
+    return client.get(f'/{tenant}/saml2?' + authn_request_qs('urn:sp-a')).get_data(as_text=True)
+
+
+def test_login_is_per_tenant(tenants):
+
+    client, auth = tenants
+
+    # authenticated at the shared auth, but not through tenant a
+    auth.is_authenticated = True
+    assert login(client, auth, 'a') == 'LOGIN'
+
+    reqid = auth.logins[-1]['reqid']
+    assert 'SAMLResponse' in client.get('/after', query_string={'reqid': reqid}).get_data(as_text=True)
+
+    assert 'SAMLResponse' in login(client, auth, 'a')
+    assert login(client, auth, 'b') == 'LOGIN'
+
+
+def test_unauthenticate_clears_every_tenant(tenants):
+
+    client, auth = tenants
+    auth.is_authenticated = True
+
+    login(client, auth, 'a')
+    client.get('/after', query_string={'reqid': auth.logins[-1]['reqid']})
+
+    with client.session_transaction() as sess:
+        assert sess['saml_idps'] == ['urn:idp0']
+
+    auth.unauthenticate()
+    assert login(client, auth, 'a') == 'LOGIN'
+
+
+def test_single_idp_trusts_its_auth(make_idp):
+
+    app, blueprint = make_idp()
+    blueprint.idP.auth.is_authenticated = True
+
+    assert 'SAMLResponse' in app.test_client().get('/saml2?' + authn_request_qs('urn:sp-a')).get_data(as_text=True)
+
+
+def test_duplicate_names_are_refused(make_idp, keypair):
+
+    app, blueprint = make_idp(name='tenant')
+
+    with pytest.raises(AssertionError, match='blueprint name tenant already registered'):
+        make_idp(app=app, name='tenant', entityId='urn:idp.other')
+
+    cert, key = keypair
+    configs = [{'entityId': f'urn:idp.dup{n}', 'x509Cert': cert, 'priv_key': key, 'splist': []} for n in range(2)]
+
+    with pytest.raises(AssertionError, match="tenant names \\['samlidp'\\] are not unique"):
+        SamlIdP.tenants(auth=FakeAuth(), idp_configs=configs)
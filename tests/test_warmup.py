@@ -0,0 +1,27 @@
+import os
+import time
+
+
+def wait_ready(blueprint, timeout=10):
+
+    deadline = time.monotonic() + timeout
+    while not blueprint.ready and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return blueprint.ready
+
+
+def test_forked_worker_warms_up_again(make_idp, monkeypatch):
+
+    app, blueprint = make_idp()
+
+    with app.test_client() as client:
+        assert client.get('/saml2/ready').status_code == 200
+
+        # as in a worker forked from a preloaded master
+        parent = os.getpid()
+        monkeypatch.setattr(os, 'getpid', lambda: parent + 1)
+
+        assert client.get('/saml2/ready').status_code == 503
+        assert wait_ready(blueprint)
+        assert client.get('/saml2/ready').status_code == 200
+        assert blueprint.ready_pid == parent + 1